@@ -1,19 +1,47 @@
 # filepath: /home/djiang/jiang_ws/coding_ws/tree_health_analysis/app_tree_analysis.py
+import time
+SCRIPT_START = time.perf_counter()
 import streamlit as st
-from openai import AzureOpenAI #, RateLimitError
-from PIL import Image
 import base64
 import os
 import json
+import mimetypes
+import re
+import hashlib
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 # from azure.identity import DefaultAzureCredential, get_bearer_token_provider
-import pandas as pd
-from geopy.geocoders import Nominatim
-from geopy.extra.rate_limiter import RateLimiter
-import io
-import pydeck as pdk
+# openai, pandas, pydeck and geopy are imported where first used, so a bare page
+# does not pay for them (about 1.4 s of a cold start)
+from image_preprocessing import VISION_SHORT_EDGE, JPEG_QUALITY, DEDUPE_THRESHOLD
+from image_store import ImageStore
+from translations import get_text
+from chat_context import CHAT_CONTEXT_BUDGET, build_chat_messages, model_summarizer
+from metrics import METRICS, Metrics
+from map_view import build_map_deck
+from report_export import write_pdf, write_xlsx
+from client_pool import EndpointPool, endpoint_configs
+from job_queue import FINISHED_STATUSES, JobQueue, start_worker, worker_running
+from inventory import TreeInventory
+from geocoding import Geocoder
+from tree_pipeline import (
+    CACHE_DIR, MAX_PACK_SIZE, CASCADE_MODEL, CASCADE_TRIAGE_MODEL, AnalysisCache, get_grade_details, get_risk_grade_details,
+    create_completion_with_retry, summarize_usage, localize_results
+)
+IMPORT_SECONDS = time.perf_counter() - SCRIPT_START
 
 
 # --- 1. AZURE OPENAI CLIENT INITIALIZATION ---
+@st.cache_resource
+def create_client(endpoints):
+    """Builds the endpoint pool once per process, so every session shares its connections and quota."""
+    # Retries are handled by create_completion_with_retry so 429 backoff is not doubled
+    return EndpointPool(endpoints)
+
+def get_client():
+    return create_client(AZURE_ENDPOINTS)
+
 try:
     # credential = DefaultAzureCredential()
     # token_provider = get_bearer_token_provider(credential, "https://cognitiveservices.azure.com/.default")
@@ -22,12 +50,10 @@ try:
     #     azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT_SWEDEN_CENTRAL"),
     #     azure_ad_token_provider=token_provider,
     # )
-    client = AzureOpenAI(
-        azure_endpoint = st.secrets["auth_endpoint"], # os.getenv("AZURE_OPENAI_ENDPOINT_SWEDEN_CENTRAL"), 
-        api_key= st.secrets["auth_key"], # os.getenv("AZURE_OPENAI_API_KEY_SWEDEN_CENTRAL"),  
-        api_version= st.secrets["auth_version"] # os.getenv("AZURE_OPENAI_API_VERSION")
-      )
-    if not st.secrets["auth_key"]: # os.getenv("AZURE_OPENAI_API_KEY_SWEDEN_CENTRAL"):
+    # The clients themselves are created on first use by get_client(); see client_pool.py
+    # for the azure_endpoints list, otherwise auth_endpoint/auth_key/auth_version are used
+    AZURE_ENDPOINTS = endpoint_configs(st.secrets)
+    if not all(endpoint["api_key"] for endpoint in AZURE_ENDPOINTS): # os.getenv("AZURE_OPENAI_API_KEY_SWEDEN_CENTRAL"):
         st.error("AZURE_OPENAI_API_KEY_SWEDEN_CENTRAL environment variable is not set.")
         st.stop()
 except Exception as e:
@@ -36,171 +62,7 @@ except Exception as e:
     st.error(f"Failed to initialize Azure OpenAI client: {e}")
     st.stop()
 
-# --- 2. MULTI-LANGUAGE SUPPORT ---
-translations = {
-    "English": {
-        "title": "🌳 Tree Health Dashboard",
-        "select_lang": "Select Language",
-        "select_model": "Select AI Model",
-        "clear_button": "Clear & Start Over",
-        "upload_prompt": "📤 Drag & drop or click to upload tree images",
-        "analyze_button": "Analyze Images",
-        "health_grade_header": "Health Grade Assessment",
-        "health_grade": "Health Grade",
-        "tree_type": "Tree Type",
-        "approx_age": "Approx. Age",
-        "location": "Photographed Location", # Origin / Location
-        "native_origins": "Native Origins",
-        "details_expander": "View Details & Chat",
-        "observations": "Observations",
-        "rehab_advice": "Rehabilitation Advice",
-        "chat_prompt": "Ask a follow-up question...",
-        "spinner_text": "Analyzing image {i} of {n}... 🌿",
-        "clear_toast": "✅ Reset complete. Ready for new images.",
-        "legend_header": "Health Grade Legend",
-        "summary_table_header": "Batch Analysis Summary",
-        "map_header": "Geographic Distribution of Trees",
-        "debug_expander": "Debug Info",
-        "map_fail_header": "Locations Not Found on Map",
-        "map_fail_info": "The following locations were too general to be plotted:",
-        "summary_filename": "Filename",
-        "map_legend_header": "Map Legend",
-        "map_legend_location": "Photographed Location",
-        "map_legend_origin": "Native Origin",
-        "risk_assessment_header": "Infection & Hazard Potential",
-        "risk_grade": "Risk Grade",
-        "felling_header": "Felling & Safety Recommendations",
-        "felling_method": "Recommended Method",
-        "felling_safety": "Safety Parameters",
-        "felling_preservation_method": "Tree is healthy. Prioritize preservation measures like pruning, reinforcement, or transplanting.",
-        "risk_grade_low": "Low",
-        "risk_grade_medium": "Medium",
-        "risk_grade_high": "High",
-        "risk_grade_critical": "Critical",
-        "risk_grade_unknown": "Unknown",
-        "risk_legend_header": "Risk Grade Legend"
-    },
-    "Deutsch": {
-        "title": "🌳 Baumgesundheits-Dashboard",
-        "select_lang": "Sprache auswählen",
-        "select_model": "KI-Modell auswählen",
-        "clear_button": "Löschen & Neustarten",
-        "upload_prompt": "📤 Bilder per Drag & Drop oder Klick hochladen",
-        "analyze_button": "Bilder analysieren",
-        "health_grade_header": "Gesundheitsbewertung",
-        "health_grade": "Gesundheitsgrad",
-        "tree_type": "Baumart",
-        "approx_age": "Ungefähres Alter",
-        "location": "Fotografierter Standort", # Herkunft / Standort
-        "native_origins": "Heimische Herkunft",
-        "details_expander": "Details & Chat anzeigen",
-        "observations": "Beobachtungen",
-        "rehab_advice": "Rehabilitationsratschläge",
-        "chat_prompt": "Stellen Sie eine Folgefrage...",
-        "spinner_text": "Analysiere Bild {i} von {n}... 🌿",
-        "clear_toast": "✅ Zurücksetzen abgeschlossen. Bereit für neue Bilder.",
-        "legend_header": "Legende der Gesundheitsgrade",
-        "summary_table_header": "Zusammenfassung der Stapelanalyse",
-        "map_header": "Geografische Verteilung der Bäume",
-        "debug_expander": "Debug-Informationen",
-        "map_fail_header": "Standorte, die nicht auf der Karte gefunden wurden",
-        "map_fail_info": "Die folgenden Standorte waren zu allgemein, um dargestellt zu werden:",
-        "summary_filename": "Dateiname",
-        "map_legend_header": "Kartenlegende",
-        "map_legend_location": "Fotografierter Standort",
-        "map_legend_origin": "Heimische Herkunft",
-        "risk_assessment_header": "Infektions- und Gefahrenpotenzial",
-        "risk_grade": "Risikograd",
-        "felling_header": "Fäll- und Sicherheitsempfehlungen",
-        "felling_method": "Empfohlene Methode",
-        "felling_safety": "Sicherheitsparameter",
-        "felling_preservation_method": "Baum ist gesund. Priorisieren Sie Erhaltungsmaßnahmen wie Schnitt, Verstärkung oder Umpflanzung.",
-        "risk_grade_low": "Niedrig",
-        "risk_grade_medium": "Mittel",
-        "risk_grade_high": "Hoch",
-        "risk_grade_critical": "Kritisch",
-        "risk_grade_unknown": "Unbekannt",
-        "risk_legend_header": "Legende der Risikograde"
-    },
-    "中文": {
-        "title": "🌳 树木健康仪表板",
-        "select_lang": "选择语言",
-        "select_model": "选择AI模型",
-        "clear_button": "清除并重新开始",
-        "upload_prompt": "📤 拖拽或点击上传树木图片",
-        "analyze_button": "分析图片",
-        "health_grade_header": "健康等级评估",
-        "health_grade": "健康等级",
-        "tree_type": "树木种类",
-        "approx_age": "大约年龄",
-        "location": "拍摄地 / 位置",
-        "native_origins": "主要原产地",
-        "details_expander": "查看详情与对话",
-        "observations": "观察结果",
-        "rehab_advice": "复健建议",
-        "chat_prompt": "提出后续问题...",
-        "spinner_text": "正在分析第 {i} 张图片，共 {n} 张... 🌿",
-        "clear_toast": "✅ 重置完成，请上传新图片。",
-        "legend_header": "健康等级图例",
-        "summary_table_header": "批量分析总览",
-        "map_header": "树木地理位置分布",
-        "debug_expander": "调试信息",
-        "map_fail_header": "地图上未找到的位置",
-        "map_fail_info": "以下位置因过于宽泛而无法标示：",
-        "summary_filename": "文件名",
-        "map_legend_header": "地图图例",
-        "map_legend_location": "拍摄位置",
-        "map_legend_origin": "原生栖息地",
-        "risk_assessment_header": "感染与危险潜力评估",
-        "risk_grade": "风险等级",
-        "felling_header": "伐木技术及安全建议",
-        "felling_method": "推荐方法",
-        "felling_safety": "安全参数",
-        "felling_preservation_method": "树木健康，优先考虑修剪、加固或移植等保护措施。",
-        "risk_grade_low": "低",
-        "risk_grade_medium": "中",
-        "risk_grade_high": "高",
-        "risk_grade_critical": "危急",
-        "risk_grade_unknown": "未知",
-        "risk_legend_header": "风险等级图例"
-    }
-}
-
-# --- 3. HELPER & VISUALIZATION FUNCTIONS ---
-def get_text(lang, key):
-    return translations.get(lang, translations["English"]).get(key)
-
-def encode_image(image_bytes, resize_to=None):
-    img = Image.open(io.BytesIO(image_bytes))
-    if resize_to:
-        img.thumbnail(resize_to)
-    buffered = io.BytesIO()
-    img_format = 'PNG' if img.mode == 'RGBA' else 'JPEG'
-    img.save(buffered, format=img_format)
-    return base64.b64encode(buffered.getvalue()).decode('utf-8')
-
-def get_grade_details(grade):
-    """Maps a health grade to a color, value, and description."""
-    grade_map = {
-        "A": {"color": "#28a745", "value": 100, "desc": "Excellent", "icon": "🌿"},
-        "B": {"color": "#90EE90", "value": 80, "desc": "Good", "icon": "🌳"},
-        "C": {"color": "#ffc107", "value": 60, "desc": "Fair", "icon": "⚠️"},
-        "D": {"color": "#fd7e14", "value": 40, "desc": "Poor", "icon": "❗️"},
-        "E": {"color": "#dc3545", "value": 20, "desc": "Critical", "icon": "🆘"},
-        "F": {"color": "#6c757d", "value": 0, "desc": "Failed / Dead", "icon": "💀"},
-    }
-    return grade_map.get(str(grade).upper(), {"color": "#6c757d", "value": 0, "desc": "Unknown", "icon": "❓"})
-
-def get_risk_grade_details(grade, lang):
-    """Maps a risk grade to a color, value, description, and icon."""
-    grade_map = {
-        "LOW":      {"color": "#28a745", "value": 25, "desc": get_text(lang, "risk_grade_low"), "icon": "🛡️"},
-        "MEDIUM":   {"color": "#ffc107", "value": 50, "desc": get_text(lang, "risk_grade_medium"), "icon": "⚠️"},
-        "HIGH":     {"color": "#fd7e14", "value": 75, "desc": get_text(lang, "risk_grade_high"), "icon": "🔥"},
-        "CRITICAL": {"color": "#dc3545", "value": 100, "desc": get_text(lang, "risk_grade_critical"), "icon": "🚨"},
-    }
-    return grade_map.get(str(grade).upper(), {"color": "#6c757d", "value": 0, "desc": get_text(lang, "risk_grade_unknown"), "icon": "❓"})
-
+# --- 2. HELPER & VISUALIZATION FUNCTIONS ---
 def create_progress_circle(progress, color, size=120):
     stroke_width = 10
     radius = (size / 2) - stroke_width
@@ -213,38 +75,157 @@ def clear_state(lang):
     """Resets the session state and increments the uploader key to clear it."""
     st.session_state.batch_results = []
     st.session_state.chat_histories = {}
+    st.session_state.chat_contexts = {}
+    st.session_state.summary_memo = {}
+    st.session_state.thumbnail_memo = {}
+    st.session_state.batch_usage = None
+    st.session_state.batch_lang = None
+    st.session_state.localized = {}
+    st.session_state.exports = {}
+    # The job keeps its photos and results; the session just stops following it
+    st.session_state.job_id = None
+    st.session_state.job_loaded = None
+    st.query_params.pop("job", None)
+    st.session_state.image_store = ImageStore()
     st.session_state.uploader_key += 1
     st.toast(get_text(lang, "clear_toast"))
 
 @st.cache_resource
 def get_geocoder():
-    return RateLimiter(Nominatim(user_agent="tree_health_app").geocode, min_delay_seconds=1)
+    return Geocoder()
+
+def geocode_many(location_strs):
+    return get_geocoder().geocode_many(location_strs)
 
 def get_lat_lon(location_str):
-    if not location_str:
-        return None, None
-    
-    # Expanded list of terms to treat as invalid locations
-    unknown_terms = ['n/a', 'unknown', 'unspecified', 'uncertain', 'not specified']
-    if any(term in location_str.lower() for term in unknown_terms):
-        return None, None
-
-    try:
-        geocode = get_geocoder()
-        location = geocode(location_str)
-        if location:
-            return location.latitude, location.longitude
-    except Exception:
-        return None, None
-    return None, None
-
-def image_to_html_thumbnail(img_bytes):
-    b64_img = encode_image(img_bytes, resize_to=(50, 50))
-    return f'<img src="data:image/png;base64,{b64_img}" width="50">'
+    return geocode_many([location_str]).get(location_str, (None, None))
+
+def image_to_data_url(thumbnail_path):
+    with open(thumbnail_path, "rb") as f:
+        b64_img = base64.b64encode(f.read()).decode('utf-8')
+    mime_type = mimetypes.guess_type(thumbnail_path)[0]
+    return f"data:{mime_type};base64,{b64_img}"
+
+# Older chat turns are condensed by the cheaper model; the answer itself uses the selected model
+CHAT_SUMMARY_MODEL = "gpt-4.1-mini"
+
+def format_chat_tokens(message, lang):
+    """Caption with the context size sent for an answer and, when reported, the billed usage."""
+    tokens = message["context_tokens"]
+    text = get_text(lang, "chat_context_stats").format(
+        total=tokens["total_tokens"], prefix=tokens["prefix_tokens"], summary=tokens["summary_tokens"],
+        history=tokens["history_tokens"], folded=tokens["folded_turns"]
+    )
+    if "usage" in message:
+        text += " · " + get_text(lang, "chat_usage_stats").format(**message["usage"])
+    return text
+
+def model_label(model, lang):
+    return get_text(lang, "cascade_option") if model == CASCADE_MODEL else model
+
+def format_batch_usage(batch_usage, lang):
+    """Caption comparing the model requests, tokens and time of the last batch."""
+    lines = [get_text(lang, "batch_usage").format(
+        images=batch_usage["images"], seconds=batch_usage["seconds"], option=model_label(batch_usage["option"], lang)
+    )]
+    for model, usage in sorted(batch_usage["models"].items()):
+        lines.append(get_text(lang, "batch_usage_model").format(
+            model=model, requests=usage["requests"], prompt=usage["prompt_tokens"], completion=usage["completion_tokens"], seconds=usage["seconds"]
+        ))
+    return "  \n".join(lines)
+
+def render_diagnostics(container, lang):
+    """Stage timings, token usage, retries and cache hit rates of this process and the job worker."""
+    import pandas as pd
+    worker = get_job_queue().worker_stats()
+    metrics = Metrics()
+    metrics.merge(METRICS.dump())
+    if worker is not None:
+        metrics.merge(worker["metrics"])
+    snapshot = metrics.snapshot()
+    container.subheader(get_text(lang, "diagnostics_header"))
+    if snapshot["stages"]:
+        container.caption(get_text(lang, "diagnostics_stages"))
+        container.dataframe(pd.DataFrame([
+            {"stage": stage, "n": data["count"], "p50 s": data["p50_seconds"], "p95 s": data["p95_seconds"], "total s": data["total_seconds"]}
+            for stage, data in sorted(snapshot["stages"].items())
+        ]).round(3), hide_index=True, use_container_width=True)
+    container.caption(get_text(lang, "diagnostics_endpoints"))
+    container.dataframe(pd.DataFrame(get_client().status()), hide_index=True, use_container_width=True)
+    if worker is not None:
+        container.caption(get_text(lang, "diagnostics_worker_endpoints").format(age=time.time() - worker["saved_at"]))
+        container.dataframe(pd.DataFrame(worker["endpoints"]), hide_index=True, use_container_width=True)
+
+    def hit_rate(cache):
+        hits = metrics.counter("cache_requests_total", cache=cache, result="hit")
+        lookups = hits + metrics.counter("cache_requests_total", cache=cache, result="miss")
+        return f"{hits / lookups:.0%}" if lookups else "–"
+
+    pack_sizes = sorted({counter["labels"]["pack_size"] for counter in snapshot["counters"] if counter["name"] == "analysis_images_total"}, key=int)
+    if pack_sizes:
+        container.caption(get_text(lang, "diagnostics_packing").format(stats=" · ".join(
+            f"{size}: {metrics.counter('analysis_prompt_tokens_total', pack_size=size) / metrics.counter('analysis_images_total', pack_size=size):.0f}"
+            for size in pack_sizes
+        )))
+    escalations = {counter["labels"]["reason"]: counter["value"] for counter in snapshot["counters"] if counter["name"] == "cascade_escalations_total"}
+    if escalations:
+        container.caption(get_text(lang, "diagnostics_cascade").format(stats=" · ".join(
+            f"{get_text(lang, 'escalation_' + reason)}: {count}" for reason, count in sorted(escalations.items())
+        )))
+    container.caption(get_text(lang, "diagnostics_startup").format(
+        imports=IMPORT_SECONDS, first_paint=st.session_state.first_paint_seconds,
+        cold_imports=snapshot["stages"]["script_imports"]["max_seconds"]
+    ))
+    container.caption(get_text(lang, "diagnostics_summary").format(
+        prompt=metrics.counter("tokens_total", kind="prompt"), cached=metrics.counter("tokens_total", kind="cached"),
+        completion=metrics.counter("tokens_total", kind="completion"), retries=metrics.counter("retries_total"),
+        analysis_hits=hit_rate("analysis"), geocode_hits=hit_rate("geocode")
+    ))
+    container.download_button(
+        get_text(lang, "diagnostics_download_prometheus"), metrics.export_prometheus(),
+        file_name="tree_health_metrics.prom", mime="text/plain", use_container_width=True
+    )
+    container.download_button(
+        get_text(lang, "diagnostics_download_json"), json.dumps(snapshot, indent=2),
+        file_name="tree_health_metrics.json", mime="application/json", use_container_width=True
+    )
+
+def display_partial_card(container, analysis, idx, lang):
+    """Renders the fields of a still-streaming analysis; the full card replaces it on completion."""
+    with container:
+        st.caption(f"Tree {idx+1} · {get_text(lang, 'streaming_text')}")
+        if "health_grade" in analysis:
+            grade = analysis["health_grade"]
+            grade_details = get_grade_details(grade)
+            st.metric(label=get_text(lang, "health_grade"), value=f"Grade {grade}")
+            st.markdown(f"**{grade_details['icon']} {grade_details['desc']}**")
+        fields = [("tree_type", "tree_type"), ("approximate_age", "approx_age"), ("location", "location")]
+        st.markdown("\n".join(f"- **{get_text(lang, label)}:** {analysis[key]}" for key, label in fields if key in analysis))
+        risk_grade = (analysis.get("risk_assessment") or {}).get("infection_and_hazard_potential_grade")
+        if risk_grade:
+            risk_details = get_risk_grade_details(risk_grade, lang)
+            st.markdown(f"**{get_text(lang, 'risk_grade')}:** {risk_details['icon']} {risk_details['desc']}")
+        if analysis.get("detailed_observations"):
+            st.markdown(f"**{get_text(lang, 'observations')}:**")
+            st.write(analysis["detailed_observations"])
+        if analysis.get("rehabilitation_advice"):
+            st.markdown(f"**{get_text(lang, 'rehab_advice')}:**")
+            st.write(analysis["rehabilitation_advice"])
 
 def display_result_card(container, result, idx, lang):
     with container:
-        st.image(result["image"], use_container_width=True, caption=f"Tree {idx+1}")
+        st.image(st.session_state.image_store.path(result["image_id"], "display"), use_container_width=True, caption=f"Tree {idx+1}")
+        if result.get("duplicate_of"):
+            duplicate_of = result["duplicate_of"]
+            st.caption(get_text(lang, "duplicate_caption").format(
+                source=duplicate_of["filename"] or get_text(lang, "duplicate_cached_source"), distance=duplicate_of["distance"]
+            ))
+        if result.get("escalated"):
+            st.caption(get_text(lang, "model_escalated_caption").format(
+                model=result["model"], triage=CASCADE_TRIAGE_MODEL, reason=get_text(lang, "escalation_" + result["escalated"])
+            ))
+        elif result.get("model"):
+            st.caption(get_text(lang, "model_caption").format(model=result["model"]))
         
         if result["analysis"]:
             st.markdown("---")
@@ -291,7 +272,7 @@ def display_result_card(container, result, idx, lang):
                 # Conditionally display safety parameters
                 # Hide if the method is the preservation one, or if the parameters object is missing/empty.
                 preservation_method_text = get_text(lang, "felling_preservation_method")
-                if "safety_parameters" in felling and felling.get("recommended_method") != preservation_method_text:
+                if felling.get("safety_parameters") and felling.get("recommended_method") != preservation_method_text:
                     st.markdown(f"**{get_text(lang, 'felling_safety')}:**")
                     safety = felling["safety_parameters"]
                     safety_text = f"""
@@ -316,6 +297,8 @@ def display_result_card(container, result, idx, lang):
                 for message in st.session_state.chat_histories[idx]:
                     with st.chat_message(message["role"]):
                         st.markdown(message["content"])
+                        if "context_tokens" in message:
+                            st.caption(format_chat_tokens(message, lang))
 
                 if prompt := st.chat_input(get_text(lang, "chat_prompt"), key=f"chat_{idx}"):
                     st.session_state.chat_histories[idx].append({"role": "user", "content": prompt})
@@ -323,23 +306,470 @@ def display_result_card(container, result, idx, lang):
                         st.markdown(prompt)
 
                     with st.chat_message("assistant"):
-                        with st.spinner("Thinking..."):
-                            context = f"The user is asking a follow-up question about a specific tree. The initial analysis for this tree was: {json.dumps(res)}."
-                            messages_for_api = [{"role": "system", "content": context}] + st.session_state.chat_histories[idx]
-                            
-                            try:
-                                chat_response = client.chat.completions.create(model=st.session_state.selected_model, messages=messages_for_api, max_completion_tokens=500)
-                                response_text = chat_response.choices[0].message.content
-                                st.markdown(response_text)
-                                st.session_state.chat_histories[idx].append({"role": "assistant", "content": response_text})
-                            except Exception as e:
-                                st.error(f"An error occurred: {e}")
+                        # The cascade's follow-ups go to the model that produced the analysis
+                        chat_model = st.session_state.selected_model
+                        if chat_model == CASCADE_MODEL:
+                            chat_model = result.get("model") or CASCADE_TRIAGE_MODEL
+                        summarize = model_summarizer(
+                            lambda **kwargs: create_completion_with_retry(get_client(), threading.Event(), **kwargs), CHAT_SUMMARY_MODEL
+                        )
+                        messages_for_api, context_tokens = build_chat_messages(
+                            res, st.session_state.chat_histories[idx], st.session_state.chat_contexts.setdefault(idx, {}),
+                            budget_tokens=st.session_state.chat_context_budget, summarize=summarize
+                        )
+                        usage = {}
+
+                        def stream_text(chat_stream):
+                            for chunk in chat_stream:
+                                if getattr(chunk, "usage", None):
+                                    usage["usage"] = chunk.usage
+                                if chunk.choices and chunk.choices[0].delta.content:
+                                    yield chunk.choices[0].delta.content
+
+                        try:
+                            with METRICS.timer("chat_request", model=chat_model):
+                                if st.session_state.stream_responses:
+                                    chat_stream = create_completion_with_retry(get_client(), threading.Event(), model=chat_model, messages=messages_for_api, max_completion_tokens=500, stream=True, stream_options={"include_usage": True})
+                                    response_text = st.write_stream(stream_text(chat_stream))
+                                else:
+                                    with st.spinner("Thinking..."):
+                                        chat_response = create_completion_with_retry(get_client(), threading.Event(), model=chat_model, messages=messages_for_api, max_completion_tokens=500)
+                                    usage["usage"] = chat_response.usage
+                                    response_text = chat_response.choices[0].message.content
+                                    st.markdown(response_text)
+                            METRICS.record_usage(usage.get("usage"), chat_model)
+                            message = {"role": "assistant", "content": response_text, "context_tokens": context_tokens}
+                            if usage.get("usage"):
+                                details = getattr(usage["usage"], "prompt_tokens_details", None)
+                                message["usage"] = {
+                                    "prompt_tokens": usage["usage"].prompt_tokens,
+                                    "cached_tokens": getattr(details, "cached_tokens", None) or 0,
+                                    "completion_tokens": usage["usage"].completion_tokens,
+                                }
+                            st.caption(format_chat_tokens(message, lang))
+                            st.session_state.chat_histories[idx].append(message)
+                        except Exception as e:
+                            st.error(f"An error occurred: {e}")
         else:
             st.error(f"Analysis Failed: {result['error']}")
             with st.expander(get_text(lang, "debug_expander")):
                 st.code(result['raw_text'])
 
-# --- 4. MAIN APPLICATION LOGIC ---
+# --- 3. PERSISTENT CACHES & SHARED RESOURCES ---
+@st.cache_resource
+def get_analysis_cache():
+    return AnalysisCache(os.path.join(CACHE_DIR, "analysis_cache.sqlite3"))
+
+@st.cache_resource
+def get_job_queue():
+    return JobQueue()
+
+@st.cache_resource
+def get_inventory():
+    return TreeInventory()
+
+# --- 4. INCREMENTAL SUMMARY RENDERING ---
+def result_fingerprint(result):
+    """Changes whenever a result's analysis (or error) changes."""
+    content = json.dumps([result["analysis"], result["error"]], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+def get_thumbnail_url(result):
+    """Thumbnails depend only on the image, so they survive language switches.
+
+    With static file serving the table only carries the thumbnail's URL; otherwise the
+    image is inlined as a data URL.
+    """
+    thumbnails = st.session_state.thumbnail_memo
+    if result["id"] not in thumbnails:
+        if st.get_option("server.enableStaticServing"):
+            thumbnails[result["id"]] = st.session_state.image_store.publish(result["image_id"], "thumbnail", st.get_option("server.baseUrlPath"))
+        else:
+            thumbnails[result["id"]] = image_to_data_url(st.session_state.image_store.path(result["image_id"], "thumbnail"))
+    return thumbnails[result["id"]]
+
+def summarize_result(result, lang, coordinates):
+    """Builds the summary-table row and map points for a single result."""
+    summary = {"row": None, "location_points": [], "origin_points": [], "failed_locations": []}
+    if result["analysis"]:
+        res = result["analysis"]
+        
+        # Process photographed location
+        loc_str = res.get('location', 'N/A')
+        lat, lon = coordinates.get(loc_str, (None, None))
+        if lat is not None and lon is not None:
+            summary["location_points"].append({
+                "lat": lat, "lon": lon, "place": loc_str,
+                "filename": result.get('filename', 'N/A'), "species": res.get('tree_type', 'N/A')
+            })
+        elif loc_str.lower() not in ['n/a', 'unknown']:
+            summary["failed_locations"].append(loc_str)
+
+        # Process native origins
+        native_origins = res.get('native_origins', [])
+        for origin_loc in native_origins:
+            origin_lat, origin_lon = coordinates.get(origin_loc, (None, None))
+            if origin_lat is not None and origin_lon is not None:
+                summary["origin_points"].append({
+                    "lat": origin_lat, "lon": origin_lon, "place": origin_loc,
+                    "filename": result.get('filename', 'N/A'), "species": res.get('tree_type', 'N/A')
+                })
+
+        summary["row"] = {
+            get_text(lang, "summary_filename"): result.get("filename", "N/A"),
+            "Thumbnail": get_thumbnail_url(result),
+            get_text(lang, "health_grade"): res.get('health_grade', 'N/A'),
+            get_text(lang, "risk_grade"): res.get('risk_assessment', {}).get('infection_and_hazard_potential_grade', 'N/A'),
+            get_text(lang, "tree_type"): res.get('tree_type', 'N/A'),
+            get_text(lang, "location"): loc_str,
+            get_text(lang, "native_origins"): ', '.join(native_origins) or 'N/A',
+        }
+    else:
+         summary["row"] = {
+            get_text(lang, "summary_filename"): result.get("filename", "N/A"), 
+            "Thumbnail": get_thumbnail_url(result),
+            get_text(lang, "health_grade"): "Error", 
+            get_text(lang, "risk_grade"): "Error",
+            get_text(lang, "tree_type"): "Error", 
+            get_text(lang, "location"): "Error",
+            get_text(lang, "native_origins"): "Error"
+        }
+    return summary
+
+def duplicate_group_labels(results, lang):
+    """Summary-table label per result id for near-duplicates sharing one analysis ("#2", "#2 (≈3)")."""
+    def group_key(result):
+        duplicate_of = result.get("duplicate_of")
+        return duplicate_of["image_id"] if duplicate_of else result["image_id"]
+
+    sizes = {}
+    for result in results:
+        sizes[group_key(result)] = sizes.get(group_key(result), 0) + 1
+    numbers, labels = {}, {}
+    for result in results:
+        duplicate_of = result.get("duplicate_of")
+        if duplicate_of and duplicate_of["filename"] is None:
+            labels[result["id"]] = get_text(lang, "summary_group_cached").format(distance=duplicate_of["distance"])
+        elif sizes[group_key(result)] > 1:
+            number = numbers.setdefault(group_key(result), len(numbers) + 1)
+            labels[result["id"]] = f"#{number}" + (f" (≈{duplicate_of['distance']})" if duplicate_of else "")
+    return labels
+
+def get_summary_view(results, lang):
+    """Returns the summary table (a DataFrame), map deck and unplotted locations for the batch.
+
+    Per-result summaries are memoized by (result id, language) and only rebuilt when a
+    result is new or its analysis changed, so geocoding and thumbnail encoding run once
+    per result. The assembled table and map are reused as long as no result changed.
+    """
+    import pandas as pd
+    memo = st.session_state.summary_memo
+    fingerprints = [result_fingerprint(result) for result in results]
+    stale = [(result, fp) for result, fp in zip(results, fingerprints) if memo.get((result["id"], lang), (None,))[0] != fp]
+    if stale:
+        with METRICS.timer("summary_rows", rows=len(stale)):
+            coordinates = geocode_many(
+                place
+                for result, _ in stale if result["analysis"]
+                for place in [result["analysis"].get('location', 'N/A')] + list(result["analysis"].get('native_origins', []))
+            )
+            for result, fp in stale:
+                memo[(result["id"], lang)] = (fp, summarize_result(result, lang, coordinates))
+        live_ids = {result["id"] for result in results}
+        for key in [key for key in memo if key[0] not in live_ids]:
+            del memo[key]
+
+    view_key = (lang, tuple(zip((result["id"] for result in results), fingerprints)))
+    if st.session_state.summary_view_key != view_key:
+        with METRICS.timer("summary_view", rows=len(results)):
+            summaries = [memo[(result["id"], lang)][1] for result in results]
+            summary_data = [summary["row"] for summary in summaries]
+            group_labels = duplicate_group_labels(results, lang)
+            if group_labels:
+                for i, result in enumerate(results):
+                    # Right after the filename, so the photos of one group are easy to pick out
+                    items = list(summary_data[i].items())
+                    summary_data[i] = dict([items[0], (get_text(lang, "summary_group"), group_labels.get(result["id"], "")), *items[1:]])
+            failed_locations = [loc for summary in summaries for loc in summary["failed_locations"]]
+            location_points = [point for summary in summaries for point in summary["location_points"]]
+            origin_points = [point for summary in summaries for point in summary["origin_points"]]
+            st.session_state.summary_view = {
+                "table": pd.DataFrame(summary_data) if summary_data else None,
+                "deck": build_map_deck(location_points, origin_points),
+                # Also drawn into the exported reports
+                "location_points": location_points,
+                "origin_points": origin_points,
+                "failed_locations": list(dict.fromkeys(failed_locations)),
+            }
+        st.session_state.summary_view_key = view_key
+    return st.session_state.summary_view
+
+def get_localized_results(lang):
+    """The batch with its analyses in ``lang``, re-localized by text-only requests on the first switch to it.
+
+    Kept per language for the session; translations are also stored in the analysis
+    cache, so other sessions and later switches of the same batch reuse them.
+    """
+    localized = st.session_state.localized
+    if lang not in localized:
+        results = list(st.session_state.batch_results)
+        progress = st.progress(0.0, text=get_text(lang, "translating").format(done=0, total=len(results)))
+        with METRICS.timer("relocalize", results=len(results)):
+            translated = localize_results(get_client(), st.session_state.batch_results, lang, cache=get_analysis_cache())
+            for done, (i, payload) in enumerate(translated, start=1):
+                results[i] = payload
+                progress.progress(done / len(results), text=get_text(lang, "translating").format(done=done, total=len(results)))
+        progress.empty()
+        localized[lang] = results
+    return localized[lang]
+
+def retry_translation(lang):
+    st.session_state.localized.pop(lang, None)
+
+# Rows sent to the browser per summary page; thumbnails are fetched by URL, so a page
+# costs the same whatever the batch size
+SUMMARY_PAGE_SIZE = 50
+SUMMARY_SORTS = ["summary_sort_upload", "summary_sort_health", "summary_sort_risk"]
+
+def health_sort_key(grade):
+    """Worst grade first; errors and unknown grades last."""
+    details = get_grade_details(grade)
+    return details["value"] if details["desc"] != "Unknown" else 101
+
+def filter_summary_table(table, lang, health_grades, risk_grades, sort):
+    """The summary rows matching the selected grades (all when none are selected), in ``sort`` order."""
+    health_column, risk_column = get_text(lang, "health_grade"), get_text(lang, "risk_grade")
+    if health_grades:
+        table = table[table[health_column].isin(health_grades)]
+    if risk_grades:
+        table = table[table[risk_column].isin(risk_grades)]
+    if sort == "summary_sort_health":
+        table = table.sort_values(health_column, key=lambda grades: grades.map(health_sort_key), kind="stable")
+    elif sort == "summary_sort_risk":
+        table = table.sort_values(risk_column, key=lambda grades: grades.map(lambda grade: -get_risk_grade_details(grade, lang)["value"]), kind="stable")
+    return table
+
+def render_summary_table(table, lang):
+    """Grade filters, sort order and one page of the summary table."""
+    health_column, risk_column = get_text(lang, "health_grade"), get_text(lang, "risk_grade")
+    controls = st.columns(3)
+    health_grades = controls[0].multiselect(
+        health_column, options=sorted(table[health_column].unique(), key=health_sort_key), key="summary_health_filter"
+    )
+    risk_grades = controls[1].multiselect(
+        risk_column, options=sorted(table[risk_column].unique(), key=lambda grade: -get_risk_grade_details(grade, lang)["value"]),
+        key="summary_risk_filter"
+    )
+    sort = controls[2].selectbox(get_text(lang, "summary_sort"), options=SUMMARY_SORTS, format_func=lambda key: get_text(lang, key))
+    rows = filter_summary_table(table, lang, health_grades, risk_grades, sort)
+
+    pages = max(1, -(-len(rows) // SUMMARY_PAGE_SIZE))
+    if st.session_state.get("summary_page", 1) > pages:
+        # Filters shrank the table below the page that was open
+        st.session_state.summary_page = pages
+    page = st.number_input(get_text(lang, "summary_page"), min_value=1, max_value=pages, step=1, key="summary_page") if pages > 1 else 1
+    first = (page - 1) * SUMMARY_PAGE_SIZE
+    st.dataframe(
+        rows.iloc[first:first + SUMMARY_PAGE_SIZE], hide_index=True, use_container_width=True,
+        column_config={"Thumbnail": st.column_config.ImageColumn("Thumbnail", width="small")}
+    )
+    st.caption(get_text(lang, "summary_rows_caption").format(
+        first=min(first + 1, len(rows)), last=min(first + SUMMARY_PAGE_SIZE, len(rows)), shown=len(rows), total=len(table)
+    ))
+
+# --- 5. REPORT EXPORT ---
+# kind -> (writer, MIME type, download file name prefix)
+EXPORT_FORMATS = {
+    "pdf": (write_pdf, "application/pdf", "tree_report"),
+    "xlsx": (write_xlsx, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "tree_inventory"),
+}
+
+@st.cache_resource
+def get_export_executor():
+    # Reports are written off the script thread, two at a time for all sessions
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="report-export")
+
+def start_export(kind, results, lang, summary_view):
+    """Writes the batch's report of ``kind`` to a file next to its photos, in the background."""
+    previous = st.session_state.exports.get(kind)
+    if previous and previous["future"].done() and os.path.exists(previous["path"]):
+        os.remove(previous["path"])
+    directory = os.path.join(st.session_state.image_store.root, "exports")
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{uuid.uuid4().hex}.{kind}")
+    st.session_state.exports[kind] = {
+        # The export is offered for download only while it matches the summary shown
+        "key": st.session_state.summary_view_key, "path": path,
+        "future": get_export_executor().submit(
+            EXPORT_FORMATS[kind][0], path, list(results), lang, st.session_state.image_store,
+            summary_view["location_points"], summary_view["origin_points"]
+        ),
+    }
+
+def render_exports(results, summary_view, lang, polling):
+    """Export buttons, a note while a file is being written and its download button when done."""
+    for column, (kind, (_, mime_type, file_prefix)) in zip(st.columns(len(EXPORT_FORMATS)), EXPORT_FORMATS.items()):
+        export = st.session_state.exports.get(kind)
+        if export is not None and export["key"] != st.session_state.summary_view_key:
+            export = None
+        if export is not None and not export["future"].done():
+            column.caption(get_text(lang, "export_running"))
+        elif export is not None and export["future"].exception() is None:
+            with open(export["path"], "rb") as f:
+                column.download_button(
+                    get_text(lang, f"export_download_{kind}"), data=f.read(), mime=mime_type,
+                    file_name=f"{file_prefix}_{time.strftime('%Y%m%d')}.{kind}", key=f"download_{kind}", on_click="ignore"
+                )
+        else:
+            if export is not None:
+                column.error(get_text(lang, "export_failed").format(error=export["future"].exception()))
+            column.button(
+                get_text(lang, f"export_{kind}"), key=f"export_{kind}", on_click=start_export,
+                args=(kind, results, lang, summary_view)
+            )
+    if polling and not any(not export["future"].done() for export in st.session_state.exports.values()):
+        # Stops the polling: the page is rendered again without a refresh interval
+        st.rerun()
+
+# --- 6. BACKGROUND JOBS ---
+# How often the page of a running job refreshes its cards
+JOB_REFRESH_SECONDS = 1.0
+
+def attach_job_store(job_id):
+    """Shows the job's photos: the session's images are the ones stored with the job."""
+    job_root = os.path.join(get_job_queue().jobs_dir, job_id)
+    if st.session_state.image_store.root != job_root:
+        st.session_state.image_store = get_job_queue().image_store(job_id)
+
+def load_job_results(job):
+    """Takes over a finished job's results as the session's batch."""
+    results = [item["payload"] for item in get_job_queue().items(job["id"]) if item["status"] == "done"]
+    st.session_state.batch_results = results
+    st.session_state.batch_usage = {
+        "option": job["options"]["model"], "images": job["total"],
+        "seconds": job["finished_at"] - (job["started_at"] or job["finished_at"]), "models": summarize_usage(results)
+    }
+    st.session_state.job_loaded = job["id"]
+    # Results are shown in other languages by translating them (see get_localized_results)
+    st.session_state.batch_lang = job["options"]["lang"]
+    st.session_state.localized = {}
+
+@st.fragment(run_every=JOB_REFRESH_SECONDS)
+def render_job_progress(job_id, lang, num_columns):
+    """Cards of a running job, refreshed from the queue until the worker finishes it."""
+    queue = get_job_queue()
+    job = queue.job(job_id)
+    if job["status"] in FINISHED_STATUSES:
+        st.rerun()
+    if not worker_running():
+        # Also after a worker crash: the new worker resumes the job without its finished photos
+        start_worker(endpoints=AZURE_ENDPOINTS)
+    st.progress(job["done"] / max(1, job["total"]), text=get_text(lang, "job_progress").format(done=job["done"], total=job["total"]))
+    st.caption(get_text(lang, "job_queued" if job["status"] == "queued" else "job_attach_hint").format(job_id=job_id))
+    st.button(get_text(lang, "job_cancel"), on_click=queue.cancel, args=(job_id,), disabled=job["cancel_requested"])
+
+    grid = st.columns(num_columns)
+    for item in queue.items(job_id):
+        i = item["position"]
+        container = grid[i % num_columns].container(border=True)
+        if item["status"] == "done":
+            display_result_card(container, item["payload"], i, lang)
+            continue
+        if item["status"] == "partial":
+            display_partial_card(container, item["payload"]["analysis"], i, lang)
+        else:
+            container.info(get_text(lang, "spinner_text").format(i=i + 1, n=job["total"]))
+        container.button(
+            get_text(lang, "job_cancel_photo"), key=f"cancel_{job_id}_{i}", on_click=queue.cancel, args=(job_id, i),
+            disabled=item["cancel_requested"]
+        )
+
+# --- 7. TREE INVENTORY ---
+RISK_GRADES = ["LOW", "MEDIUM", "HIGH", "CRITICAL"]
+# "lat, lon" typed into the place field instead of a place name
+COORDINATES_PATTERN = re.compile(r"^\s*(-?\d+(?:\.\d+)?)\s*[,;\s]\s*(-?\d+(?:\.\d+)?)\s*$")
+
+def resolve_place(text):
+    """(lat, lon) of a place name or of typed coordinates, or None."""
+    match = COORDINATES_PATTERN.match(text)
+    if match:
+        lat, lon = float(match.group(1)), float(match.group(2))
+        return (lat, lon) if -90 <= lat <= 90 and -180 <= lon <= 180 else None
+    lat, lon = get_lat_lon(text)
+    return (lat, lon) if lat is not None else None
+
+def get_inventory_thumbnail_url(image_id):
+    inventory = get_inventory()
+    if st.get_option("server.enableStaticServing"):
+        return inventory.images.publish(image_id, "thumbnail", st.get_option("server.baseUrlPath"))
+    return image_to_data_url(inventory.images.path(image_id, "thumbnail"))
+
+@st.fragment
+def render_inventory(lang):
+    """Filters over every tree analyzed so far, the matching trees and their map; reruns without the rest of the page."""
+    from datetime import date, datetime, timedelta
+    inventory = get_inventory()
+    stats = inventory.stats()
+    if not stats["trees"]:
+        st.caption(get_text(lang, "inventory_empty"))
+        return
+    import pandas as pd
+    controls = st.columns(3)
+    health_grades = controls[0].multiselect(get_text(lang, "health_grade"), options=["A", "B", "C", "D", "E", "F"], key="inventory_health")
+    risk_grades = controls[1].multiselect(
+        get_text(lang, "risk_grade"), options=RISK_GRADES, format_func=lambda grade: get_risk_grade_details(grade, lang)["desc"],
+        key="inventory_risk"
+    )
+    species_counts = dict(inventory.species())
+    species = controls[2].multiselect(
+        get_text(lang, "tree_type"), options=list(species_counts), format_func=lambda name: f"{name} ({species_counts[name]})",
+        key="inventory_species"
+    )
+    controls = st.columns(3)
+    place = controls[0].text_input(get_text(lang, "inventory_near"), help=get_text(lang, "inventory_near_help"), key="inventory_near")
+    radius_km = controls[1].number_input(
+        get_text(lang, "inventory_radius"), min_value=0.1, max_value=20000.0, value=2.0, step=0.5, key="inventory_radius"
+    )
+    first_day, last_day = date.fromtimestamp(stats["first"]), date.fromtimestamp(stats["last"])
+    dates = controls[2].date_input(
+        get_text(lang, "inventory_dates"), value=(first_day, last_day), max_value=max(last_day, date.today()), key="inventory_dates"
+    )
+
+    near = None
+    if place.strip():
+        near = resolve_place(place.strip())
+        if near is None:
+            st.warning(get_text(lang, "inventory_near_unknown").format(place=place.strip()))
+            return
+    filters = {
+        "health_grades": health_grades, "risk_grades": risk_grades, "species": species,
+        "near": near, "radius_km": radius_km if near else None,
+        # Until the end of the last selected day; a range still being picked has only its start
+        "since": datetime.combine(dates[0], datetime.min.time()).timestamp() if dates else None,
+        "until": datetime.combine(dates[-1] + timedelta(days=1), datetime.min.time()).timestamp() if dates else None,
+    }
+    with METRICS.timer("inventory_query"):
+        total, rows = inventory.query(**filters)
+        points = inventory.points(**filters)
+    st.caption(get_text(lang, "inventory_matches").format(shown=len(rows), total=total, trees=stats["trees"]))
+    if not rows:
+        return
+    st.dataframe(pd.DataFrame([{
+        "Thumbnail": get_inventory_thumbnail_url(row["image_id"]),
+        get_text(lang, "inventory_analyzed"): datetime.fromtimestamp(row["analyzed_at"]).strftime("%Y-%m-%d"),
+        get_text(lang, "summary_filename"): row["filename"],
+        get_text(lang, "health_grade"): row["health_grade"] or "N/A",
+        get_text(lang, "risk_grade"): get_risk_grade_details(row["risk_grade"], lang)["desc"],
+        get_text(lang, "tree_type"): row["species"] or "N/A",
+        get_text(lang, "location"): row["location"] or "N/A",
+        **({get_text(lang, "inventory_distance"): round(row["distance_km"], 2)} if near else {}),
+    } for row in rows]), hide_index=True, use_container_width=True,
+        column_config={"Thumbnail": st.column_config.ImageColumn("Thumbnail", width="small")})
+    deck = build_map_deck(points, [])
+    if deck:
+        st.pydeck_chart(deck)
+
+# --- 8. MAIN APPLICATION LOGIC ---
 st.set_page_config(page_title="Tree Health Dashboard", layout="wide")
 
 # Initialize session state
@@ -347,16 +777,102 @@ if 'batch_results' not in st.session_state:
     st.session_state.batch_results = []
 if 'chat_histories' not in st.session_state:
     st.session_state.chat_histories = {}
+if 'chat_contexts' not in st.session_state:
+    st.session_state.chat_contexts = {}
+if 'show_diagnostics' not in st.session_state:
+    st.session_state.show_diagnostics = False
+if 'chat_context_budget' not in st.session_state:
+    st.session_state.chat_context_budget = CHAT_CONTEXT_BUDGET
 if 'uploader_key' not in st.session_state:
     st.session_state.uploader_key = 0
 if 'selected_model' not in st.session_state:
     st.session_state.selected_model = "gpt-4.1"
+if 'batch_usage' not in st.session_state:
+    st.session_state.batch_usage = None
+if 'batch_lang' not in st.session_state:
+    # Language the batch was analyzed in; None for batches that are never translated
+    st.session_state.batch_lang = None
+if 'localized' not in st.session_state:
+    st.session_state.localized = {}
+if 'translate_results' not in st.session_state:
+    st.session_state.translate_results = True
+if 'max_concurrency' not in st.session_state:
+    st.session_state.max_concurrency = 4
+if 'pack_size' not in st.session_state:
+    st.session_state.pack_size = 1
+if 'bypass_cache' not in st.session_state:
+    st.session_state.bypass_cache = False
+if 'stream_responses' not in st.session_state:
+    st.session_state.stream_responses = True
+if 'image_short_edge' not in st.session_state:
+    st.session_state.image_short_edge = VISION_SHORT_EDGE
+if 'jpeg_quality' not in st.session_state:
+    st.session_state.jpeg_quality = JPEG_QUALITY
+if 'dedupe_enabled' not in st.session_state:
+    st.session_state.dedupe_enabled = True
+if 'dedupe_threshold' not in st.session_state:
+    st.session_state.dedupe_threshold = DEDUPE_THRESHOLD
+if 'image_store' not in st.session_state:
+    # Removed with the session: ImageStore deletes its directory when garbage collected
+    st.session_state.image_store = ImageStore()
+st.session_state.image_store.touch()
+if 'summary_memo' not in st.session_state:
+    st.session_state.summary_memo = {}
+if 'thumbnail_memo' not in st.session_state:
+    st.session_state.thumbnail_memo = {}
+if 'summary_view_key' not in st.session_state:
+    st.session_state.summary_view_key = None
+if 'job_id' not in st.session_state:
+    # Attaching to a job by its id: the link shown while it runs carries ?job=<id>
+    st.session_state.job_id = st.query_params.get("job")
+if 'job_loaded' not in st.session_state:
+    st.session_state.job_loaded = None
+if 'exports' not in st.session_state:
+    st.session_state.exports = {}
 
 # --- SIDEBAR ---
 lang = st.sidebar.selectbox(get_text("English", "select_lang"), options=["English", "Deutsch", "中文"])
-st.session_state.selected_model = st.sidebar.selectbox(get_text(lang, "select_model"), options=["gpt-4.1", "gpt-4.1-mini"])
+st.session_state.selected_model = st.sidebar.selectbox(
+    get_text(lang, "select_model"), options=["gpt-4.1", "gpt-4.1-mini", CASCADE_MODEL], format_func=lambda model: model_label(model, lang)
+)
+st.session_state.translate_results = st.sidebar.checkbox(
+    get_text(lang, "translate_results"), value=st.session_state.translate_results, help=get_text(lang, "translate_results_help")
+)
+st.session_state.stream_responses = st.sidebar.checkbox(get_text(lang, "stream_responses"), value=st.session_state.stream_responses)
+st.session_state.max_concurrency = st.sidebar.slider(get_text(lang, "max_concurrency"), min_value=1, max_value=16, value=st.session_state.max_concurrency)
+st.session_state.pack_size = st.sidebar.slider(get_text(lang, "pack_size"), min_value=1, max_value=MAX_PACK_SIZE, value=st.session_state.pack_size)
+with st.sidebar.expander(get_text(lang, "preprocess_header")):
+    # The model scales every photo to VISION_SHORT_EDGE on the short side, so only smaller targets change anything
+    st.session_state.image_short_edge = st.slider(
+        get_text(lang, "image_short_edge"), min_value=256, max_value=VISION_SHORT_EDGE, step=64, value=st.session_state.image_short_edge,
+        help=get_text(lang, "image_short_edge_help")
+    )
+    st.session_state.jpeg_quality = st.slider(get_text(lang, "jpeg_quality"), min_value=50, max_value=95, value=st.session_state.jpeg_quality)
+    st.session_state.dedupe_enabled = st.checkbox(get_text(lang, "dedupe_toggle"), value=st.session_state.dedupe_enabled)
+    st.session_state.dedupe_threshold = st.slider(
+        get_text(lang, "dedupe_threshold"), min_value=0, max_value=20, value=st.session_state.dedupe_threshold,
+        disabled=not st.session_state.dedupe_enabled
+    )
+with st.sidebar.expander(get_text(lang, "chat_header")):
+    st.session_state.chat_context_budget = st.number_input(get_text(lang, "chat_context_budget"), min_value=500, max_value=32000, step=250, value=st.session_state.chat_context_budget)
 st.sidebar.button(get_text(lang, "clear_button"), on_click=clear_state, args=(lang,), use_container_width=True)
 
+st.sidebar.markdown("---")
+st.sidebar.subheader(get_text(lang, "cache_header"))
+st.session_state.bypass_cache = st.sidebar.checkbox(get_text(lang, "cache_bypass"), value=st.session_state.bypass_cache)
+st.sidebar.button(get_text(lang, "cache_clear_button"), on_click=get_analysis_cache().clear, use_container_width=True)
+cache_stats = get_analysis_cache().stats()
+# Batches run in the job worker, which counts its lookups in its own AnalysisCache
+worker_cache = (get_job_queue().worker_stats() or {}).get("cache", {})
+st.sidebar.caption(get_text(lang, "cache_stats").format(
+    hits=cache_stats["hits"] + worker_cache.get("hits", 0), misses=cache_stats["misses"] + worker_cache.get("misses", 0),
+    entries=cache_stats["entries"], size_mb=cache_stats["bytes"] / (1024 * 1024)
+))
+
+st.session_state.show_diagnostics = st.sidebar.checkbox(get_text(lang, "diagnostics_toggle"), value=st.session_state.show_diagnostics)
+# Filled at the end of the run so the panel includes this run's batch
+diagnostics_slot = st.sidebar.empty()
+
 st.sidebar.markdown("---")
 st.sidebar.subheader(get_text(lang, "legend_header"))
 for grade in ["A", "B", "C", "D", "E", "F"]:
@@ -385,200 +901,90 @@ uploaded_files = st.file_uploader(
     key=f"file_uploader_{st.session_state.uploader_key}"
 )
 
+num_columns = 3
 if uploaded_files and st.button(get_text(lang, "analyze_button")):
     st.session_state.batch_results = []
     st.session_state.chat_histories = {}
-    
-    num_columns = 3
+    st.session_state.chat_contexts = {}
+    st.session_state.batch_usage = None
+    # The batch runs as a background job, so closing the tab or a rerun does not lose it
+    st.session_state.job_id = get_job_queue().submit([(uploaded_file.name, uploaded_file.getvalue()) for uploaded_file in uploaded_files], {
+        "lang": lang, "model": st.session_state.selected_model, "max_concurrency": st.session_state.max_concurrency,
+        "use_cached": not st.session_state.bypass_cache,
+        "preprocess_options": {"short_edge": st.session_state.image_short_edge, "quality": st.session_state.jpeg_quality},
+        "stream": st.session_state.stream_responses,
+        "dedupe_threshold": st.session_state.dedupe_threshold if st.session_state.dedupe_enabled else None,
+        "pack_size": st.session_state.pack_size,
+    })
+    st.session_state.job_loaded = None
+    st.query_params["job"] = st.session_state.job_id
+    start_worker(endpoints=AZURE_ENDPOINTS)
+
+job = get_job_queue().job(st.session_state.job_id) if st.session_state.job_id else None
+if st.session_state.job_id and job is None:
+    st.warning(get_text(lang, "job_not_found").format(job_id=st.session_state.job_id))
+    st.session_state.job_id = None
+    st.query_params.pop("job", None)
+elif job:
+    attach_job_store(job["id"])
+    if job["status"] not in FINISHED_STATUSES:
+        render_job_progress(job["id"], lang, num_columns)
+    elif st.session_state.job_loaded != job["id"]:
+        load_job_results(job)
+    if job["status"] == "failed":
+        st.error(get_text(lang, "job_failed").format(error=job["error"]))
+job_running = job is not None and job["status"] not in FINISHED_STATUSES
+
+results = st.session_state.batch_results
+if results and not job_running and st.session_state.translate_results and st.session_state.batch_lang not in (None, lang):
+    results = get_localized_results(lang)
+    untranslated = sum(1 for result in results if result.get("localize_error"))
+    if untranslated:
+        st.warning(get_text(lang, "translation_failed").format(count=untranslated))
+        st.button(get_text(lang, "translation_retry"), on_click=retry_translation, args=(lang,))
+
+if results and not job_running:
+    # Re-render existing cards on reruns (e.g. a follow-up chat message) from session state
     grid = st.columns(num_columns)
-    
-    for i, uploaded_file in enumerate(uploaded_files):
-        placeholder = grid[i % num_columns].container(border=True)
-        
-        with placeholder:
-            with st.spinner(get_text(lang, "spinner_text").format(i=i+1, n=len(uploaded_files))):
-                img_bytes = uploaded_file.getvalue()
-                base64_image = encode_image(img_bytes)
-                
-                system_prompt = """
-                You are a professional botanist, tree pathologist, certified arborist, tree risk assessor, and experienced forestry worker.
-                Analyze the user-submitted tree image for two separate goals:
-                1)  **Clear Health Assessment** and 2) **Comprehensive Risk Assessment**.
-
-                ### **Health Assessment**
-
-                Please check specifically for the following indicators, but do not limit your analysis to them:
-
-                * **Deadwood and loose branches** → risk of falling branches
-                * **Fungal fruiting bodies** → signs of white rot, brown rot, or soft rot
-                * **Diseased or weak fork (branch junction)** → increased risk of breakage
-                * **Loose or peeling bark** → possible internal stem decay
-                * **Cavities or broken branches** → structural instability
-
-                If none of these indicators are present, state that the tree appears healthy. If no tree is detected in the image, skip the analysis and return exactly: `No tree`.
-
-                -----
-
-                ### **Risk Assessment**
-
-                Drawing on your expertise as a forestry worker, evaluate the following critical risk factors:
-
-                * **Infection Potential:** Determine if any detected disease is infectious (e.g., fungus, beetle infestation) and assess if immediate removal is necessary to protect neighboring trees.
-                * **Trunk Stability:** Analyze if the trunk or rootstock is weakened by rot, pest infestation, or soil erosion, and evaluate the probability of a spontaneous collapse.
-                * **Consequences of Failure:** Identify any potential threats to people, animals, or buildings. Assess whether adjacent trees could be brought down in a domino effect.
-                * **Felling Technique:** If a high hazard exists, determine if a controlled method like rope-assisted or sectional felling is required and specify the necessary safety parameters.
-
-                ### **Output Format**
-                Your response MUST be a single, complete JSON object. Do not add any text outside of this object.
-
-                The JSON structure is:
-                { "tree_type": "The common name and scientific name of the tree species, if identifiable.",
-                  "approximate_age": "An estimated age of the tree in years (e.g., '10-15 years', 'Mature').",
-                  "location": "The likely city and country where the photo was taken (e.g., 'Bonn, Germany'). If unknown, state 'Unknown'.",
-                  "native_origins": "A list of up to three primary native countries or regions for this tree species. Example: ['Japan', 'Korea', 'China']. If the species is a hybrid or its origin is unknown, provide an empty list [].",
-                  "health_status": "A brief summary (e.g., 'Healthy', 'Showing signs of stress', 'Diseased').",
-                  "health_grade": "A single letter grade from A to F (A=Excellent, B=Good, C=Fair, D=Poor, E=Critical, F=Dead).",
-                  "is_diseased": true or false,
-                  "disease_identification": "If is_diseased is true, name the potential disease(s) or pest(s). Otherwise, 'None'.",
-                  "detailed_observations": "A paragraph describing what you see in the image (leaf color, bark condition, trunk damage, fungal bodies, structural issues like weak forks or cavities).",
-                  "rehabilitation_advice": "If is_diseased is true or health_grade is C or lower, provide a detailed, actionable rehabilitation plan. Otherwise, provide simple maintenance tips.",
-                  "risk_assessment": {
-                    "infection_and_hazard_potential_grade": "A final comprehensive risk grade (Low, Medium, High, or Critical) based on the factors below.",
-                    "infectious_risk_summary": "Summarize contagion risk, including whether removal is needed to protect adjacent trees (e.g., 'High risk of spreading oak wilt to adjacent trees, immediate removal recommended').",
-                    "structural_stability_summary": "Summarize structural risks, considering rootstock and trunk integrity, and the likelihood of collapse (e.g., 'Medium risk of spontaneous collapse due to deep trunk cavity').",
-                    "consequence_of_failure_summary": "Summarize the threat to targets and potential for a domino effect (e.g., 'Critical threat to a nearby house and power line; high risk of domino effect on two smaller trees')."
-                  },
-                  "felling_recommendations": {
-                    "recommended_method": "IMPORTANT: If health_grade is 'A' or 'B' AND risk_assessment.infection_and_hazard_potential_grade is 'Low', set this to the exact phrase: '" + get_text(lang, "felling_preservation_method") + "'. Otherwise, recommend a suitable felling method (e.g., 'Standard Felling', 'Controlled Sectional Felling').",
-                    "safety_parameters": "If the recommended_method is the preservation phrase, this entire object should be omitted from the JSON. Otherwise, provide the following details.",
-                    "minimum_safety_distance_meters": "Required minimum safety distance in meters. 'N/A' if not applicable.",
-                    "required_personnel": "Number of personnel and their roles. 'N/A' if not applicable.",
-                    "required_equipment": "List of essential technical equipment. 'N/A' if not applicable."
-                  }
-                }
-               
-                """
-                result_text = ""
-                try:
-                    response = client.chat.completions.create(
-                        model=st.session_state.selected_model,
-                        messages=[
-                            {"role": "system", "content": system_prompt},
-                            {"role": "user", "content": [{"type": "text", "text": f"Analyze this tree. Respond in {lang}."}, {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}]}
-                        ],
-                        max_completion_tokens=1500, temperature=0.5
-                    )
-                    result_text = response.choices[0].message.content
-                    if result_text:
-                        analysis_data = json.loads(result_text)
-                    else:
-                        analysis_data = None
-                        print("No response from model.")
-                    result_payload = {"image": img_bytes, "analysis": analysis_data, "error": None, "raw_text": None, "filename": uploaded_file.name}
-                except Exception as e:
-                    error_text = getattr(e, 'message', str(e))
-                    raw_output = result_text if result_text else "No response from model."
-                    result_payload = {"image": img_bytes, "analysis": None, "error": error_text, "raw_text": raw_output, "filename": uploaded_file.name}
-                
-                st.session_state.batch_results.append(result_payload)
-        
-        # After spinner is done, display the final card in the same placeholder
-        display_result_card(placeholder, result_payload, i, lang)
+    for i, result_payload in enumerate(results):
+        display_result_card(grid[i % num_columns].container(border=True), result_payload, i, lang)
 
-if st.session_state.batch_results:
+if results and not job_running:
     st.write("---")
     st.subheader(get_text(lang, "summary_table_header"))
-    
-    summary_data = []
-    location_points = []
-    origin_points = []
-    failed_locations = []
+    if st.session_state.batch_usage:
+        st.caption(format_batch_usage(st.session_state.batch_usage, lang))
 
-    for idx, result in enumerate(st.session_state.batch_results):
-        if result["analysis"]:
-            res = result["analysis"]
-            
-            # Process photographed location
-            loc_str = res.get('location', 'N/A')
-            lat, lon = get_lat_lon(loc_str)
-            if lat and lon:
-                location_points.append({
-                    "lat": lat, "lon": lon, 
-                    #"tooltip": f"<b>Photographed Location</b><br>{loc_str}",
-                    "tooltip": f"<b>Photographed Location</b><br>File: {result.get('filename', 'N/A')}<br>Species: {res.get('tree_type', 'N/A')}<br>Photographed Location: {loc_str}",
-                    "location_text": loc_str
-                })
-            elif loc_str.lower() not in ['n/a', 'unknown']:
-                failed_locations.append(loc_str)
-
-            # Process native origins
-            native_origins = res.get('native_origins', [])
-            for origin_loc in native_origins:
-                origin_lat, origin_lon = get_lat_lon(origin_loc)
-                if origin_lat and origin_lon:
-                    origin_points.append({
-                        "lat": origin_lat, "lon": origin_lon,
-                        #"tooltip": f"<b>Native Origin: {res.get('tree_type')}</b><br>{origin_loc}"
-                        #"tooltip": f"<b>Location Info</b><br>File: {result.get('filename', 'N/A')}<br>Species: {res.get('tree_type', 'N/A')}<br>Location: {origin_loc}"
-                        "tooltip": f"<b>Native Origin</b><br>File: {result.get('filename', 'N/A')}<br>Species: {res.get('tree_type', 'N/A')}<br>Location: {origin_loc}"
-                    })
-
-            summary_data.append({
-                get_text(lang, "summary_filename"): result.get("filename", "N/A"),
-                "Thumbnail": image_to_html_thumbnail(result['image']),
-                get_text(lang, "health_grade"): res.get('health_grade', 'N/A'),
-                get_text(lang, "risk_grade"): res.get('risk_assessment', {}).get('infection_and_hazard_potential_grade', 'N/A'),
-                get_text(lang, "tree_type"): res.get('tree_type', 'N/A'),
-                get_text(lang, "location"): loc_str,
-                get_text(lang, "native_origins"): ', '.join(native_origins) or 'N/A',
-            })
-        else:
-             summary_data.append({
-                get_text(lang, "summary_filename"): result.get("filename", "N/A"), 
-                "Thumbnail": image_to_html_thumbnail(result['image']), 
-                get_text(lang, "health_grade"): "Error", 
-                get_text(lang, "risk_grade"): "Error",
-                get_text(lang, "tree_type"): "Error", 
-                get_text(lang, "location"): "Error",
-                get_text(lang, "native_origins"): "Error"
-            })
-
-    if summary_data:
-        df = pd.DataFrame(summary_data)
-        st.markdown(df.to_html(escape=False, index=False), unsafe_allow_html=True)
+    summary_view = get_summary_view(results, lang)
+    if summary_view["table"] is not None:
+        render_summary_table(summary_view["table"], lang)
 
     st.subheader(get_text(lang, "map_header"))
-    map_layers = []
-    if location_points:
-        loc_df = pd.DataFrame(location_points)
-        map_layers.append(pdk.Layer(
-            'ScatterplotLayer', data=loc_df, get_position='[lon, lat]',
-            get_color='[200, 30, 0, 160]', get_radius=50000, pickable=True
-        ))
-        map_layers.append(pdk.Layer(
-            'TextLayer', data=loc_df, get_position='[lon, lat]', get_text='location_text',
-            get_size=15, get_color='[255, 255, 255, 200]', get_angle=0,
-            get_text_anchor='"middle"', get_alignment_baseline='"bottom"'
-        ))
-
-    if origin_points:
-        origin_df = pd.DataFrame(origin_points)
-        map_layers.append(pdk.Layer(
-            'ScatterplotLayer', data=origin_df, get_position='[lon, lat]',
-            get_color='[30, 200, 0, 160]', get_radius=30000, pickable=True # Green, smaller radius
-        ))
-
-    if map_layers:
-        initial_view_state = pdk.ViewState(latitude=30, longitude=0, zoom=1, pitch=0)
-        st.pydeck_chart(pdk.Deck(
-            map_style='https://basemaps.cartocdn.com/gl/voyager-gl-style/style.json',
-            initial_view_state=initial_view_state,
-            layers=map_layers,
-            tooltip={"html": "{tooltip}", "style": {"color": "white"}}
-        ))
+    if summary_view["deck"]:
+        st.pydeck_chart(summary_view["deck"])
     
-    if failed_locations:
+    if summary_view["failed_locations"]:
         st.warning(get_text(lang, "map_fail_header"))
-        st.info(f"{get_text(lang, 'map_fail_info')} {', '.join(set(failed_locations))}")
-    elif not map_layers:
+        st.info(f"{get_text(lang, 'map_fail_info')} {', '.join(summary_view['failed_locations'])}")
+    elif not summary_view["deck"]:
          st.info("No valid location data was found in the analysis results to display on the map.")
+
+    st.subheader(get_text(lang, "export_header"))
+    exporting = any(not export["future"].done() for export in st.session_state.exports.values())
+    st.fragment(render_exports, run_every=JOB_REFRESH_SECONDS if exporting else None)(results, summary_view, lang, exporting)
+
+st.write("---")
+st.subheader(get_text(lang, "inventory_header"))
+render_inventory(lang)
+
+# Startup report: module imports are only slow on the first run in a process; first paint is
+# the session's first complete run, i.e. until the whole page has been sent to the browser
+METRICS.observe("script_imports", IMPORT_SECONDS)
+run_seconds = time.perf_counter() - SCRIPT_START
+METRICS.observe("script_run", run_seconds)
+if 'first_paint_seconds' not in st.session_state:
+    st.session_state.first_paint_seconds = run_seconds
+    METRICS.observe("first_paint", run_seconds)
+
+if st.session_state.show_diagnostics:
+    render_diagnostics(diagnostics_slot.container(), lang)
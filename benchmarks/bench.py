@@ -0,0 +1,480 @@
+"""Load and benchmark scenarios for the analysis pipeline and the summary page.
+
+    python benchmarks/bench.py                           # all scenarios
+    python benchmarks/bench.py baseline streaming --quick
+    python benchmarks/bench.py --output after.json --compare before.json
+
+Every scenario runs against benchmarks/mock_services.py (no Azure or public Nominatim
+traffic) in a fresh process, so peak RSS is per scenario. Synthetic images, mock
+latencies and fault injection are seeded; results are written as JSON together with
+the git commit, and --compare prints the relative change against an earlier run.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+SCENARIOS = {
+    "baseline": {"kind": "pipeline", "images": 24, "size": (1600, 1200), "concurrency": 4},
+    "phone-photos": {"kind": "pipeline", "images": 24, "size": (4032, 3024), "concurrency": 8},
+    "large-batch": {"kind": "pipeline", "images": 200, "size": (1280, 960), "concurrency": 16, "latency_ms": 400},
+    "rate-limited": {"kind": "pipeline", "images": 48, "size": (1280, 960), "concurrency": 16,
+                     "max_in_flight": 6, "rate_limit_rate": 0.05, "error_rate": 0.02},
+    "streaming": {"kind": "pipeline", "images": 24, "size": (1600, 1200), "concurrency": 8, "stream": True},
+    "packed": {"kind": "pipeline", "images": 24, "size": (1600, 1200), "concurrency": 4, "pack_size": 4},
+    "bursts": {"kind": "pipeline", "images": 24, "size": (1600, 1200), "concurrency": 4, "burst": 4, "dedupe": True},
+    "cascade": {"kind": "pipeline", "images": 24, "size": (1600, 1200), "concurrency": 4, "model": "cascade"},
+    "malformed": {"kind": "pipeline", "images": 24, "size": (1600, 1200), "concurrency": 4, "malformed_rate": 0.2, "truncate_rate": 0.2},
+    "summary": {"kind": "summary", "images": 150, "size": (1024, 768)},
+    "map": {"kind": "map", "images": 0, "size": (0, 0), "trees": 5000, "places": 1500},
+    "export": {"kind": "export", "images": 1000, "size": (800, 600)},
+    "translate": {"kind": "translate", "images": 0, "size": (0, 0), "trees": 100},
+    "inventory": {"kind": "inventory", "images": 1, "size": (800, 600), "trees": 50000, "places": 2000},
+    "startup": {"kind": "startup", "images": 0, "size": (0, 0)},
+}
+# Imported lazily by the dashboard; a bare page should load none of them
+HEAVY_MODULES = ("openai", "pandas", "pydeck", "geopy")
+MOCK_OPTIONS = ["latency_ms", "jitter_ms", "error_rate", "rate_limit_rate", "max_in_flight", "retry_after_ms", "geocode_latency_ms",
+                "malformed_rate", "truncate_rate"]
+# Metrics where a smaller value is better, for the --compare report
+LOWER_IS_BETTER = ("seconds", "_s", "rss", "bytes", "requests", "errors", "retries", "rate_limited", "tokens")
+
+def percentiles(samples, points=(50, 95, 99)):
+    ordered = sorted(samples)
+    if not ordered:
+        return {f"p{point}": None for point in points}
+    return {f"p{point}": ordered[min(len(ordered) - 1, int(point / 100 * len(ordered)))] for point in points}
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(who).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def generate_images(directory, count, size, seed=0, burst=1):
+    """Writes ``count`` seeded photo-like JPEGs of ``size``; reuses them if already there.
+
+    With ``burst`` > 1, each run of that many images are slightly shifted and re-exposed
+    frames of one scene, like the burst shots field crews take of a tree.
+    """
+    from PIL import Image, ImageEnhance, ImageFilter
+
+    os.makedirs(directory, exist_ok=True)
+    existing = sorted(name for name in os.listdir(directory) if name.endswith(".jpg"))
+    if len(existing) >= count:
+        return [os.path.join(directory, name) for name in existing[:count]]
+    rng = random.Random(seed)
+    paths = []
+    margin = size[0] // 200 if burst > 1 else 0
+    scene_size = (size[0] + 2 * margin, size[1] + 2 * margin)
+    for i in range(count):
+        if i % burst == 0:
+            # Blurred noise over a gradient compresses roughly like foliage photos, unlike flat colours
+            # (coarser in burst scenes, whose large crown/sky-like patches keep frames perceptually alike)
+            grain = 8 if burst == 1 else 96
+            noise = Image.effect_noise((scene_size[0] // grain, scene_size[1] // grain), 60).resize(scene_size).filter(ImageFilter.GaussianBlur(2))
+            tint = Image.new("RGB", scene_size, (rng.randint(40, 120), rng.randint(90, 170), rng.randint(30, 90)))
+            scene = Image.blend(tint, Image.merge("RGB", [noise] * 3), 0.45)
+        image = scene
+        if burst > 1:
+            left, top = rng.randint(0, 2 * margin), rng.randint(0, 2 * margin)
+            image = ImageEnhance.Brightness(scene.crop((left, top, left + size[0], top + size[1]))).enhance(rng.uniform(0.95, 1.05))
+        path = os.path.join(directory, f"tree_{i:04d}.jpg")
+        image.save(path, quality=92)
+        paths.append(path)
+    return paths
+
+def generate_images_isolated(directory, count, size, seed=0, burst=1):
+    """Runs generate_images in a separate process and returns the image paths.
+
+    Linux carries a process's peak RSS over fork+exec into its children, so decoding and
+    encoding multi-megapixel images here would inflate every later scenario's peak_rss_mb.
+    """
+    spec = json.dumps({"directory": directory, "count": count, "size": list(size), "seed": seed, "burst": burst})
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--generate", spec], capture_output=True, text=True, check=True).stdout
+    return json.loads(output)
+
+def run_pipeline_scenario(config, mock_url, image_paths):
+    from openai import AzureOpenAI
+    from image_preprocessing import create_preprocess_pool, DEDUPE_THRESHOLD
+    from image_store import ImageStore
+    from metrics import METRICS
+    from tree_pipeline import run_batch_analysis
+
+    client = AzureOpenAI(azure_endpoint=mock_url, api_key="bench", api_version="2024-10-21", max_retries=0)
+    store = ImageStore()
+    preprocess_pool = create_preprocess_pool()
+    outcomes = {"ok": 0, "error": 0}
+    finish_times = []
+    start = time.perf_counter()
+    images = []
+    for path in image_paths:
+        with open(path, "rb") as f:
+            images.append((os.path.basename(path), store.put(f.read())))
+    cancel_events = [threading.Event() for _ in images]
+    batch = run_batch_analysis(
+        client, images, store, "English", config.get("model", "gpt-4.1"), config["concurrency"], cancel_events,
+        preprocess_pool=preprocess_pool, stream=config.get("stream", False),
+        dedupe_threshold=DEDUPE_THRESHOLD if config.get("dedupe") else None, pack_size=config.get("pack_size", 1)
+    )
+    for _, payload in batch:
+        if payload.get("partial"):
+            continue
+        finish_times.append(time.perf_counter() - start)
+        outcomes["ok" if payload["analysis"] else "error"] += 1
+    elapsed = time.perf_counter() - start
+    if preprocess_pool is not None:
+        preprocess_pool.shutdown()
+    store.close()
+
+    stages = METRICS.snapshot()["stages"]
+    result = {
+        "wall_seconds": round(elapsed, 3),
+        "images_per_second": round(len(images) / elapsed, 3),
+        "ok": outcomes["ok"],
+        "errors": outcomes["error"],
+        "retries": METRICS.counter("retries_total"),
+        "duplicates": METRICS.counter("images_total", result="duplicate"),
+        "prompt_tokens": METRICS.counter("tokens_total", kind="prompt"),
+        "completion_tokens": METRICS.counter("tokens_total", kind="completion"),
+        "large_model_images": METRICS.counter("analysis_images_total", model="gpt-4.1"),
+        "escalations": METRICS.counter("cascade_escalations_total"),
+        "repaired_replies": METRICS.counter("reply_repairs_total", kind="extracted"),
+        "continuations": METRICS.counter("reply_repairs_total", kind="continuation"),
+        "prompt_tokens_per_image": round(METRICS.counter("analysis_prompt_tokens_total") / max(1, METRICS.counter("analysis_images_total")), 1),
+        "peak_rss_mb": peak_rss_mb(),
+        "peak_rss_workers_mb": peak_rss_mb(resource.RUSAGE_CHILDREN),
+    }
+    result.update({f"time_to_result_{key}_s": round(value, 3) for key, value in percentiles(finish_times).items()})
+    for stage in ("preprocess", "model_request"):
+        data = stages.get(stage)
+        result[f"{stage}_p50_s"] = round(data["p50_seconds"], 4) if data else None
+        result[f"{stage}_p95_s"] = round(data["p95_seconds"], 4) if data else None
+    return result
+
+def run_summary_scenario(config, mock_url, image_paths):
+    """Renders the dashboard with ``images`` finished results: cold (geocoding), warm, and after a language switch."""
+    import uuid
+    from streamlit.testing.v1 import AppTest
+    from image_store import ImageStore
+    from mock_services import canned_analysis
+
+    store = ImageStore()
+    rng = random.Random(0)
+    results = []
+    for path in image_paths:
+        with open(path, "rb") as f:
+            image_id = store.put(f.read())
+        store.prepare_derivatives(image_id)
+        results.append({"id": uuid.uuid4().hex, "image_id": image_id, "analysis": json.loads(canned_analysis(rng)),
+                        "error": None, "raw_text": None, "filename": os.path.basename(path)})
+
+    app = AppTest.from_file(os.path.join(REPO_DIR, "app_tree_analysis.py"), default_timeout=600)
+    app.secrets["auth_endpoint"] = mock_url
+    app.secrets["auth_key"] = "bench"
+    app.secrets["auth_version"] = "2024-10-21"
+    app.session_state["batch_results"] = results
+    app.session_state["image_store"] = store
+    timings = {}
+    for label, action in (("cold", None), ("warm", None), ("relocalize", "Deutsch")):
+        if action:
+            app.sidebar.selectbox[0].select(action)
+        start = time.perf_counter()
+        app.run()
+        timings[f"render_{label}_seconds"] = round(time.perf_counter() - start, 3)
+        if app.exception:
+            raise RuntimeError(f"{label} render failed: {app.exception[0].value}")
+    # What the browser receives for the summary table, thumbnails included
+    table_bytes = sum(table.proto.ByteSize() for table in app.dataframe)
+    store.close()
+    return dict(timings, table_bytes=table_bytes, peak_rss_mb=peak_rss_mb())
+
+def run_map_scenario(config, mock_url, image_paths):
+    """Builds the summary map for a citywide inventory: ``trees`` points over ``places`` distinct coordinates."""
+    from map_view import build_map_deck
+
+    rng = random.Random(0)
+    places = [(f"Street {k}, Bonn, Germany", 50.73 + rng.uniform(-0.08, 0.08), 7.1 + rng.uniform(-0.12, 0.12)) for k in range(config["places"])]
+    origins = [("Europe", 50.0, 10.0), ("Japan", 36.2, 138.3), ("Eastern North America", 40.0, -78.0), ("China", 35.9, 104.2)]
+    location_points, origin_points = [], []
+    for k in range(config["trees"]):
+        place, lat, lon = rng.choice(places)
+        location_points.append({"lat": lat, "lon": lon, "place": place, "filename": f"tree_{k:05d}.jpg", "species": "Silver Birch (Betula pendula)"})
+        origin, lat, lon = rng.choice(origins)
+        origin_points.append({"lat": lat, "lon": lon, "place": origin, "filename": f"tree_{k:05d}.jpg", "species": "Silver Birch (Betula pendula)"})
+    start = time.perf_counter()
+    deck = build_map_deck(location_points, origin_points)
+    build_seconds = time.perf_counter() - start
+    payload = deck.to_json()
+    layers = json.loads(payload)["layers"]
+    return {
+        "build_seconds": round(build_seconds, 3),
+        "payload_bytes": len(payload.encode("utf-8")),
+        "drawn_points": sum(len(layer["data"]) for layer in layers if layer["@@type"] == "ScatterplotLayer"),
+        "labels": sum(len(layer["data"]) for layer in layers if layer["@@type"] == "TextLayer"),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def run_export_scenario(config, mock_url, image_paths):
+    """Writes the XLSX inventory and the PDF report of ``images`` finished results, each in turn."""
+    from image_store import ImageStore
+    from mock_services import canned_analysis
+    from report_export import write_pdf, write_xlsx
+
+    store = ImageStore()
+    rng = random.Random(0)
+    results, location_points = [], []
+    for path in image_paths:
+        with open(path, "rb") as f:
+            image_id = store.put(f.read())
+        store.path(image_id, "thumbnail")
+        results.append({"id": image_id, "image_id": image_id, "analysis": json.loads(canned_analysis(rng)),
+                        "error": None, "raw_text": None, "filename": os.path.basename(path), "model": "gpt-4.1"})
+        location_points.append({"lat": 50.73 + rng.uniform(-0.08, 0.08), "lon": 7.1 + rng.uniform(-0.12, 0.12), "place": "Bonn, Germany",
+                                "filename": os.path.basename(path), "species": "Silver Birch (Betula pendula)"})
+    result = {"setup_rss_mb": peak_rss_mb()}
+    for kind, writer in (("xlsx", write_xlsx), ("pdf", write_pdf)):
+        path = os.path.join(store.root, f"report.{kind}")
+        start = time.perf_counter()
+        writer(path, results, "English", store, location_points)
+        result[f"{kind}_seconds"] = round(time.perf_counter() - start, 3)
+        result[f"{kind}_bytes"] = os.path.getsize(path)
+    store.close()
+    return dict(result, peak_rss_mb=peak_rss_mb())
+
+def run_translate_scenario(config, mock_url, image_paths):
+    """Re-localizes ``trees`` finished English results into German: first switch, then again from the cache."""
+    import uuid
+    from openai import AzureOpenAI
+    from metrics import METRICS
+    from mock_services import canned_analysis
+    from translations import get_text
+    from tree_pipeline import AnalysisCache, CACHE_DIR, localize_results
+
+    client = AzureOpenAI(azure_endpoint=mock_url, api_key="bench", api_version="2024-10-21", max_retries=0)
+    cache = AnalysisCache(os.path.join(CACHE_DIR, "analysis_cache.sqlite3"))
+    rng = random.Random(0)
+    results = []
+    for k in range(config["trees"]):
+        analysis = json.loads(canned_analysis(rng))
+        if analysis["health_grade"] in "AB" and analysis["risk_assessment"]["infection_and_hazard_potential_grade"] == "Low":
+            analysis["felling_recommendations"] = {"recommended_method": get_text("English", "felling_preservation_method"), "safety_parameters": None}
+        results.append({"id": uuid.uuid4().hex, "image_id": f"{k:064x}", "analysis": analysis, "error": None, "filename": f"tree_{k:03d}.jpg", "model": "gpt-4.1"})
+    result = {}
+    for label in ("cold", "cached"):
+        start = time.perf_counter()
+        localized = dict(localize_results(client, results, "Deutsch", cache=cache))
+        result[f"{label}_seconds"] = round(time.perf_counter() - start, 3)
+    for i, payload in localized.items():
+        source, analysis = results[i]["analysis"], payload["analysis"]
+        assert analysis["health_grade"] == source["health_grade"] and analysis["risk_assessment"]["infection_and_hazard_potential_grade"] == source["risk_assessment"]["infection_and_hazard_potential_grade"]
+        if source["felling_recommendations"]["safety_parameters"] is None:
+            assert analysis["felling_recommendations"]["recommended_method"] == get_text("Deutsch", "felling_preservation_method")
+    return dict(
+        result, failed=sum(1 for payload in localized.values() if payload.get("localize_error")),
+        prompt_tokens=METRICS.counter("tokens_total", kind="prompt"), completion_tokens=METRICS.counter("tokens_total", kind="completion"),
+        peak_rss_mb=peak_rss_mb(),
+    )
+
+def run_inventory_scenario(config, mock_url, image_paths):
+    """Fills the tree inventory with ``trees`` analyses over a year and times typical queries, map points included."""
+    import uuid
+    from image_store import ImageStore
+    from inventory import TreeInventory
+    from mock_services import canned_analysis
+
+    store = ImageStore()
+    with open(image_paths[0], "rb") as f:
+        image_id = store.put(f.read())
+    inventory = TreeInventory(os.path.join(store.root, "inventory"))
+    rng = random.Random(0)
+    places = {f"Street {k}, Bonn, Germany": (50.73 + rng.uniform(-0.08, 0.08), 7.1 + rng.uniform(-0.12, 0.12)) for k in range(config["places"])}
+    now = time.time()
+    start = time.perf_counter()
+    for job in range(0, config["trees"], 1000):
+        results = []
+        for k in range(job, min(job + 1000, config["trees"])):
+            analysis = json.loads(canned_analysis(rng))
+            analysis["location"] = rng.choice(list(places))
+            results.append({"id": uuid.uuid4().hex, "image_id": image_id, "analysis": analysis, "filename": f"tree_{k:05d}.jpg", "model": "gpt-4.1"})
+        inventory.add(results, places, store, "English", job_id=str(job), analyzed_at=now - rng.uniform(0, 365 * 24 * 3600))
+    result = {"insert_seconds": round(time.perf_counter() - start, 3), "db_bytes": os.path.getsize(inventory.path)}
+    queries = {
+        "all": {},
+        "high_risk": {"risk_grades": ["HIGH", "CRITICAL"]},
+        "high_risk_2km_6months": {"risk_grades": ["HIGH", "CRITICAL"], "near": (50.73, 7.1), "radius_km": 2, "since": now - 182 * 24 * 3600},
+        "species_grade": {"species": [inventory.species()[0][0]], "health_grades": ["D", "E", "F"]},
+    }
+    for name, filters in queries.items():
+        start = time.perf_counter()
+        total, _ = inventory.query(**filters)
+        points = inventory.points(**filters)
+        result[f"query_{name}_seconds"] = round(time.perf_counter() - start, 4)
+        result[f"query_{name}_matches"] = total
+        assert len(points) == total
+    store.close()
+    return dict(result, peak_rss_mb=peak_rss_mb())
+
+def run_startup_scenario(config, mock_url, image_paths):
+    """Cold import cost of each dependency (fresh interpreters) and the first and repeat run of a bare page."""
+    from streamlit.testing.v1 import AppTest
+
+    result = {}
+    for module in HEAVY_MODULES + ("streamlit", "tree_pipeline"):
+        timer = f"import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+        output = subprocess.run([sys.executable, "-c", timer], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout
+        result[f"import_{module}_seconds"] = round(float(output.strip().splitlines()[-1]), 3)
+
+    app = AppTest.from_file(os.path.join(REPO_DIR, "app_tree_analysis.py"), default_timeout=600)
+    app.secrets["auth_endpoint"] = mock_url
+    app.secrets["auth_key"] = "bench"
+    app.secrets["auth_version"] = "2024-10-21"
+    for label in ("first_run", "rerun"):
+        start = time.perf_counter()
+        app.run()
+        result[f"{label}_seconds"] = round(time.perf_counter() - start, 3)
+        if app.exception:
+            raise RuntimeError(f"{label} failed: {app.exception[0].value}")
+    result["heavy_modules_loaded"] = sum(module in sys.modules for module in HEAVY_MODULES)
+    return dict(result, peak_rss_mb=peak_rss_mb())
+
+def run_child(args):
+    """Entry point of the per-scenario process; prints the result as JSON."""
+    config = json.loads(args.config)
+    sys.path.insert(0, BENCH_DIR)
+    runner = {"pipeline": run_pipeline_scenario, "summary": run_summary_scenario, "map": run_map_scenario, "export": run_export_scenario,
+              "translate": run_translate_scenario, "inventory": run_inventory_scenario, "startup": run_startup_scenario}[config["kind"]]
+    print(json.dumps(runner(config, args.mock_url, args.images or [])))
+
+def start_mock(config, seed):
+    command = [sys.executable, os.path.join(BENCH_DIR, "mock_services.py"), "--port", "0", "--seed", str(seed)]
+    for option in MOCK_OPTIONS:
+        if option in config:
+            command += [f"--{option.replace('_', '-')}", str(config[option])]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    url = process.stdout.readline().strip().rsplit(" ", 1)[-1]
+    return process, url
+
+def mock_stats(url):
+    with urllib.request.urlopen(f"{url}/_stats") as response:
+        return json.load(response)
+
+def run_scenario(name, config, workdir, seed):
+    burst = config.get("burst", 1)
+    image_dir = os.path.join(workdir, f"{config['size'][0]}x{config['size'][1]}" + (f"-burst{burst}" if burst > 1 else ""))
+    image_paths = generate_images_isolated(image_dir, config["images"], config["size"], seed, burst) if config["images"] else []
+    mock, url = start_mock(config, seed)
+    try:
+        env = dict(
+            os.environ, TREE_CACHE_DIR=tempfile.mkdtemp(dir=workdir), TREE_IMAGE_STORE_DIR=tempfile.mkdtemp(dir=workdir),
+            TREE_NOMINATIM_DOMAIN=url.split("://", 1)[1], TREE_NOMINATIM_SCHEME="http", TREE_NOMINATIM_MIN_DELAY="0",
+            TREE_METRICS_LOG="", TREE_METRICS_TEXTFILE=""
+        )
+        child = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", "--mock-url", url, "--config", json.dumps(config), "--images", *image_paths],
+            env=env, capture_output=True, text=True
+        )
+        if child.returncode != 0:
+            raise RuntimeError(f"scenario {name} failed:\n{child.stderr[-4000:]}")
+        result = json.loads(child.stdout.strip().splitlines()[-1])
+        stats = mock_stats(url)
+    finally:
+        mock.terminate()
+        mock.wait()
+    result.update({
+        "bytes_uploaded": stats["bytes_received"],
+        "completion_requests": stats["completion_requests"],
+        "geocode_requests": stats["geocode_requests"],
+        "rate_limited_responses": stats["status_counts"].get("429", 0),
+        "truncated_replies": stats["truncated_replies"],
+        "translation_requests": stats["translation_requests"],
+    })
+    return {"config": dict(config, size=list(config["size"])), "metrics": result}
+
+def git_revision():
+    def git(*command):
+        return subprocess.run(["git", *command], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+    return {"commit": git("rev-parse", "HEAD") or None, "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+def compare(current, baseline):
+    """Prints each shared metric with its relative change; '+' marks a regression."""
+    print(f"{'scenario':14} {'metric':30} {'baseline':>12} {'current':>12} {'change':>9}")
+    for name, scenario in current["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if not previous:
+            continue
+        for metric, value in scenario["metrics"].items():
+            old = previous["metrics"].get(metric)
+            if not isinstance(value, (int, float)) or not isinstance(old, (int, float)):
+                continue
+            change = (value - old) / old if old else 0.0
+            worse = change > 0 if any(token in metric for token in LOWER_IS_BETTER) else change < 0
+            flag = "+" if worse and abs(change) >= 0.05 else " "
+            print(f"{name:14} {metric:30} {old:12.3f} {value:12.3f} {change:+8.1%}{flag}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the tree analysis pipeline against local mock services.")
+    parser.add_argument("scenarios", nargs="*", help=f"Scenarios to run (default: all of {', '.join(SCENARIOS)})")
+    parser.add_argument("--quick", action="store_true", help="Run each scenario with a quarter of the images")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "tree_health_bench"),
+                        help="Where synthetic images are generated (reused across runs)")
+    parser.add_argument("--output", help="Result file (default: bench-<commit>.json)")
+    parser.add_argument("--compare", help="Earlier result file to compare against")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--mock-url", help=argparse.SUPPRESS)
+    parser.add_argument("--config", help=argparse.SUPPRESS)
+    parser.add_argument("--images", nargs="*", help=argparse.SUPPRESS)
+    parser.add_argument("--generate", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(sorted(unknown))}")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.child:
+        run_child(args)
+        return 0
+    if args.generate:
+        spec = json.loads(args.generate)
+        print(json.dumps(generate_images(**dict(spec, size=tuple(spec["size"])))))
+        return 0
+
+    revision = git_revision()
+    report = {
+        "meta": dict(revision, python=platform.python_version(), platform=platform.platform(), cpu_count=os.cpu_count(),
+                     seed=args.seed, quick=args.quick, timestamp=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())),
+        "scenarios": {},
+    }
+    for name in args.scenarios or list(SCENARIOS):
+        config = dict(SCENARIOS[name])
+        if args.quick and config["images"]:
+            config["images"] = max(4, config["images"] // 4)
+        print(f"running {name} ({config['images']} images at {config['size'][0]}x{config['size'][1]})...", file=sys.stderr)
+        report["scenarios"][name] = run_scenario(name, config, args.workdir, args.seed)
+        print(json.dumps(report["scenarios"][name]["metrics"]), file=sys.stderr)
+
+    output = args.output or f"bench-{(revision['commit'] or 'unknown')[:10]}.json"
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"wrote {output}", file=sys.stderr)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(report, json.load(f))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
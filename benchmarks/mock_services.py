@@ -0,0 +1,297 @@
+"""Local stand-ins for Azure OpenAI chat completions and Nominatim, for benchmarks.
+
+    python benchmarks/mock_services.py --port 8765 --latency-ms 800 --rate-limit-rate 0.1
+
+Point the dashboard or tree_batch.py at it with AZURE_OPENAI_ENDPOINT=http://127.0.0.1:8765
+(any key and api-version) and TREE_NOMINATIM_DOMAIN=127.0.0.1:8765 TREE_NOMINATIM_SCHEME=http.
+Responses are deterministic for a given --seed and request body. --malformed-rate wraps
+replies in markdown fences with a trailing remark and --truncate-rate cuts them off
+(finish_reason "length"); a follow-up request that includes the cut-off reply as an
+assistant turn receives the rest. Translation requests get their fields back, marked. GET /_stats returns
+request, byte and status counters; POST /_reset zeroes them.
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+TREES = [
+    ("Pedunculate Oak (Quercus robur)", ["Europe", "Western Asia"]),
+    ("Japanese Maple (Acer palmatum)", ["Japan", "Korea", "China"]),
+    ("Silver Birch (Betula pendula)", ["Europe", "Siberia"]),
+    ("Coast Redwood (Sequoia sempervirens)", ["California"]),
+    ("London Plane (Platanus × acerifolia)", []),
+    ("Red Maple (Acer rubrum)", ["Eastern North America"]),
+]
+LOCATIONS = ["Bonn, Germany", "Kyoto, Japan", "Unknown", "Zurich, Switzerland", "Portland, Oregon, USA", "Lyon, France", "Hangzhou, China"]
+GRADES = "AABBCDEF"
+RISKS = ["Low", "Low", "Medium", "High", "Critical"]
+# Prompt tokens billed per high-detail image after the client's downscaling
+IMAGE_PROMPT_TOKENS = 765
+# Share of a one-image latency that does not grow with more images per request (the rest is generation)
+PACK_FIXED_LATENCY_SHARE = 0.2
+# Latency relative to --latency-ms of deployments answering faster than the default model
+MODEL_LATENCY_FACTORS = {"gpt-4.1-mini": 0.5}
+# Prefix of every value in a translation reply
+TRANSLATION_MARKER = "[translated] "
+
+def canned_analysis(rng):
+    tree_type, origins = rng.choice(TREES)
+    grade = rng.choice(GRADES)
+    risk = rng.choice(RISKS)
+    analysis = {
+        "no_tree": False,
+        "tree_type": tree_type,
+        "health_grade": grade,
+        "health_status": "Healthy" if grade in "AB" else "Showing signs of stress",
+        "is_diseased": grade not in "AB",
+        "approximate_age": f"{rng.randint(10, 120)} years",
+        "location": rng.choice(LOCATIONS),
+        "native_origins": origins,
+        "disease_identification": "None" if grade in "AB" else "Possible fungal infection (Ganoderma sp.)",
+        "risk_assessment": {
+            "infection_and_hazard_potential_grade": risk,
+            "infectious_risk_summary": "Low risk of spreading to adjacent trees.",
+            "structural_stability_summary": "No visible cavities; root plate appears intact.",
+            "consequence_of_failure_summary": "Footpath within falling distance.",
+        },
+        "felling_recommendations": {"recommended_method": "Standard Felling", "safety_parameters": {
+            "minimum_safety_distance_meters": "30", "required_personnel": "2 arborists", "required_equipment": "Chainsaw, ropes"}},
+        "detailed_observations": "Leaves show normal colour. " * rng.randint(20, 60),
+        "rehabilitation_advice": "Mulch the root zone and remove deadwood annually. " * rng.randint(5, 15),
+    }
+    return json.dumps(analysis, ensure_ascii=False)
+
+def translation_reply(request):
+    """Reply to a text-only re-localization request: the fields sent, each value marked as translated."""
+    fields = json.loads(request["messages"][-1]["content"])
+    return json.dumps({key: f"{TRANSLATION_MARKER}{value}" for key, value in fields.items()}, ensure_ascii=False)
+
+def request_images(request):
+    return sum(
+        1 for message in request.get("messages", []) if isinstance(message.get("content"), list)
+        for part in message["content"] if part.get("type") == "image_url"
+    )
+
+def prompt_tokens(request):
+    """Rough prompt size: about 4 characters per text token plus a fixed cost per image."""
+    text_chars = 0
+    for message in request.get("messages", []):
+        content = message.get("content")
+        parts = content if isinstance(content, list) else [{"type": "text", "text": content or ""}]
+        text_chars += sum(len(part.get("text", "")) for part in parts if part.get("type") == "text")
+    return text_chars // 4 + IMAGE_PROMPT_TOKENS * request_images(request)
+
+class MockState:
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.rng = random.Random(args.seed)
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stats = {"completion_requests": 0, "geocode_requests": 0, "bytes_received": 0, "bytes_sent": 0,
+                          "status_counts": {}, "max_in_flight": 0, "malformed_replies": 0, "truncated_replies": 0, "continuations": 0,
+                          "translation_requests": 0}
+            # Rest of each truncated reply, by the text that was sent
+            self.truncated = {}
+            self.in_flight = 0
+
+    def count(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+
+    def count_status(self, status):
+        with self.lock:
+            self.stats["status_counts"][str(status)] = self.stats["status_counts"].get(str(status), 0) + 1
+
+    def roll(self):
+        """One draw from the shared RNG, so fault injection is reproducible across runs."""
+        with self.lock:
+            return self.rng.random()
+
+    def latency(self, body):
+        # Seeded by the body so a given image always gets the same latency
+        rng = random.Random(f"{self.args.seed}:{hashlib.sha256(body).hexdigest()}")
+        return max(0.0, (self.args.latency_ms + rng.uniform(-self.args.jitter_ms, self.args.jitter_ms)) / 1000)
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type="application/json", headers=None):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+        self.state.count("bytes_sent", len(data))
+        self.state.count_status(status)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/_stats":
+            with self.state.lock:
+                stats = json.loads(json.dumps(dict(self.state.stats, in_flight=self.state.in_flight)))
+            self._send(200, stats)
+        elif url.path == "/search":
+            self.handle_geocode(parse_qs(url.query).get("q", [""])[0])
+        else:
+            self._send(404, {"error": "not found"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.state.count("bytes_received", len(body))
+        if url.path == "/_reset":
+            self.state.reset()
+            self._send(200, {"ok": True})
+        elif url.path.endswith("/chat/completions"):
+            self.handle_completion(body)
+        else:
+            self._send(404, {"error": "not found"})
+
+    def handle_geocode(self, query):
+        state = self.state
+        state.count("geocode_requests")
+        time.sleep(state.args.geocode_latency_ms / 1000)
+        digest = hashlib.sha256(query.lower().encode("utf-8")).digest()
+        if digest[0] < 26: # ~10% of places are not found
+            self._send(200, [])
+            return
+        lat = digest[1] / 255 * 140 - 60
+        lon = digest[2] / 255 * 360 - 180
+        self._send(200, [{"place_id": int.from_bytes(digest[3:7], "big"), "lat": f"{lat:.5f}", "lon": f"{lon:.5f}",
+                          "display_name": query, "boundingbox": [str(lat - 0.1), str(lat + 0.1), str(lon - 0.1), str(lon + 0.1)]}])
+
+    def handle_completion(self, body):
+        state, args = self.state, self.state.args
+        state.count("completion_requests")
+        with state.lock:
+            state.in_flight += 1
+            state.stats["max_in_flight"] = max(state.stats["max_in_flight"], state.in_flight)
+            over_capacity = args.max_in_flight and state.in_flight > args.max_in_flight
+        try:
+            if over_capacity or state.roll() < args.rate_limit_rate:
+                self._send(429, {"error": {"code": "429", "message": "Requests to the deployment have exceeded the rate limit."}},
+                           headers={"retry-after-ms": str(args.retry_after_ms), "Retry-After": str(max(1, round(args.retry_after_ms / 1000)))})
+                return
+            if state.roll() < args.error_rate:
+                time.sleep(state.latency(body) / 4)
+                self._send(500, {"error": {"code": "InternalServerError", "message": "The server had an error."}})
+                return
+            request = json.loads(body)
+            rng = random.Random(hashlib.sha256(body).digest())
+            images = request_images(request)
+            finish_reason = "stop"
+            messages = request.get("messages", [])
+            prefix = messages[-2].get("content") if len(messages) >= 2 and messages[-2].get("role") == "assistant" else None
+            with state.lock:
+                rest = state.truncated.pop(prefix, None) if prefix is not None else None
+            if rest is not None:
+                content = rest
+                state.count("continuations")
+            elif images == 0 and str(messages[0].get("content", "")).lstrip().startswith("You translate"):
+                content = translation_reply(request)
+                state.count("translation_requests")
+            elif images > 1:
+                # Packed request: one analysis per image under "trees"
+                content = json.dumps({"trees": [dict(image_index=number, **json.loads(canned_analysis(rng))) for number in range(1, images + 1)]}, ensure_ascii=False)
+            else:
+                content = canned_analysis(rng)
+            if rest is None and rng.random() < args.malformed_rate:
+                content = f"```json\n{content}\n```\nLet me know if you need more detail."
+                state.count("malformed_replies")
+            if rest is None and rng.random() < args.truncate_rate:
+                full, cut = content, len(content) // 2
+                content, finish_reason = full[:cut], "length"
+                with state.lock:
+                    state.truncated[content] = full[cut:]
+                state.count("truncated_replies")
+            prompt = prompt_tokens(request)
+            # The shared system prompt is served from the prompt cache once it reaches 1024 tokens
+            usage = {"prompt_tokens": prompt, "completion_tokens": len(content) // 4, "total_tokens": prompt + len(content) // 4,
+                     "prompt_tokens_details": {"cached_tokens": 1024 if prompt >= 1024 else 0}}
+            latency = state.latency(body) * MODEL_LATENCY_FACTORS.get(request.get("model"), 1.0) * (PACK_FIXED_LATENCY_SHARE + (1 - PACK_FIXED_LATENCY_SHARE) * max(1, images))
+            if request.get("stream"):
+                self.stream_completion(request, content, usage, latency, finish_reason)
+            else:
+                time.sleep(latency)
+                self._send(200, {
+                    "id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion", "created": int(time.time()), "model": request.get("model"),
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": finish_reason}],
+                    "usage": usage,
+                })
+        finally:
+            with state.lock:
+                state.in_flight -= 1
+
+    def stream_completion(self, request, content, usage, latency, finish_reason="stop"):
+        """Server-sent events: first chunk after a third of the latency, the rest spread over the remainder."""
+        chunk_chars = 24
+        pieces = [content[i:i + chunk_chars] for i in range(0, len(content), chunk_chars)]
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        self.state.count_status(200)
+
+        def emit(payload):
+            data = f"data: {payload}\n\n".encode("utf-8")
+            self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+            self.state.count("bytes_sent", len(data))
+
+        base = {"id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion.chunk", "created": int(time.time()), "model": request.get("model")}
+        time.sleep(latency / 3)
+        delay = (latency * 2 / 3) / max(1, len(pieces))
+        for piece in pieces:
+            emit(json.dumps(dict(base, choices=[{"index": 0, "delta": {"content": piece}, "finish_reason": None}])))
+            time.sleep(delay)
+        emit(json.dumps(dict(base, choices=[{"index": 0, "delta": {}, "finish_reason": finish_reason}])))
+        if (request.get("stream_options") or {}).get("include_usage"):
+            emit(json.dumps(dict(base, choices=[], usage=usage)))
+        emit("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+
+def create_server(args, host="127.0.0.1"):
+    handler = type("BoundMockHandler", (MockHandler,), {"state": MockState(args)})
+    server = ThreadingHTTPServer((host, args.port), handler)
+    server.daemon_threads = True
+    return server
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Mock Azure OpenAI chat completions and Nominatim search.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=800, help="Mean latency of a one-image completion (packed requests take longer, gpt-4.1-mini half as long)")
+    parser.add_argument("--jitter-ms", type=float, default=200, help="Uniform jitter around the mean latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of completions failing with HTTP 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of completions rejected with HTTP 429")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="Fraction of replies wrapped in markdown fences with trailing text")
+    parser.add_argument("--truncate-rate", type=float, default=0.0, help="Fraction of replies cut off halfway with finish_reason 'length'")
+    parser.add_argument("--max-in-flight", type=int, default=0, help="Reject completions with 429 above this concurrency (0: unlimited)")
+    parser.add_argument("--retry-after-ms", type=int, default=500, help="retry-after-ms sent with 429 responses")
+    parser.add_argument("--geocode-latency-ms", type=float, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    server = create_server(args)
+    print(f"Mock services listening on http://127.0.0.1:{server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,135 @@
+"""Token-budgeted context for the follow-up chat about an analyzed tree.
+
+The request is laid out as [system prefix, summary of older turns, recent turns].
+The system prefix only depends on the analysis, so it is byte-identical on every
+turn and can be served from the service's prompt cache. Older turns are folded
+into a rolling summary once the recent turns no longer fit the budget.
+"""
+import json
+
+CHAT_CONTEXT_BUDGET = 2000
+# Chat-format overhead per message (role markers and separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+SUMMARY_CLIP_CHARS = 160
+# Share of the budget left after the analysis that the rolling summary may occupy
+SUMMARY_BUDGET_SHARE = 0.4
+CHAT_SYSTEM_PROMPT = (
+    "The user is asking a follow-up question about a specific tree. "
+    "Answer using the initial analysis below; say so if it does not cover the question."
+)
+
+_encoding = None
+
+def get_encoding():
+    """The tiktoken encoding of the gpt-4.1 models, or False when tiktoken is not installed."""
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+        except ImportError: # Optional: fall back to a character-based estimate
+            _encoding = False
+        else:
+            _encoding = tiktoken.get_encoding("o200k_base")
+    return _encoding
+
+def estimate_tokens(text):
+    """Token count of ``text``: exact with tiktoken installed, otherwise a conservative estimate."""
+    encoding = get_encoding()
+    if encoding:
+        return len(encoding.encode(text))
+    ascii_chars = sum(1 for char in text if ord(char) < 128)
+    # ~4 ASCII characters per token; CJK and other scripts are closer to one token per character
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+def count_message_tokens(messages):
+    return sum(estimate_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS for message in messages)
+
+def compact_analysis(analysis):
+    """Minified analysis JSON without empty or placeholder fields."""
+    def prune(value):
+        if isinstance(value, dict):
+            pruned = {key: prune(item) for key, item in value.items()}
+            return {key: item for key, item in pruned.items() if item not in (None, "", [], {}, "N/A", "None")}
+        if isinstance(value, list):
+            return [prune(item) for item in value]
+        return value
+    return json.dumps(prune(analysis), ensure_ascii=False, separators=(",", ":"))
+
+def system_prefix(analysis):
+    return {"role": "system", "content": f"{CHAT_SYSTEM_PROMPT}\nInitial analysis: {compact_analysis(analysis)}"}
+
+def extractive_summary(previous_summary, turns):
+    """Cheap summary: earlier questions and answers clipped to their first sentence or so."""
+    lines = [previous_summary] if previous_summary else []
+    for turn in turns:
+        text = " ".join(turn["content"].split())
+        if len(text) > SUMMARY_CLIP_CHARS:
+            text = text[:SUMMARY_CLIP_CHARS].rstrip() + "…"
+        lines.append(f"{turn['role']}: {text}")
+    return "\n".join(lines)
+
+def trim_summary(summary, max_tokens):
+    """Drops the oldest summary lines until the summary fits ``max_tokens``."""
+    lines = summary.splitlines()
+    while len(lines) > 1 and estimate_tokens("\n".join(lines)) > max_tokens:
+        lines.pop(0)
+    return "\n".join(lines)
+
+def model_summarizer(create_completion, model):
+    """Summarizer that asks ``model`` to merge folded turns into the summary, falling back to extractive_summary.
+
+    ``create_completion`` is called with chat-completion keyword arguments.
+    """
+    def summarize(previous_summary, turns):
+        transcript = "\n".join(f"{turn['role']}: {turn['content']}" for turn in turns)
+        try:
+            response = create_completion(
+                model=model,
+                messages=[
+                    {"role": "system", "content": "Condense this conversation about a tree into at most five short bullet points. Keep concrete facts, numbers and decisions."},
+                    {"role": "user", "content": f"Existing summary:\n{previous_summary or '(none)'}\n\nNew turns:\n{transcript}"},
+                ],
+                max_completion_tokens=200,
+            )
+            return response.choices[0].message.content or extractive_summary(previous_summary, turns)
+        except Exception:
+            return extractive_summary(previous_summary, turns)
+    return summarize
+
+def build_chat_messages(analysis, history, state, budget_tokens=CHAT_CONTEXT_BUDGET, summarize=extractive_summary):
+    """Builds the messages for the next follow-up request within ``budget_tokens``.
+
+    ``state`` is a per-chat dict holding the rolling "summary" and how many turns of
+    ``history`` are already "folded" into it; it is updated in place. The newest turn
+    (the user's question) is always sent. Returns (messages, token report).
+    """
+    state.setdefault("summary", "")
+    state.setdefault("folded", 0)
+    prefix = system_prefix(analysis)
+    prefix_tokens = count_message_tokens([prefix])
+    summary_budget = int(max(0, budget_tokens - prefix_tokens) * SUMMARY_BUDGET_SHARE)
+
+    def summary_messages():
+        return [{"role": "system", "content": f"Summary of the earlier conversation:\n{state['summary']}"}] if state["summary"] else []
+
+    turns = [{"role": turn["role"], "content": turn["content"]} for turn in history]
+    while True:
+        recent = turns[state["folded"]:]
+        summary_tokens = count_message_tokens(summary_messages())
+        history_tokens = count_message_tokens(recent)
+        if prefix_tokens + summary_tokens + history_tokens <= budget_tokens or len(recent) <= 1:
+            break
+        # Fold whole exchanges (question + answer) where possible so the recent turns stay coherent
+        fold = 2 if len(recent) > 2 and recent[0]["role"] == "user" else 1
+        state["summary"] = trim_summary(summarize(state["summary"], recent[:fold]), summary_budget)
+        state["folded"] += fold
+
+    messages = [prefix] + summary_messages() + recent
+    report = {
+        "prefix_tokens": prefix_tokens,
+        "summary_tokens": summary_tokens,
+        "history_tokens": history_tokens,
+        "total_tokens": prefix_tokens + summary_tokens + history_tokens,
+        "folded_turns": state["folded"],
+    }
+    return messages, report
@@ -0,0 +1,238 @@
+"""Quota-aware pool of Azure OpenAI endpoints shared by every session in the process.
+
+Endpoints are configured in .streamlit/secrets.toml; without an ``azure_endpoints``
+list the single ``auth_endpoint``/``auth_key``/``auth_version`` entry is used:
+
+    [[azure_endpoints]]
+    name = "swedencentral"
+    endpoint = "https://...openai.azure.com"
+    api_key = "..."
+    api_version = "2024-10-21"
+    tpm = 450000                    # tokens per minute of the deployment quota
+    rpm = 2700                      # requests per minute
+    deployments = { "gpt-4.1" = "gpt-41-prod" }   # optional model -> deployment names
+
+Each request is routed to a healthy endpoint with free quota, weighted by TPM.
+Per-endpoint token and request buckets are charged the way Azure's rate limiter
+counts (estimated prompt tokens plus max_completion_tokens), so concurrent batches
+queue here instead of triggering 429 storms. Endpoints failing with 429s, 5xx or
+connection errors are taken out of rotation for a cooldown and the request fails
+over to the next one; when all of them are cooling down, requests go to the one
+that recovers first and the caller's retry backoff sets the pace.
+"""
+import os
+import random
+import threading
+import time
+import types
+
+from metrics import METRICS
+
+DEFAULT_TPM = 150_000
+DEFAULT_RPM = 900
+# Share of each quota this process may use, e.g. 0.5 when two replicas share the deployments
+QUOTA_SHARE = float(os.getenv("TREE_QUOTA_SHARE", "1"))
+# Azure bills a high-detail image after our downscaling at roughly 4-8 tiles of 170 tokens
+IMAGE_TOKEN_ESTIMATE = 1105
+DEFAULT_COMPLETION_TOKENS = 4096
+COOLDOWN_BASE_SECONDS = 5.0
+COOLDOWN_MAX_SECONDS = 300.0
+QUOTA_POLL_SECONDS = 0.25
+MAX_CONNECTIONS = 64
+KEEPALIVE_EXPIRY_SECONDS = 60.0
+
+def endpoint_configs(secrets):
+    """Endpoint dicts from a secrets mapping (``azure_endpoints`` list, or the single auth_* entry)."""
+    if "azure_endpoints" in secrets:
+        configs = [dict(endpoint) for endpoint in secrets["azure_endpoints"]]
+    else:
+        configs = [{"endpoint": secrets["auth_endpoint"], "api_key": secrets["auth_key"], "api_version": secrets["auth_version"]}]
+    for i, config in enumerate(configs):
+        config.setdefault("name", f"endpoint-{i}")
+        config["deployments"] = dict(config.get("deployments") or {})
+    return configs
+
+class TokenBucket:
+    """Per-minute quota refilled continuously."""
+
+    def __init__(self, per_minute):
+        self.capacity = max(1.0, float(per_minute))
+        self.tokens = self.capacity
+        self.rate = self.capacity / 60.0
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """Seconds until ``amount`` is available (0 when it is available now)."""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def available(self, now):
+        self._refill(now)
+        return max(0.0, self.tokens)
+
+    def take(self, amount):
+        self.tokens -= min(amount, self.capacity)
+
+    def drain(self, now):
+        self._refill(now)
+        self.tokens = min(self.tokens, 0.0)
+
+class Endpoint:
+    def __init__(self, config, http_client):
+        from openai import AzureOpenAI
+        self.name = config["name"]
+        self.deployments = config["deployments"]
+        self.tpm = config.get("tpm", DEFAULT_TPM) * QUOTA_SHARE
+        self.tokens = TokenBucket(self.tpm)
+        self.requests = TokenBucket(config.get("rpm", DEFAULT_RPM) * QUOTA_SHARE)
+        self.failures = 0
+        self.cooldown_until = 0.0
+        # After a cooldown a single probe request decides whether the endpoint is back
+        self.probe_in_flight = False
+        self.client = AzureOpenAI(
+            azure_endpoint=config["endpoint"], api_key=config["api_key"], api_version=config["api_version"],
+            http_client=http_client, max_retries=0
+        )
+
+    def serves(self, model):
+        return not self.deployments or model in self.deployments
+
+def estimate_request_tokens(kwargs):
+    """Prompt estimate plus the completion allowance, as Azure charges a request against TPM."""
+    from chat_context import estimate_tokens
+    tokens = 0
+    for message in kwargs.get("messages", []):
+        content = message.get("content")
+        parts = content if isinstance(content, list) else [{"type": "text", "text": content or ""}]
+        for part in parts:
+            tokens += IMAGE_TOKEN_ESTIMATE if part.get("type") == "image_url" else estimate_tokens(part.get("text") or "")
+    return tokens + (kwargs.get("max_completion_tokens") or kwargs.get("max_tokens") or DEFAULT_COMPLETION_TOKENS)
+
+class EndpointPool:
+    """Drop-in for an AzureOpenAI client: ``pool.chat.completions.create(**kwargs)`` routes across endpoints."""
+
+    # Lets create_completion_with_retry pass its cancel event into the quota wait
+    accepts_cancel_event = True
+
+    def __init__(self, configs):
+        import httpx
+        from openai import DefaultHttpxClient
+        if not configs:
+            raise ValueError("No Azure OpenAI endpoints configured")
+        # One keep-alive connection pool for all endpoints and threads
+        self.http_client = DefaultHttpxClient(limits=httpx.Limits(
+            max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS, keepalive_expiry=KEEPALIVE_EXPIRY_SECONDS
+        ))
+        self.endpoints = [Endpoint(config, self.http_client) for config in configs]
+        self._lock = threading.Lock()
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self.create))
+
+    def _reserve(self, model, tokens, exclude, cancel_event):
+        """Blocks until an endpoint has quota for the request, charges it and returns it (None if cancelled)."""
+        candidates = [endpoint for endpoint in self.endpoints if endpoint.serves(model) and endpoint not in exclude]
+        if not candidates:
+            raise ValueError(f"No configured endpoint serves model {model!r}")
+        waited_from, waited = time.monotonic(), False
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                healthy = [endpoint for endpoint in candidates if endpoint.cooldown_until <= now and not endpoint.probe_in_flight]
+                # With every endpoint cooling down the caller's backoff paces retries instead of the cooldown
+                pool = healthy or candidates
+                ready, wait = [], float("inf")
+                for endpoint in pool:
+                    endpoint_wait = max(endpoint.tokens.wait_time(tokens, now), endpoint.requests.wait_time(1, now))
+                    if endpoint_wait <= 0:
+                        ready.append(endpoint)
+                    wait = min(wait, endpoint_wait)
+                if ready:
+                    if healthy:
+                        endpoint = random.choices(ready, weights=[endpoint.tpm for endpoint in ready])[0]
+                    else:
+                        endpoint = min(ready, key=lambda endpoint: endpoint.cooldown_until)
+                    endpoint.tokens.take(tokens)
+                    endpoint.requests.take(1)
+                    endpoint.probe_in_flight = endpoint.failures > 0
+                    if waited:
+                        METRICS.observe("quota_wait", now - waited_from)
+                    return endpoint
+            # Sleep in short slices so a cancelled analysis stops waiting promptly
+            waited = True
+            if cancel_event is not None:
+                if cancel_event.wait(min(wait, QUOTA_POLL_SECONDS)):
+                    return None
+            else:
+                time.sleep(min(wait, QUOTA_POLL_SECONDS))
+
+    def _mark_failed(self, endpoint, error):
+        from tree_pipeline import retry_delay
+        from openai import RateLimitError
+        with self._lock:
+            now = time.monotonic()
+            endpoint.probe_in_flight = False
+            if endpoint.cooldown_until > now:
+                return # Concurrent requests failing together count as one incident
+            if isinstance(error, RateLimitError):
+                # Quota, not health: honour Retry-After and stop routing here until then
+                endpoint.tokens.drain(now)
+                endpoint.cooldown_until = now + retry_delay(error, 0)
+            else:
+                endpoint.failures += 1
+                endpoint.cooldown_until = now + min(COOLDOWN_MAX_SECONDS, COOLDOWN_BASE_SECONDS * 2 ** (endpoint.failures - 1))
+
+    def create(self, cancel_event=None, **kwargs):
+        """Sends a chat completion through the pool, failing over to other endpoints on transient errors.
+
+        Raises the last error once every eligible endpoint has failed, so the caller's
+        retry loop backs off. Returns None when ``cancel_event`` is set while waiting
+        for quota.
+        """
+        from tree_pipeline import retryable_errors
+        model = kwargs["model"]
+        tokens = estimate_request_tokens(kwargs)
+        tried = set()
+        while True:
+            endpoint = self._reserve(model, tokens, tried, cancel_event)
+            if endpoint is None:
+                return None
+            tried.add(endpoint)
+            try:
+                response = endpoint.client.chat.completions.create(**dict(kwargs, model=endpoint.deployments.get(model, model)))
+            except retryable_errors() as e:
+                self._mark_failed(endpoint, e)
+                METRICS.incr("endpoint_requests_total", endpoint=endpoint.name, result=type(e).__name__)
+                if len(tried) == sum(1 for candidate in self.endpoints if candidate.serves(model)):
+                    raise
+                continue
+            except BaseException as e:
+                # The endpoint answered (e.g. a content-filter 400) or we were interrupted: it is not
+                # unhealthy, but a probe must release its flag or the endpoint stays out of rotation
+                with self._lock:
+                    endpoint.probe_in_flight = False
+                METRICS.incr("endpoint_requests_total", endpoint=endpoint.name, result=type(e).__name__)
+                raise
+            with self._lock:
+                endpoint.failures = 0
+                endpoint.probe_in_flight = False
+            METRICS.incr("endpoint_requests_total", endpoint=endpoint.name, result="ok")
+            return response
+
+    def status(self):
+        """One row per endpoint for the diagnostics panel."""
+        with self._lock:
+            now = time.monotonic()
+            return [{
+                "endpoint": endpoint.name,
+                "healthy": endpoint.cooldown_until <= now,
+                "cooldown s": round(max(0.0, endpoint.cooldown_until - now), 1),
+                "free tokens": int(endpoint.tokens.available(now)),
+                "free requests": int(endpoint.requests.available(now)),
+            } for endpoint in self.endpoints]
+
+    def close(self):
+        self.http_client.close()
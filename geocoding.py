@@ -0,0 +1,140 @@
+"""Location strings to coordinates: bundled gazetteer first, then a shared SQLite cache, then Nominatim.
+
+Kept free of Streamlit so the job worker and tree_batch.py can place the trees they add
+to the inventory the same way the dashboard places them on its map.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from metrics import METRICS
+from tree_pipeline import CACHE_DIR
+
+GAZETTEER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gazetteer.json")
+# Expanded list of terms to treat as invalid locations
+UNKNOWN_LOCATION_TERMS = ['n/a', 'unknown', 'unspecified', 'uncertain', 'not specified']
+# "Northern Italy" etc. fall back to the country/region centroid
+LOCATION_QUALIFIERS = ['northern ', 'southern ', 'eastern ', 'western ', 'central ', 'north ', 'south ', 'east ', 'west ',
+                       'northeastern ', 'northwestern ', 'southeastern ', 'southwestern ']
+
+# Overridable to point at a self-hosted Nominatim or the benchmark stand-in; the public
+# instance's usage policy allows at most one request per second
+NOMINATIM_DOMAIN = os.getenv("TREE_NOMINATIM_DOMAIN", "nominatim.openstreetmap.org")
+NOMINATIM_SCHEME = os.getenv("TREE_NOMINATIM_SCHEME", "https")
+NOMINATIM_MIN_DELAY_SECONDS = float(os.getenv("TREE_NOMINATIM_MIN_DELAY", "1"))
+
+GEOCODE_CACHE_MAX_AGE_SECONDS = 180 * 24 * 3600
+GEOCODE_NEGATIVE_MAX_AGE_SECONDS = 7 * 24 * 3600
+
+class GeocodeCache:
+    """SQLite store of geocoding results shared across sessions and processes.
+
+    Unresolvable places are cached too (as NULL coordinates), with a shorter lifetime.
+    """
+
+    def __init__(self, path, max_age_seconds=GEOCODE_CACHE_MAX_AGE_SECONDS, negative_max_age_seconds=GEOCODE_NEGATIVE_MAX_AGE_SECONDS):
+        self.path = path
+        self.max_age_seconds = max_age_seconds
+        self.negative_max_age_seconds = negative_max_age_seconds
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS geocodes (query TEXT PRIMARY KEY, lat REAL, lon REAL, created_at REAL NOT NULL)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, query):
+        """Returns (found, (lat, lon)); found is False when the query must be geocoded remotely."""
+        with self._connect() as conn:
+            row = conn.execute("SELECT lat, lon, created_at FROM geocodes WHERE query = ?", (query,)).fetchone()
+        if row is None:
+            return False, (None, None)
+        max_age = self.max_age_seconds if row[0] is not None else self.negative_max_age_seconds
+        if time.time() - row[2] > max_age:
+            return False, (None, None)
+        return True, (row[0], row[1])
+
+    def put(self, query, coords):
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO geocodes (query, lat, lon, created_at) VALUES (?, ?, ?, ?)", (query, coords[0], coords[1], time.time()))
+
+def load_gazetteer(path=GAZETTEER_PATH):
+    """Loads the bundled country/region centroids, keyed by lower-cased name and alias."""
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    places = {name.lower(): tuple(coords) for name, coords in data["places"].items()}
+    for alias, name in data["aliases"].items():
+        places[alias.lower()] = places[name.lower()]
+    return places
+
+def normalize_location(location_str):
+    query = " ".join(str(location_str).lower().split()).strip(" .")
+    return query[4:] if query.startswith("the ") else query
+
+class Geocoder:
+    """The gazetteer, the disk cache and the rate-limited Nominatim client of one process."""
+
+    def __init__(self, cache=None, gazetteer_path=GAZETTEER_PATH):
+        self.cache = cache or GeocodeCache(os.path.join(CACHE_DIR, "geocode_cache.sqlite3"))
+        self.places = load_gazetteer(gazetteer_path)
+        self._lock = threading.Lock()
+        self._nominatim = None
+
+    def gazetteer_lookup(self, query):
+        if query in self.places:
+            return self.places[query]
+        for qualifier in LOCATION_QUALIFIERS:
+            if query.startswith(qualifier) and query[len(qualifier):] in self.places:
+                return self.places[query[len(qualifier):]]
+        return None
+
+    def nominatim(self):
+        """The rate-limited Nominatim lookup, created on first use (geopy is imported only then)."""
+        with self._lock:
+            if self._nominatim is None:
+                from geopy.geocoders import Nominatim
+                from geopy.extra.rate_limiter import RateLimiter
+                # Errors must propagate so network failures are not negatively cached
+                geolocator = Nominatim(user_agent="tree_health_app", domain=NOMINATIM_DOMAIN, scheme=NOMINATIM_SCHEME)
+                self._nominatim = RateLimiter(geolocator.geocode, min_delay_seconds=NOMINATIM_MIN_DELAY_SECONDS, swallow_exceptions=False)
+            return self._nominatim
+
+    def geocode_many(self, location_strs):
+        """Resolves location strings to (lat, lon), with (None, None) for unresolvable ones.
+
+        Each distinct place is looked up once: first in the offline gazetteer, then in the
+        shared disk cache, and only then through the rate-limited Nominatim geocoder.
+        """
+        results = {}
+        remote_queries = {}
+        for location_str in set(filter(None, location_strs)):
+            query = normalize_location(location_str)
+            if not query or any(term in query for term in UNKNOWN_LOCATION_TERMS):
+                results[location_str] = (None, None)
+                continue
+            coords = self.gazetteer_lookup(query)
+            if coords is None:
+                found, coords = self.cache.get(query)
+                METRICS.incr("cache_requests_total", cache="geocode", result="hit" if found else "miss")
+                if not found:
+                    remote_queries.setdefault(query, []).append(location_str)
+                    continue
+            results[location_str] = coords
+
+        if remote_queries:
+            geocode = self.nominatim()
+            for query, location_strs_for_query in remote_queries.items():
+                try:
+                    with METRICS.timer("geocode"):
+                        location = geocode(query)
+                except Exception:
+                    coords = (None, None) # Transient failure: retry on a later run
+                else:
+                    coords = (location.latitude, location.longitude) if location else (None, None)
+                    self.cache.put(query, coords)
+                for location_str in location_strs_for_query:
+                    results[location_str] = coords
+        return results
@@ -0,0 +1,99 @@
+"""Image preprocessing for the vision request.
+
+Kept free of Streamlit so the functions can run in a worker process pool.
+"""
+import base64
+import io
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageOps
+
+# gpt-4.1 scales high-detail images to fit 2048x2048 and then to 768px on the short side,
+# so anything larger is decoded, encoded and uploaded only to be thrown away.
+VISION_MAX_EDGE = 2048
+VISION_SHORT_EDGE = 768
+JPEG_QUALITY = 85
+# dHash side length: hash_size x hash_size bits, compared by Hamming distance
+PERCEPTUAL_HASH_SIZE = 8
+# Grey levels the hash thumbnail must span; flatter images all hash alike
+PERCEPTUAL_HASH_MIN_CONTRAST = 8
+# Re-encodes and burst frames of one tree usually differ in under 10 of the 64 bits,
+# unrelated photos in 20 or more
+DEDUPE_THRESHOLD = 10
+PREPROCESS_WORKERS = max(1, min(4, (multiprocessing.cpu_count() or 1) - 1))
+
+def vision_target_size(size, max_edge=VISION_MAX_EDGE, short_edge=VISION_SHORT_EDGE):
+    """Returns the (width, height) the model would actually see for an image of ``size``."""
+    width, height = size
+    scale = min(1.0, max_edge / max(width, height))
+    if short_edge and min(width, height) * scale > short_edge:
+        scale = short_edge / min(width, height)
+    return max(1, math.ceil(width * scale)), max(1, math.ceil(height * scale))
+
+def downscale_image(source, max_edge=VISION_MAX_EDGE, short_edge=VISION_SHORT_EDGE, quality=JPEG_QUALITY):
+    """Decodes, orients, downsizes and re-encodes an image given as bytes or a file path.
+
+    Returns ``(encoded_bytes, mime_type)``. JPEGs are decoded in draft mode, which lets
+    libjpeg scale by 1/2, 1/4 or 1/8 during decoding instead of materialising every
+    pixel of a 12-48 MP photo. Images with transparency stay PNG; everything else is
+    encoded as JPEG at ``quality``.
+    """
+    img = Image.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+    if img.format == "JPEG":
+        img.draft("RGB", vision_target_size(img.size, max_edge, short_edge))
+    img = ImageOps.exif_transpose(img)
+    img.thumbnail(vision_target_size(img.size, max_edge, short_edge))
+
+    buffered = io.BytesIO()
+    if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+        img.save(buffered, format="PNG")
+        mime_type = "image/png"
+    else:
+        img.convert("RGB").save(buffered, format="JPEG", quality=quality)
+        mime_type = "image/jpeg"
+    return buffered.getvalue(), mime_type
+
+def preprocess_image(source, max_edge=VISION_MAX_EDGE, short_edge=VISION_SHORT_EDGE, quality=JPEG_QUALITY):
+    """Prepares an upload for the vision request; returns ``(base64_data, mime_type)``."""
+    encoded, mime_type = downscale_image(source, max_edge, short_edge, quality)
+    return base64.b64encode(encoded).decode("utf-8"), mime_type
+
+def perceptual_hash(source, hash_size=PERCEPTUAL_HASH_SIZE):
+    """Difference hash (dHash) of an image given as bytes or a file path, as an int of hash_size² bits.
+
+    Each bit says whether a pixel of the hash_size+1 x hash_size grayscale thumbnail is
+    brighter than its right neighbour, so re-encoding, resizing and small exposure or
+    framing changes flip only a few bits. Returns None for (nearly) uniform images,
+    which carry no fingerprint.
+    """
+    img = Image.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+    if img.format == "JPEG":
+        img.draft("L", (hash_size * 16, hash_size * 16))
+    img = ImageOps.exif_transpose(img)
+    pixels = img.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.BOX).tobytes()
+    if max(pixels) - min(pixels) < PERCEPTUAL_HASH_MIN_CONTRAST:
+        return None
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            offset = row * (hash_size + 1) + col
+            value = value << 1 | (pixels[offset] > pixels[offset + 1])
+    return value
+
+def hash_distance(a, b):
+    """Number of differing bits between two perceptual hashes."""
+    return (a ^ b).bit_count()
+
+def create_preprocess_pool(max_workers=PREPROCESS_WORKERS, start_method="fork"):
+    """Returns a process pool for preprocess_image, or None where it cannot be used safely.
+
+    Streamlit installs the running script as ``__main__``, so "spawn"/"forkserver" workers
+    would re-execute the whole app on start-up. Only "fork" avoids that; elsewhere callers
+    preprocess in their own thread (Pillow releases the GIL while decoding and resizing).
+    Plain scripts may pass another ``start_method``, e.g. so workers do not inherit open files.
+    """
+    if start_method not in multiprocessing.get_all_start_methods():
+        return None
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context(start_method))
@@ -0,0 +1,156 @@
+"""Disk-backed store for uploaded images, so session state only holds small handles."""
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import weakref
+
+from image_preprocessing import downscale_image
+
+IMAGE_STORE_DIR = os.getenv("TREE_IMAGE_STORE_DIR", os.path.join(tempfile.gettempdir(), "tree_health_images"))
+# Stores untouched for this long belong to dead sessions (e.g. after a server crash)
+IMAGE_STORE_MAX_IDLE_SECONDS = 24 * 3600
+# variant -> (max_edge, quality); thumbnails are 2x their 50px display width for sharp HiDPI rendering
+DERIVATIVE_SIZES = {"thumbnail": (100, 80), "display": (1024, 85)}
+MIME_EXTENSIONS = {"image/jpeg": ".jpg", "image/png": ".png"}
+# Streamlit serves <app dir>/static/ at app/static/ when server.enableStaticServing is on
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+STATIC_URL = "app/static"
+# Sweeping stats every published file, so each static dir is swept at most this often per process
+PUBLISHED_SWEEP_INTERVAL_SECONDS = 3600
+
+_published_sweeps = {} # static dir -> time of its last sweep
+_published_sweeps_lock = threading.Lock()
+
+class ImageStore:
+    """Content-addressed image files for one session, with precomputed derivatives.
+
+    Image ids are the SHA-256 of the original bytes. The directory is removed by
+    close(), or automatically when the store is garbage collected with its session.
+    A store opened on an existing ``root`` (a background job's photos) is left in place.
+    """
+
+    def __init__(self, base_dir=IMAGE_STORE_DIR, static_dir=STATIC_DIR, root=None):
+        sweep_published_periodically(static_dir)
+        self.static_dir = static_dir
+        if root is not None:
+            os.makedirs(root, exist_ok=True)
+            self.root = root
+            self._finalizer = None
+            return
+        os.makedirs(base_dir, exist_ok=True)
+        sweep_stale_stores(base_dir)
+        self.root = tempfile.mkdtemp(prefix="session_", dir=base_dir)
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.root, True)
+
+    def put(self, image_bytes):
+        image_id = hashlib.sha256(image_bytes).hexdigest()
+        path = self._path(image_id, "original")
+        if not os.path.exists(path):
+            self._write(path, image_bytes)
+        return image_id
+
+    def path(self, image_id, variant="original"):
+        """Path of an image variant ("original", "thumbnail" or "display"), created on first use."""
+        if variant == "original":
+            return self._path(image_id, "original")
+        return self.derive(image_id, variant, self._path(image_id, "original"))
+
+    def derive(self, image_id, variant, original_path):
+        """Path of a variant rendered from ``original_path`` on first use, e.g. from a photo this store does not hold."""
+        for mime_type, extension in MIME_EXTENSIONS.items():
+            path = self._path(image_id, variant) + extension
+            if os.path.exists(path):
+                return path
+        max_edge, quality = DERIVATIVE_SIZES[variant]
+        encoded, mime_type = downscale_image(original_path, max_edge=max_edge, short_edge=None, quality=quality)
+        path = self._path(image_id, variant) + MIME_EXTENSIONS[mime_type]
+        self._write(path, encoded)
+        return path
+
+    def prepare_derivatives(self, image_id):
+        for variant in DERIVATIVE_SIZES:
+            self.path(image_id, variant)
+
+    def publish(self, image_id, variant="thumbnail", base_url_path=""):
+        """URL path of an image variant copied under Streamlit's static files.
+
+        ``base_url_path`` is Streamlit's server.baseUrlPath, which prefixes every URL the
+        server answers. Published files are named by image id, so sessions uploading the
+        same photo share one file; they outlive the session until sweep_published removes them.
+        """
+        source = self.path(image_id, variant)
+        name = f"{image_id}{os.path.splitext(source)[1]}"
+        target = os.path.join(self.static_dir, variant, name)
+        if os.path.exists(target):
+            os.utime(target)
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target), suffix=".tmp")
+            with os.fdopen(fd, "wb") as f, open(source, "rb") as src:
+                shutil.copyfileobj(src, f)
+            os.replace(tmp_path, target)
+        return static_url(f"{variant}/{name}", base_url_path)
+
+    def read(self, image_id, variant="original"):
+        with open(self.path(image_id, variant), "rb") as f:
+            return f.read()
+
+    def touch(self):
+        """Marks the store as in use so sweep_stale_stores leaves it alone."""
+        if os.path.isdir(self.root):
+            os.utime(self.root)
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+        os.makedirs(self.root, exist_ok=True)
+
+    def close(self):
+        if self._finalizer is not None:
+            self._finalizer()
+
+    def _path(self, image_id, variant):
+        return os.path.join(self.root, f"{image_id}.{variant}")
+
+    def _write(self, path, data):
+        # Write-then-rename so concurrent readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+def sweep_stale_stores(base_dir=IMAGE_STORE_DIR, max_idle_seconds=IMAGE_STORE_MAX_IDLE_SECONDS):
+    cutoff = time.time() - max_idle_seconds
+    for entry in os.scandir(base_dir):
+        if entry.is_dir() and entry.name.startswith("session_") and entry.stat().st_mtime < cutoff:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+def static_url(relative_path, base_url_path=""):
+    """Absolute URL path of a file under STATIC_DIR, e.g. "/trees/app/static/thumbnail/x.jpg" with base path "trees"."""
+    base = base_url_path.strip("/")
+    return f"/{base}/{STATIC_URL}/{relative_path}" if base else f"/{STATIC_URL}/{relative_path}"
+
+def sweep_published_periodically(static_dir=STATIC_DIR, interval_seconds=PUBLISHED_SWEEP_INTERVAL_SECONDS):
+    """Runs sweep_published unless this process swept ``static_dir`` within ``interval_seconds``."""
+    now = time.time()
+    with _published_sweeps_lock:
+        if now - _published_sweeps.get(static_dir, float("-inf")) < interval_seconds:
+            return
+        _published_sweeps[static_dir] = now
+    sweep_published(static_dir)
+
+def sweep_published(static_dir=STATIC_DIR, max_idle_seconds=IMAGE_STORE_MAX_IDLE_SECONDS):
+    """Removes published derivatives no session has asked for within ``max_idle_seconds``."""
+    cutoff = time.time() - max_idle_seconds
+    for variant in DERIVATIVE_SIZES:
+        directory = os.path.join(static_dir, variant)
+        if not os.path.isdir(directory):
+            continue
+        for entry in os.scandir(directory):
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
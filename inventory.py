@@ -0,0 +1,167 @@
+"""Persistent inventory of analyzed trees, queryable by grade, species, distance and date.
+
+Every finished job and tree_batch.py run adds its trees with their geocoded position and
+a thumbnail, so they outlive the session and the job (which is deleted after a week).
+Positions are indexed in an SQLite R-tree: a radius query reads only the trees inside
+the circle's bounding box and then checks their exact distance. Health grade, risk
+grade, species and analysis date have ordinary indexes.
+"""
+import json
+import math
+import os
+import sqlite3
+import time
+
+from image_store import ImageStore
+from tree_pipeline import CACHE_DIR
+
+INVENTORY_DIR = os.getenv("TREE_INVENTORY_DIR", os.path.join(CACHE_DIR, "inventory"))
+# Mean Earth radius, for distances between geocoded positions
+EARTH_RADIUS_KM = 6371.0088
+# Rows returned per query; the match count and the map cover every match
+INVENTORY_QUERY_LIMIT = 200
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """Great-circle (haversine) distance between two positions."""
+    if lat1 is None or lat2 is None:
+        return None
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+def bounding_box(lat, lon, radius_km):
+    """(min_lat, max_lat, min_lon, max_lon) around a circle.
+
+    Near the poles, and for circles crossing the antimeridian, the box spans every longitude.
+    """
+    dlat = math.degrees(radius_km / EARTH_RADIUS_KM)
+    cos_lat = math.cos(math.radians(lat))
+    dlon = math.degrees(radius_km / EARTH_RADIUS_KM) / cos_lat if cos_lat > 1e-6 else 180
+    if lat + dlat >= 90 or lat - dlat <= -90 or lon - dlon < -180 or lon + dlon > 180:
+        return max(-90, lat - dlat), min(90, lat + dlat), -180, 180
+    return lat - dlat, lat + dlat, lon - dlon, lon + dlon
+
+class TreeInventory:
+    """Analyzed trees in one SQLite file shared by all sessions, with their thumbnails in an ImageStore."""
+
+    def __init__(self, inventory_dir=INVENTORY_DIR):
+        self.inventory_dir = inventory_dir
+        self.path = os.path.join(inventory_dir, "inventory.sqlite3")
+        self.images = ImageStore(root=os.path.join(inventory_dir, "images"))
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS trees ("
+                "id INTEGER PRIMARY KEY, result_id TEXT NOT NULL UNIQUE, job_id TEXT, filename TEXT NOT NULL, image_id TEXT NOT NULL, "
+                "analyzed_at REAL NOT NULL, lang TEXT NOT NULL, model TEXT, health_grade TEXT, risk_grade TEXT, species TEXT, "
+                "location TEXT, lat REAL, lon REAL, analysis TEXT NOT NULL)"
+            )
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS tree_positions USING rtree(id, min_lat, max_lat, min_lon, max_lon)")
+            conn.execute("CREATE INDEX IF NOT EXISTS trees_health ON trees (health_grade, analyzed_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS trees_risk ON trees (risk_grade, analyzed_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS trees_species ON trees (species, analyzed_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS trees_analyzed ON trees (analyzed_at)")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.create_function("distance_km", 4, distance_km, deterministic=True)
+        return conn
+
+    def add(self, results, coordinates, image_source, lang, job_id=None, analyzed_at=None):
+        """Adds the analyzed trees among ``results`` (result payloads) and returns how many were new.
+
+        ``coordinates`` maps location strings to (lat, lon) as Geocoder.geocode_many returns
+        them; thumbnails are rendered from the originals in ``image_source`` (an ImageStore
+        or FileImageSource). Results already in the inventory are skipped.
+        """
+        analyzed_at = analyzed_at or time.time()
+        rows = []
+        for result in results:
+            res = result.get("analysis")
+            if not res:
+                continue
+            self.images.derive(result["image_id"], "thumbnail", image_source.path(result["image_id"]))
+            lat, lon = coordinates.get(res.get("location"), (None, None))
+            risk = (res.get("risk_assessment") or {}).get("infection_and_hazard_potential_grade")
+            rows.append((
+                result["id"], job_id, result.get("filename") or "", result["image_id"], analyzed_at, lang, result.get("model"),
+                str(res["health_grade"]).upper() if res.get("health_grade") else None, str(risk).upper() if risk else None,
+                res.get("tree_type"), res.get("location"), lat, lon, json.dumps(res, ensure_ascii=False),
+            ))
+        added = 0
+        with self._connect() as conn:
+            for row in rows:
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO trees (result_id, job_id, filename, image_id, analyzed_at, lang, model, health_grade, "
+                    "risk_grade, species, location, lat, lon, analysis) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row
+                )
+                if cursor.rowcount:
+                    added += 1
+                    if row[11] is not None:
+                        conn.execute("INSERT INTO tree_positions VALUES (?, ?, ?, ?, ?)", (cursor.lastrowid, row[11], row[11], row[12], row[12]))
+        return added
+
+    def stats(self):
+        """Number of trees and the first and last analysis time (None when empty)."""
+        with self._connect() as conn:
+            count, first, last = conn.execute("SELECT COUNT(*), MIN(analyzed_at), MAX(analyzed_at) FROM trees").fetchone()
+        return {"trees": count, "first": first, "last": last}
+
+    def species(self):
+        """(species, tree count) pairs, most common first."""
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT species, COUNT(*) FROM trees WHERE species IS NOT NULL GROUP BY species ORDER BY COUNT(*) DESC, species"
+            ).fetchall()
+
+    def _where(self, clauses=(), health_grades=(), risk_grades=(), species=(), near=None, radius_km=None, since=None, until=None):
+        """FROM clause and parameters of the trees matching the filters and ``clauses``; empty filters match everything."""
+        clauses, params = list(clauses), []
+        source = "trees"
+        for column, values in (("health_grade", health_grades), ("risk_grade", risk_grades), ("species", species)):
+            if values:
+                clauses.append(f"trees.{column} IN ({', '.join('?' * len(values))})")
+                params.extend(values)
+        if since is not None:
+            clauses.append("trees.analyzed_at >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("trees.analyzed_at < ?")
+            params.append(until)
+        if near is not None and radius_km is not None:
+            # The R-tree narrows the search to the circle's bounding box before distances are computed; CROSS JOIN
+            # keeps SQLite from starting at a grade index and probing the R-tree once per tree instead
+            source = "tree_positions CROSS JOIN trees ON trees.id = tree_positions.id"
+            min_lat, max_lat, min_lon, max_lon = bounding_box(near[0], near[1], radius_km)
+            clauses.append("tree_positions.max_lat >= ? AND tree_positions.min_lat <= ? AND tree_positions.max_lon >= ? AND tree_positions.min_lon <= ?")
+            clauses.append("distance_km(trees.lat, trees.lon, ?, ?) <= ?")
+            params.extend((min_lat, max_lat, min_lon, max_lon, near[0], near[1], radius_km))
+        return f"FROM {source}" + (f" WHERE {' AND '.join(clauses)}" if clauses else ""), params
+
+    def query(self, limit=INVENTORY_QUERY_LIMIT, **filters):
+        """(match count, first ``limit`` matches), nearest first with a ``near`` filter and newest first otherwise.
+
+        Filters: health_grades, risk_grades, species (exact values), near ((lat, lon)) with
+        radius_km, and since/until (Unix times).
+        """
+        where, params = self._where(**filters)
+        near = filters.get("near")
+        distance = "distance_km(trees.lat, trees.lon, ?, ?)" if near else "NULL"
+        order = "distance, trees.analyzed_at DESC" if near else "trees.analyzed_at DESC"
+        with self._connect() as conn:
+            total = conn.execute(f"SELECT COUNT(*) {where}", params).fetchone()[0]
+            rows = conn.execute(
+                f"SELECT trees.id, filename, image_id, job_id, analyzed_at, model, health_grade, risk_grade, species, location, lat, lon, "
+                f"{distance} AS distance {where} ORDER BY {order} LIMIT ?",
+                ([*near] if near else []) + params + [limit],
+            ).fetchall()
+        columns = ["id", "filename", "image_id", "job_id", "analyzed_at", "model", "health_grade", "risk_grade", "species",
+                   "location", "lat", "lon", "distance_km"]
+        return total, [dict(zip(columns, row)) for row in rows]
+
+    def points(self, **filters):
+        """Map points ({"lat", "lon", "place", "species", "filename"}) of every geocoded match."""
+        where, params = self._where(["trees.lat IS NOT NULL"], **filters)
+        with self._connect() as conn:
+            rows = conn.execute(f"SELECT trees.lat, trees.lon, location, species, filename {where}", params).fetchall()
+        return [{"lat": lat, "lon": lon, "place": place, "species": species or "N/A", "filename": filename} for lat, lon, place, species, filename in rows]
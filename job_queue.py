@@ -0,0 +1,435 @@
+"""Background analysis jobs, queued in SQLite and run by one worker process for all sessions.
+
+    python job_queue.py          # started on demand by the dashboard (see start_worker)
+
+A job keeps its photos in its own ImageStore directory and one row per photo. The
+worker runs up to JOB_SLOTS jobs at a time through run_batch_analysis and writes every
+partial and final payload back, so the analysis carries on when the browser tab is
+closed or the script reruns, and any session can attach to the job by its id
+(``?job=<id>``). Cancelling sets a flag per photo that the worker polls. Jobs left
+running by a killed worker are resumed, without their finished photos, by the next one.
+Finished jobs add their trees to the inventory (inventory.py).
+The worker also saves its metrics, cache counters and endpoint status to the queue, so
+the dashboard's diagnostics cover the analyses it no longer runs itself.
+"""
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+
+from image_preprocessing import create_preprocess_pool
+from image_store import ImageStore
+from client_pool import EndpointPool
+from geocoding import Geocoder
+from inventory import TreeInventory
+from metrics import METRICS
+from tree_pipeline import CACHE_DIR, AnalysisCache, run_batch_analysis
+
+JOBS_DIR = os.getenv("TREE_JOBS_DIR", os.path.join(CACHE_DIR, "jobs"))
+# Jobs the worker runs at once; each uses up to its own max_concurrency request threads
+JOB_SLOTS = int(os.getenv("TREE_JOB_SLOTS", "2"))
+# How often the worker looks for new jobs and cancellations
+JOB_POLL_SECONDS = 0.5
+# The worker exits after this long without jobs; the next submit starts it again
+WORKER_IDLE_SECONDS = 300
+# How often a busy worker saves its metrics for the dashboard
+WORKER_STATS_SECONDS = 2.0
+# Finished jobs and their photos are deleted after this long
+JOB_MAX_AGE_SECONDS = 7 * 24 * 3600
+FINISHED_STATUSES = ("done", "cancelled", "failed")
+# The dashboard's endpoint configs, API keys included, for the worker (see start_worker)
+ENDPOINTS_FILE = "endpoints.json"
+# start_worker leaves a just-started worker this long to take the lock before starting another
+WORKER_START_GRACE_SECONDS = 10.0
+# After a worker failed to start, the next start waits this long, doubling per failure up to the max
+WORKER_RESTART_BASE_SECONDS = 15.0
+WORKER_RESTART_MAX_SECONDS = 600.0
+
+class JobQueue:
+    """Jobs and their per-photo results in one SQLite file, shared by the dashboard and the worker."""
+
+    def __init__(self, jobs_dir=JOBS_DIR):
+        self.jobs_dir = jobs_dir
+        self.path = os.path.join(jobs_dir, "jobs.sqlite3")
+        os.makedirs(jobs_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, status TEXT NOT NULL, options TEXT NOT NULL, error TEXT, "
+                "cancel_requested INTEGER NOT NULL DEFAULT 0, created_at REAL NOT NULL, started_at REAL, finished_at REAL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS items ("
+                "job_id TEXT NOT NULL, position INTEGER NOT NULL, filename TEXT NOT NULL, image_id TEXT NOT NULL, "
+                "status TEXT NOT NULL DEFAULT 'pending', payload TEXT, cancel_requested INTEGER NOT NULL DEFAULT 0, "
+                "PRIMARY KEY (job_id, position))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+            conn.execute("CREATE TABLE IF NOT EXISTS worker_stats (id INTEGER PRIMARY KEY CHECK (id = 1), stats TEXT NOT NULL, saved_at REAL NOT NULL)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS worker_starts ("
+                "id INTEGER PRIMARY KEY CHECK (id = 1), attempted_at REAL NOT NULL, failures INTEGER NOT NULL DEFAULT 0, error TEXT)"
+            )
+
+    def _connect(self):
+        # Short-lived connections: the dashboard's sessions and the worker's job threads all use the queue
+        return sqlite3.connect(self.path, timeout=30)
+
+    def image_store(self, job_id):
+        return ImageStore(root=os.path.join(self.jobs_dir, job_id))
+
+    def submit(self, files, options):
+        """Queues (filename, image_bytes) pairs for analysis with run_batch_analysis ``options``; returns the job id.
+
+        ``options``: lang, model, max_concurrency, use_cached, preprocess_options, stream,
+        dedupe_threshold, pack_size.
+        """
+        job_id = uuid.uuid4().hex
+        store = self.image_store(job_id)
+        items = [(job_id, position, filename, store.put(image_bytes)) for position, (filename, image_bytes) in enumerate(files)]
+        with self._connect() as conn:
+            conn.executemany("INSERT INTO items (job_id, position, filename, image_id) VALUES (?, ?, ?, ?)", items)
+            conn.execute(
+                "INSERT INTO jobs (id, status, options, created_at) VALUES (?, 'queued', ?, ?)",
+                (job_id, json.dumps(options), time.time()),
+            )
+        return job_id
+
+    def job(self, job_id):
+        """The job with its options and photo counts by status, or None for unknown ids."""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT status, options, error, cancel_requested, created_at, started_at, finished_at FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            counts = dict(conn.execute("SELECT status, COUNT(*) FROM items WHERE job_id = ? GROUP BY status", (job_id,)).fetchall())
+        return {
+            "id": job_id, "status": row[0], "options": json.loads(row[1]), "error": row[2], "cancel_requested": bool(row[3]),
+            "created_at": row[4], "started_at": row[5], "finished_at": row[6],
+            "total": sum(counts.values()), "done": counts.get("done", 0),
+        }
+
+    def items(self, job_id):
+        """One entry per photo in upload order: position, filename, image_id, status, payload and cancel_requested."""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT position, filename, image_id, status, payload, cancel_requested FROM items WHERE job_id = ? ORDER BY position",
+                (job_id,),
+            ).fetchall()
+        return [{
+            "position": position, "filename": filename, "image_id": image_id, "status": status,
+            "payload": json.loads(payload) if payload else None, "cancel_requested": bool(cancel_requested),
+        } for position, filename, image_id, status, payload, cancel_requested in rows]
+
+    def cancel(self, job_id, position=None):
+        """Cancels one photo of the job, or with ``position=None`` every photo not yet analyzed."""
+        with self._connect() as conn:
+            if position is None:
+                conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ?", (job_id,))
+                conn.execute("UPDATE items SET cancel_requested = 1 WHERE job_id = ? AND status != 'done'", (job_id,))
+            else:
+                conn.execute("UPDATE items SET cancel_requested = 1 WHERE job_id = ? AND position = ?", (job_id, position))
+
+    def worker_stats(self):
+        """The worker's last save_worker_stats() with its ``saved_at`` time, or None before its first save."""
+        with self._connect() as conn:
+            row = conn.execute("SELECT stats, saved_at FROM worker_stats").fetchone()
+        return None if row is None else dict(json.loads(row[0]), saved_at=row[1])
+
+    def worker_start(self):
+        """The last worker start: attempted_at, consecutive failures and the last failure's error; None before the first."""
+        with self._connect() as conn:
+            row = conn.execute("SELECT attempted_at, failures, error FROM worker_starts").fetchone()
+        return None if row is None else {"attempted_at": row[0], "failures": row[1], "error": row[2]}
+
+    def claim_worker_start(self):
+        """Records a worker start attempt and returns True, or False while the last one's grace or backoff period lasts.
+
+        After ``failures`` failed starts in a row the next waits WORKER_RESTART_BASE_SECONDS
+        doubled per further failure, so a worker that cannot start is not respawned on every poll.
+        """
+        last = self.worker_start()
+        now = time.time()
+        if last is not None:
+            wait = WORKER_START_GRACE_SECONDS
+            if last["failures"]:
+                wait = min(WORKER_RESTART_MAX_SECONDS, WORKER_RESTART_BASE_SECONDS * 2 ** (last["failures"] - 1))
+            if now - last["attempted_at"] < wait:
+                return False
+        with self._connect() as conn:
+            if last is None:
+                claimed = conn.execute("INSERT OR IGNORE INTO worker_starts (id, attempted_at) VALUES (1, ?)", (now,)).rowcount
+            else:
+                # Only one of the sessions polling at the same moment wins
+                claimed = conn.execute(
+                    "UPDATE worker_starts SET attempted_at = ? WHERE attempted_at = ?", (now, last["attempted_at"])
+                ).rowcount
+        return claimed == 1
+
+    # --- worker side ---
+    def record_worker_start(self, error=None):
+        """Counts a failed start with its ``error``, or with ``error=None`` resets the failures after a successful one."""
+        with self._connect() as conn:
+            if error is None:
+                conn.execute("UPDATE worker_starts SET failures = 0, error = NULL")
+            else:
+                # A worker started by hand has no start on record yet
+                conn.execute(
+                    "INSERT INTO worker_starts (id, attempted_at, failures, error) VALUES (1, ?, 1, ?) "
+                    "ON CONFLICT (id) DO UPDATE SET failures = failures + 1, error = excluded.error",
+                    (time.time(), error),
+                )
+
+    def fail_queued(self, error):
+        """Marks every queued job as failed with ``error``, e.g. when the worker cannot reach the model."""
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET status = 'failed', error = ?, finished_at = ? WHERE status = 'queued'", (error, time.time()))
+
+    def claim(self):
+        """Marks the oldest queued job as running and returns it, or None when the queue is empty."""
+        with self._connect() as conn:
+            row = conn.execute("SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1").fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE jobs SET status = 'running', started_at = COALESCE(started_at, ?) WHERE id = ?", (time.time(), row[0]))
+        return self.job(row[0])
+
+    def record(self, job_id, position, payload):
+        status = "partial" if payload.get("partial") else "done"
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE items SET status = ?, payload = ? WHERE job_id = ? AND position = ? AND status != 'done'",
+                (status, json.dumps(payload, ensure_ascii=False), job_id, position),
+            )
+
+    def cancelled_positions(self, job_id):
+        with self._connect() as conn:
+            return {row[0] for row in conn.execute("SELECT position FROM items WHERE job_id = ? AND cancel_requested = 1", (job_id,))}
+
+    def finish(self, job_id, error=None):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = CASE WHEN ? IS NOT NULL THEN 'failed' WHEN cancel_requested THEN 'cancelled' ELSE 'done' END, "
+                "error = ?, finished_at = ? WHERE id = ?",
+                (error, error, time.time(), job_id),
+            )
+
+    def save_worker_stats(self, client, cache):
+        """Stores the worker's METRICS dump, analysis cache hits/misses and endpoint status."""
+        cache_stats = cache.stats()
+        stats = {"metrics": METRICS.dump(), "cache": {"hits": cache_stats["hits"], "misses": cache_stats["misses"]}, "endpoints": client.status()}
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO worker_stats (id, stats, saved_at) VALUES (1, ?, ?)", (json.dumps(stats), time.time()))
+
+    def requeue_interrupted(self):
+        """Puts jobs a dead worker left running back in the queue; their finished photos are kept."""
+        with self._connect() as conn:
+            conn.execute("UPDATE items SET status = 'pending', payload = NULL WHERE status = 'partial'")
+            conn.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running'")
+
+    def purge(self, max_age_seconds=JOB_MAX_AGE_SECONDS):
+        """Deletes jobs finished more than ``max_age_seconds`` ago, with their photos."""
+        with self._connect() as conn:
+            job_ids = [row[0] for row in conn.execute(
+                f"SELECT id FROM jobs WHERE status IN ({', '.join('?' * len(FINISHED_STATUSES))}) AND finished_at < ?",
+                (*FINISHED_STATUSES, time.time() - max_age_seconds),
+            )]
+            conn.executemany("DELETE FROM items WHERE job_id = ?", [(job_id,) for job_id in job_ids])
+            conn.executemany("DELETE FROM jobs WHERE id = ?", [(job_id,) for job_id in job_ids])
+        for job_id in job_ids:
+            shutil.rmtree(os.path.join(self.jobs_dir, job_id), ignore_errors=True)
+
+def _try_lock(jobs_dir):
+    """The worker lock file, held exclusively, or None when another worker holds it.
+
+    The lock is released when the file is closed or the process dies.
+    """
+    lock_file = open(os.path.join(jobs_dir, "worker.lock"), "a")
+    try:
+        if os.name == "nt":
+            import msvcrt
+            # msvcrt locks bytes from the current position; byte 0 stands for the whole file
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError: # BlockingIOError from flock, PermissionError from msvcrt
+        lock_file.close()
+        return None
+    return lock_file
+
+def worker_running(jobs_dir=JOBS_DIR):
+    lock_file = _try_lock(jobs_dir)
+    if lock_file is None:
+        return True
+    lock_file.close()
+    return False
+
+def save_endpoints(endpoints, jobs_dir=JOBS_DIR):
+    """Hands the dashboard's endpoint configs to the worker in ENDPOINTS_FILE, readable by its owner only."""
+    # mkstemp creates the file with mode 0600
+    fd, tmp_path = tempfile.mkstemp(dir=jobs_dir, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(endpoints, f)
+    os.replace(tmp_path, os.path.join(jobs_dir, ENDPOINTS_FILE))
+
+def load_worker_endpoints(jobs_dir=JOBS_DIR):
+    """The endpoint configs saved by the dashboard, or else those tree_batch.py would use."""
+    path = os.path.join(jobs_dir, ENDPOINTS_FILE)
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    from tree_batch import load_endpoints
+    return load_endpoints()
+
+def start_worker(jobs_dir=JOBS_DIR, endpoints=None):
+    """Starts the worker process unless one is running; it outlives the session that started it.
+
+    ``endpoints`` are the caller's endpoint configs, saved for the worker (see
+    save_endpoints). Starts are rate-limited through the queue (see claim_worker_start).
+    """
+    os.makedirs(jobs_dir, exist_ok=True)
+    if worker_running(jobs_dir) or not JobQueue(jobs_dir).claim_worker_start():
+        return
+    if endpoints is not None:
+        save_endpoints(endpoints, jobs_dir)
+    with open(os.path.join(jobs_dir, "worker.log"), "a") as log:
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--jobs-dir", jobs_dir],
+            stdin=subprocess.DEVNULL, stdout=log, stderr=log, start_new_session=True,
+        )
+
+def add_to_inventory(queue, job_id, inventory, geocoder):
+    """Adds the analyzed trees of a finished job to the inventory; returns how many were new."""
+    job = queue.job(job_id)
+    results = [item["payload"] for item in queue.items(job_id) if item["status"] == "done"]
+    coordinates = geocoder.geocode_many(result["analysis"].get("location") for result in results if result["analysis"])
+    return inventory.add(results, coordinates, queue.image_store(job_id), job["options"]["lang"], job_id=job_id, analyzed_at=job["finished_at"])
+
+def run_job(queue, job, client, cache, preprocess_pool, inventory=None, geocoder=None):
+    """Analyzes the job's photos that have no final result yet, recording each payload as it arrives.
+
+    The finished job's trees are then added to ``inventory``, placed by ``geocoder``.
+    """
+    options = job["options"]
+    items = [item for item in queue.items(job["id"]) if item["status"] != "done"]
+    images = [(item["filename"], item["image_id"]) for item in items]
+    cancel_events = [threading.Event() for _ in items]
+    stopped = threading.Event()
+
+    def watch_cancellations():
+        while True:
+            cancelled = queue.cancelled_positions(job["id"])
+            for item, event in zip(items, cancel_events):
+                if item["position"] in cancelled:
+                    event.set()
+            if stopped.wait(JOB_POLL_SECONDS):
+                return
+
+    watcher = threading.Thread(target=watch_cancellations, name=f"job-{job['id'][:8]}-cancel", daemon=True)
+    watcher.start()
+    try:
+        batch = run_batch_analysis(
+            client, images, queue.image_store(job["id"]), options["lang"], options["model"], options["max_concurrency"], cancel_events,
+            cache=cache, use_cached=options["use_cached"], preprocess_pool=preprocess_pool,
+            preprocess_options=options["preprocess_options"], stream=options["stream"],
+            dedupe_threshold=options["dedupe_threshold"], pack_size=options["pack_size"]
+        )
+        with METRICS.timer("batch", images=len(images), pack_size=options["pack_size"], model=options["model"]):
+            for i, payload in batch:
+                queue.record(job["id"], items[i]["position"], payload)
+        queue.finish(job["id"])
+    except Exception as e:
+        traceback.print_exc()
+        queue.finish(job["id"], error=f"{type(e).__name__}: {e}")
+    finally:
+        stopped.set()
+    try:
+        if inventory is not None:
+            with METRICS.timer("inventory_add"):
+                add_to_inventory(queue, job["id"], inventory, geocoder)
+    except Exception:
+        traceback.print_exc() # The results stay in the queue; only the inventory misses them
+    finally:
+        METRICS.flush()
+        queue.save_worker_stats(client, cache)
+
+def run_worker(jobs_dir=JOBS_DIR, slots=JOB_SLOTS, idle_seconds=WORKER_IDLE_SECONDS):
+    """Runs queued jobs, up to ``slots`` at a time, until the queue has been empty for ``idle_seconds``.
+
+    Without usable endpoint configs the queued jobs fail with the error and the worker exits with 1.
+    """
+    lock_file = _try_lock(jobs_dir)
+    if lock_file is None:
+        return 0 # Another worker already serves the queue
+    queue = JobQueue(jobs_dir)
+    queue.requeue_interrupted()
+    queue.purge()
+    try:
+        client = EndpointPool(load_worker_endpoints(jobs_dir))
+    except (Exception, SystemExit) as e:
+        # load_endpoints exits when credentials are missing; the jobs would otherwise wait forever
+        traceback.print_exc()
+        error = str(e) if isinstance(e, SystemExit) else f"{type(e).__name__}: {e}"
+        queue.record_worker_start(error)
+        queue.fail_queued(error)
+        lock_file.close()
+        return 1
+    queue.record_worker_start()
+    if METRICS.textfile_path:
+        # Next to the dashboard's export instead of overwriting it
+        METRICS.textfile_path = os.path.splitext(METRICS.textfile_path)[0] + ".worker.prom"
+    cache = AnalysisCache(os.path.join(CACHE_DIR, "analysis_cache.sqlite3"))
+    inventory = TreeInventory()
+    geocoder = Geocoder()
+    # Forked pool workers would inherit the lock and keep it held after a worker crash
+    preprocess_pool = create_preprocess_pool(start_method="forkserver")
+    running = {}
+    idle_since = time.monotonic()
+    stats_saved = 0.0
+    try:
+        while True:
+            for job_id in [job_id for job_id, thread in running.items() if not thread.is_alive()]:
+                del running[job_id]
+            while len(running) < slots:
+                job = queue.claim()
+                if job is None:
+                    break
+                thread = threading.Thread(target=run_job, args=(queue, job, client, cache, preprocess_pool, inventory, geocoder), name=f"job-{job['id'][:8]}")
+                thread.start()
+                running[job["id"]] = thread
+            if running:
+                idle_since = time.monotonic()
+                if idle_since - stats_saved >= WORKER_STATS_SECONDS:
+                    queue.save_worker_stats(client, cache)
+                    stats_saved = idle_since
+            elif time.monotonic() - idle_since > idle_seconds:
+                queue.purge()
+                return 0
+            time.sleep(JOB_POLL_SECONDS)
+    finally:
+        if preprocess_pool is not None:
+            preprocess_pool.shutdown(cancel_futures=True)
+        lock_file.close()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--jobs-dir", default=JOBS_DIR, help="Queue directory shared with the dashboard (default: %(default)s)")
+    parser.add_argument("--slots", type=int, default=JOB_SLOTS, help="Jobs run at once (default: %(default)s)")
+    parser.add_argument("--idle-seconds", type=float, default=WORKER_IDLE_SECONDS, help="Exit after this long without jobs (default: %(default)s)")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    sys.exit(run_worker(args.jobs_dir, args.slots, args.idle_seconds))
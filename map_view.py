@@ -0,0 +1,196 @@
+"""Map of photographed locations and native origins that stays light for thousands of trees.
+
+Geocoded places repeat (every tree photographed in Bonn gets Bonn's coordinates), so
+points are first merged per distinct coordinate. Beyond MAP_MAX_POINTS distinct
+positions, nearby ones are clustered on a grid that is coarsened until the limit
+holds. Each drawn point carries only short, rounded fields; circle sizes are in
+pixels so they stay readable at every zoom level, and only the MAP_MAX_LABELS
+largest points get a text label.
+"""
+import math
+
+# ~1 m; more precision only makes the JSON sent to the browser longer
+MAP_COORDINATE_DECIMALS = 5
+# Distinct positions drawn per layer before nearby ones are clustered
+MAP_MAX_POINTS = 500
+MAP_MAX_LABELS = 30
+# Trees listed in a point's tooltip
+MAP_TOOLTIP_TREES = 5
+# Starting grid cell of the clustering, in degrees (~100 m)
+MAP_CLUSTER_CELL_DEGREES = 0.001
+MAP_MAX_ZOOM = 11
+
+def aggregate_points(points):
+    """Merges points ({"lat", "lon", "place", "species", "filename"}) per distinct coordinate.
+
+    Returns one entry per position, largest first: {"lon", "lat", "n", "places", "trees"}
+    where ``places`` counts the trees per place name and ``trees`` lists the first
+    MAP_TOOLTIP_TREES (filename, species) pairs.
+    """
+    merged = {}
+    for point in points:
+        key = (round(point["lon"], MAP_COORDINATE_DECIMALS), round(point["lat"], MAP_COORDINATE_DECIMALS))
+        entry = merged.get(key)
+        if entry is None:
+            entry = merged[key] = {"lon": key[0], "lat": key[1], "n": 0, "places": {}, "trees": []}
+        entry["n"] += 1
+        entry["places"][point["place"]] = entry["places"].get(point["place"], 0) + 1
+        if len(entry["trees"]) < MAP_TOOLTIP_TREES:
+            entry["trees"].append((point["filename"], point["species"]))
+    return sorted(merged.values(), key=lambda entry: -entry["n"])
+
+def cluster_points(entries, max_points=MAP_MAX_POINTS):
+    """Merges aggregated entries on a lon/lat grid, doubling the cell until at most ``max_points`` remain.
+
+    A cluster sits at the tree-weighted mean of its members.
+    """
+    cell = MAP_CLUSTER_CELL_DEGREES
+    clusters = entries
+    while len(clusters) > max_points and cell <= 360:
+        grid = {}
+        for entry in entries:
+            grid.setdefault((math.floor(entry["lon"] / cell), math.floor(entry["lat"] / cell)), []).append(entry)
+        clusters = []
+        for members in grid.values():
+            n = sum(member["n"] for member in members)
+            places, trees = {}, []
+            for member in members:
+                for place, count in member["places"].items():
+                    places[place] = places.get(place, 0) + count
+                trees.extend(member["trees"][:MAP_TOOLTIP_TREES - len(trees)])
+            clusters.append({
+                "lon": round(sum(member["lon"] * member["n"] for member in members) / n, MAP_COORDINATE_DECIMALS),
+                "lat": round(sum(member["lat"] * member["n"] for member in members) / n, MAP_COORDINATE_DECIMALS),
+                "n": n, "places": places, "trees": trees,
+            })
+        clusters.sort(key=lambda entry: -entry["n"])
+        cell *= 2
+    return clusters
+
+def point_label(entry):
+    place = max(entry["places"], key=entry["places"].get)
+    more = len(entry["places"]) - 1
+    return (f"{place} +{more}" if more else place) + (f" ({entry['n']})" if entry["n"] > 1 else "")
+
+def point_tooltip(entry, title):
+    lines = [f"<b>{title}</b>", point_label(entry)]
+    lines += [f"File: {filename}<br>Species: {species}" for filename, species in entry["trees"]]
+    if entry["n"] > len(entry["trees"]):
+        lines.append(f"… {entry['n'] - len(entry['trees'])} more")
+    return "<br>".join(lines)
+
+def layer_rows(entries, title):
+    """The columns each drawn point needs: position, pixel radius and tooltip."""
+    return [{
+        "lon": entry["lon"], "lat": entry["lat"], "r": round(min(30, 4 + 2 * math.sqrt(entry["n"])), 1),
+        "tooltip": point_tooltip(entry, title),
+    } for entry in entries]
+
+def fit_view(entries):
+    """View state framing the entries (the whole world when there are none)."""
+    import pydeck as pdk
+    if not entries:
+        return pdk.ViewState(latitude=30, longitude=0, zoom=1, pitch=0)
+    lons = [entry["lon"] for entry in entries]
+    lats = [entry["lat"] for entry in entries]
+    span = max(max(lons) - min(lons), (max(lats) - min(lats)) * 2, 1e-6)
+    zoom = max(1, min(MAP_MAX_ZOOM, math.log2(360 / span)))
+    return pdk.ViewState(latitude=(min(lats) + max(lats)) / 2, longitude=(min(lons) + max(lons)) / 2, zoom=zoom, pitch=0)
+
+def build_map_deck(location_points, origin_points):
+    """The pydeck map of photographed locations (red, labelled) and native origins (green), or None without points."""
+    import pandas as pd
+    import pydeck as pdk
+    locations = cluster_points(aggregate_points(location_points))
+    origins = cluster_points(aggregate_points(origin_points))
+    map_layers = []
+    if locations:
+        map_layers.append(pdk.Layer(
+            'ScatterplotLayer', data=pd.DataFrame(layer_rows(locations, "Photographed Location")), get_position='[lon, lat]',
+            get_color='[200, 30, 0, 160]', get_radius='r', radius_units='pixels', pickable=True
+        ))
+        map_layers.append(pdk.Layer(
+            'TextLayer', data=pd.DataFrame([
+                {"lon": entry["lon"], "lat": entry["lat"], "label": point_label(entry)} for entry in locations[:MAP_MAX_LABELS]
+            ]), get_position='[lon, lat]', get_text='label',
+            get_size=15, get_color='[255, 255, 255, 200]', get_angle=0,
+            get_text_anchor='"middle"', get_alignment_baseline='"bottom"', character_set='auto'
+        ))
+
+    if origins:
+        map_layers.append(pdk.Layer(
+            'ScatterplotLayer', data=pd.DataFrame(layer_rows(origins, "Native Origin")), get_position='[lon, lat]',
+            get_color='[30, 200, 0, 160]', get_radius='r * 0.6', radius_units='pixels', pickable=True # Green, smaller radius
+        ))
+
+    if not map_layers:
+        return None
+    return pdk.Deck(
+        map_style='https://basemaps.cartocdn.com/gl/voyager-gl-style/style.json',
+        # Framed on where the photos were taken; origins span continents
+        initial_view_state=fit_view(locations or origins),
+        layers=map_layers,
+        tooltip={"html": "{tooltip}", "style": {"color": "white"}}
+    )
+
+def graticule_step(span):
+    """Spacing in degrees of the grid lines drawn across ``span`` degrees (about four to eight lines)."""
+    for step in (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 30, 60):
+        if span / step <= 8:
+            return step
+    return 90
+
+def render_map_image(location_points, origin_points, width=1600, height=1000, font_path=None):
+    """PNG of the same points as build_map_deck, for reports: no basemap, just a lat/lon grid.
+
+    Framed on the photographed locations like the dashboard map (on the origins when
+    there are none); ``font_path`` is a TrueType font for the labels.
+    """
+    import io
+    from PIL import Image, ImageDraw, ImageFont
+    locations = cluster_points(aggregate_points(location_points))
+    origins = cluster_points(aggregate_points(origin_points))
+    framed = locations or origins
+    if framed:
+        lons = [entry["lon"] for entry in framed]
+        lats = [entry["lat"] for entry in framed]
+        center_lat = (min(lats) + max(lats)) / 2
+        x_scale = max(0.2, math.cos(math.radians(center_lat)))
+        # Degrees per pixel, so the frame holds every point with a margin and x/y keep the same ground scale
+        scale = max((max(lons) - min(lons)) * x_scale / (width * 0.8), (max(lats) - min(lats)) / (height * 0.8), 1e-5)
+        center_lon = (min(lons) + max(lons)) / 2
+    else:
+        center_lat, center_lon, x_scale, scale = 0, 0, 1, 360 / width
+
+    def project(lon, lat):
+        return width / 2 + (lon - center_lon) * x_scale / scale, height / 2 - (lat - center_lat) / scale
+
+    image = Image.new("RGB", (width, height), (236, 240, 236))
+    draw = ImageDraw.Draw(image, "RGBA")
+    font = ImageFont.truetype(font_path, 18) if font_path else ImageFont.load_default(18)
+    lon_span, lat_span = width * scale / x_scale, height * scale
+    for axis, center, span in (("lon", center_lon, lon_span), ("lat", center_lat, lat_span)):
+        step = graticule_step(span)
+        value = math.floor((center - span / 2) / step) * step
+        while value <= center + span / 2:
+            if axis == "lon":
+                x = project(value, center_lat)[0]
+                draw.line([(x, 0), (x, height)], fill=(200, 206, 200), width=1)
+                draw.text((x + 4, height - 24), f"{value:g}°", fill=(120, 128, 120), font=font)
+            else:
+                y = project(center_lon, value)[1]
+                draw.line([(0, y), (width, y)], fill=(200, 206, 200), width=1)
+                draw.text((4, y + 2), f"{value:g}°", fill=(120, 128, 120), font=font)
+            value += step
+
+    for entries, color, factor in ((origins, (30, 200, 0, 160), 0.6), (locations, (200, 30, 0, 160), 1.0)):
+        for row in layer_rows(entries, ""):
+            x, y = project(row["lon"], row["lat"])
+            radius = row["r"] * factor * 1.5
+            draw.ellipse([x - radius, y - radius, x + radius, y + radius], fill=color)
+    for entry in locations[:MAP_MAX_LABELS]:
+        x, y = project(entry["lon"], entry["lat"])
+        draw.text((x, y - 14), point_label(entry), fill=(40, 40, 40), font=font, anchor="mb")
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
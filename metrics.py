@@ -0,0 +1,193 @@
+"""Process-wide performance metrics for the analysis pipeline.
+
+Stages are timed with ``METRICS.timer("stage")`` and events counted with
+``METRICS.incr``. Everything can be exported in the Prometheus text format
+(``TREE_METRICS_TEXTFILE`` is rewritten on flush, for node_exporter's textfile
+collector) and every timed stage is appended as one JSON line to
+``TREE_METRICS_LOG`` when that is set.
+"""
+import bisect
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+METRICS_PREFIX = "tree_health"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# Recent samples kept per stage for the p50/p95 shown in the dashboard
+SAMPLE_WINDOW = 1000
+COUNTER_HELP = {
+    "images_total": "Images finished, by result (ok, error, no_tree, cancelled, cached, duplicate).",
+    "tokens_total": "Tokens reported in response.usage, by kind and model.",
+    "retries_total": "Model requests retried after a transient error, by error type.",
+    "cache_requests_total": "Cache lookups, by cache and result (hit, miss).",
+    "analysis_images_total": "Photos sent in completed analysis requests, by model and photos per request (pack_size).",
+    "analysis_prompt_tokens_total": "Prompt tokens of analysis requests, by model and photos per request (pack_size).",
+    "endpoint_requests_total": "Requests sent per Azure OpenAI endpoint, by result (ok or error type).",
+    "reply_repairs_total": "Analysis replies recovered locally or by a follow-up, by kind (extracted, continuation, salvaged).",
+    "cascade_escalations_total": "Cascade triage results re-analyzed by the large model, by reason (grade, risk, error).",
+    "pack_fallbacks_total": "Packed requests whose photos fell back to one request each, by model and reason (cancelled or error type).",
+}
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + "}"
+
+def _percentile(sorted_samples, fraction):
+    if not sorted_samples:
+        return None
+    return sorted_samples[min(len(sorted_samples) - 1, int(fraction * len(sorted_samples)))]
+
+def _new_stage():
+    return {"count": 0, "sum": 0.0, "buckets": [0] * len(LATENCY_BUCKETS), "samples": deque(maxlen=SAMPLE_WINDOW)}
+
+class Metrics:
+    """Thread-safe stage histograms and labelled counters."""
+
+    def __init__(self, log_path=None, textfile_path=None):
+        self.log_path = log_path
+        self.textfile_path = textfile_path
+        self._lock = threading.Lock()
+        self._log_file = None
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._stages = {}
+            self._counters = {}
+
+    @contextmanager
+    def timer(self, stage, **fields):
+        """Times the enclosed block as ``stage``; failures are recorded with status "error"."""
+        start = time.perf_counter()
+        status = "ok"
+        try:
+            yield
+        except BaseException:
+            status = "error"
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - start, status=status, **fields)
+
+    def observe(self, stage, seconds, **fields):
+        with self._lock:
+            data = self._stages.get(stage)
+            if data is None:
+                data = self._stages[stage] = _new_stage()
+            data["count"] += 1
+            data["sum"] += seconds
+            bucket = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+            if bucket < len(LATENCY_BUCKETS):
+                data["buckets"][bucket] += 1
+            data["samples"].append(seconds)
+            if self.log_path:
+                self._log({"ts": time.time(), "event": "stage", "stage": stage, "seconds": round(seconds, 6), **fields})
+
+    def incr(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def record_usage(self, usage, model):
+        """Counts the tokens of a ``response.usage`` object (ignored when the response had none)."""
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        self.incr("tokens_total", usage.prompt_tokens or 0, kind="prompt", model=model)
+        self.incr("tokens_total", usage.completion_tokens or 0, kind="completion", model=model)
+        self.incr("tokens_total", getattr(details, "cached_tokens", None) or 0, kind="cached", model=model)
+
+    def counter(self, name, **labels):
+        """Sum of counter ``name`` over all label sets matching ``labels``."""
+        with self._lock:
+            return sum(
+                value for (key, key_labels), value in self._counters.items()
+                if key == name and all(dict(key_labels).get(k) == v for k, v in labels.items())
+            )
+
+    def snapshot(self):
+        """Plain-dict view of all metrics, with p50/p95 over the recent samples of each stage."""
+        with self._lock:
+            stages = {}
+            for stage, data in self._stages.items():
+                samples = sorted(data["samples"])
+                stages[stage] = {
+                    "count": data["count"], "total_seconds": data["sum"],
+                    "p50_seconds": _percentile(samples, 0.5), "p95_seconds": _percentile(samples, 0.95),
+                    "max_seconds": samples[-1] if samples else None,
+                }
+            counters = [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in self._counters.items()]
+        return {"stages": stages, "counters": counters}
+
+    def dump(self):
+        """JSON-serialisable copy of the raw histograms and counters, for merge() in another process."""
+        with self._lock:
+            stages = {
+                stage: {"count": data["count"], "sum": data["sum"], "buckets": list(data["buckets"]), "samples": list(data["samples"])}
+                for stage, data in self._stages.items()
+            }
+            counters = [[name, [list(label) for label in labels], value] for (name, labels), value in self._counters.items()]
+        return {"stages": stages, "counters": counters}
+
+    def merge(self, dumped):
+        """Adds the histograms and counters of a dump() (e.g. the job worker's) to this instance."""
+        with self._lock:
+            for stage, other in dumped["stages"].items():
+                data = self._stages.get(stage)
+                if data is None:
+                    data = self._stages[stage] = _new_stage()
+                data["count"] += other["count"]
+                data["sum"] += other["sum"]
+                data["buckets"] = [a + b for a, b in zip(data["buckets"], other["buckets"])]
+                data["samples"].extend(other["samples"])
+            for name, labels, value in dumped["counters"]:
+                key = (name, tuple(tuple(label) for label in labels))
+                self._counters[key] = self._counters.get(key, 0) + value
+
+    def export_prometheus(self):
+        with self._lock:
+            stages = {stage: (data["count"], data["sum"], list(data["buckets"])) for stage, data in self._stages.items()}
+            counters = dict(self._counters)
+        lines = [
+            f"# HELP {METRICS_PREFIX}_stage_seconds Time spent per pipeline stage.",
+            f"# TYPE {METRICS_PREFIX}_stage_seconds histogram",
+        ]
+        for stage, (count, total, buckets) in sorted(stages.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(LATENCY_BUCKETS, buckets):
+                cumulative += bucket_count
+                lines.append(f"{METRICS_PREFIX}_stage_seconds_bucket{_format_labels({'stage': stage, 'le': repr(bound)})} {cumulative}")
+            lines.append(f"{METRICS_PREFIX}_stage_seconds_bucket{_format_labels({'stage': stage, 'le': '+Inf'})} {count}")
+            lines.append(f"{METRICS_PREFIX}_stage_seconds_sum{_format_labels({'stage': stage})} {total}")
+            lines.append(f"{METRICS_PREFIX}_stage_seconds_count{_format_labels({'stage': stage})} {count}")
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# HELP {METRICS_PREFIX}_{name} {COUNTER_HELP.get(name, name)}")
+            lines.append(f"# TYPE {METRICS_PREFIX}_{name} counter")
+            for (key, labels), value in sorted(counters.items()):
+                if key == name:
+                    lines.append(f"{METRICS_PREFIX}_{name}{_format_labels(dict(labels))} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        """Atomically writes the Prometheus export to ``path``."""
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(self.export_prometheus())
+        os.replace(temp_path, path)
+
+    def flush(self):
+        """Refreshes the textfile export, if configured."""
+        if self.textfile_path:
+            self.write_textfile(self.textfile_path)
+
+    def _log(self, record):
+        # Called with self._lock held
+        if self._log_file is None:
+            self._log_file = open(self.log_path, "a", encoding="utf-8", buffering=1)
+        self._log_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+METRICS = Metrics(log_path=os.getenv("TREE_METRICS_LOG"), textfile_path=os.getenv("TREE_METRICS_TEXTFILE"))
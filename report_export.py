@@ -0,0 +1,194 @@
+"""PDF inspection reports and XLSX inventories of a batch, written one tree at a time.
+
+Only thumbnails are embedded and each is read when its tree is written, so memory grows
+with the thumbnails (a few KB per tree), not with the uploads. The XLSX is written in
+openpyxl's write-only mode. fpdf2 cannot stream: the whole document stays in memory
+until it is written, so the PDF's peak memory does grow with the batch, by roughly the
+size of the finished file (about 3 MB per 1,000 trees) on top of some 45 MB for fonts
+and the map, as measured with tracemalloc.
+"""
+import io
+import os
+from datetime import datetime
+
+from map_view import render_map_image
+from translations import get_text
+from tree_pipeline import get_grade_details, get_risk_grade_details
+
+# Unicode fonts for the PDF and the map labels, first found wins (TREE_REPORT_FONT overrides).
+# DejaVu covers English and German; Chinese also needs one of the CJK fonts, used as fallback
+REPORT_FONTS = [
+    (os.getenv("TREE_REPORT_FONT"), os.getenv("TREE_REPORT_FONT_BOLD")),
+    ("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"),
+    ("/Library/Fonts/Arial Unicode.ttf", None),
+    ("C:/Windows/Fonts/arial.ttf", "C:/Windows/Fonts/arialbd.ttf"),
+]
+CJK_FONTS = [
+    os.getenv("TREE_REPORT_CJK_FONT"),
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/truetype/wqy/wqy-microhei.ttc",
+    "/System/Library/Fonts/PingFang.ttc",
+    "C:/Windows/Fonts/msyh.ttc",
+]
+# Thumbnail width in the PDF (mm) and the XLSX (px)
+PDF_THUMBNAIL_MM = 32
+XLSX_THUMBNAIL_PX = 80
+
+def find_fonts():
+    """(regular, bold, cjk) font paths; None where no such font is installed."""
+    regular, bold = next(((regular, bold) for regular, bold in REPORT_FONTS if regular and os.path.exists(regular)), (None, None))
+    cjk = next((path for path in CJK_FONTS if path and os.path.exists(path)), None)
+    return regular, bold if bold and os.path.exists(bold) else regular, cjk
+
+def report_fields(result, lang):
+    """(label, value) pairs of one tree, in report and inventory column order; failed photos only have the error."""
+    res = result["analysis"] or {}
+    risk = res.get("risk_assessment") or {}
+    felling = res.get("felling_recommendations") or {}
+    safety = felling.get("safety_parameters") or {}
+    missing = "N/A" if res else ""
+    grade = res.get("health_grade")
+    risk_grade = risk.get("infection_and_hazard_potential_grade")
+    return [
+        (get_text(lang, "health_grade"), f"{grade} ({get_grade_details(grade)['desc']})" if grade else missing),
+        (get_text(lang, "risk_grade"), get_risk_grade_details(risk_grade, lang)["desc"] if res else ""),
+        (get_text(lang, "tree_type"), res.get("tree_type", missing)),
+        (get_text(lang, "approx_age"), res.get("approximate_age", missing)),
+        (get_text(lang, "location"), res.get("location", missing)),
+        (get_text(lang, "native_origins"), ", ".join(res.get("native_origins") or []) or missing),
+        (get_text(lang, "report_disease"), res.get("disease_identification", missing)),
+        (get_text(lang, "felling_method"), felling.get("recommended_method", missing)),
+        (get_text(lang, "report_safety_distance"), safety.get("minimum_safety_distance_meters", "")),
+        (get_text(lang, "report_personnel"), safety.get("required_personnel", "")),
+        (get_text(lang, "report_equipment"), safety.get("required_equipment", "")),
+        (get_text(lang, "report_infection_risk"), risk.get("infectious_risk_summary", "")),
+        (get_text(lang, "report_structural_risk"), risk.get("structural_stability_summary", "")),
+        (get_text(lang, "report_failure_consequence"), risk.get("consequence_of_failure_summary", "")),
+        (get_text(lang, "observations"), res.get("detailed_observations", "")),
+        (get_text(lang, "rehab_advice"), res.get("rehabilitation_advice", "")),
+        (get_text(lang, "report_model"), result.get("model") or ""),
+        (get_text(lang, "report_error"), "" if res else result.get("error") or ""),
+    ]
+
+def write_xlsx(path, results, lang, image_store, location_points=(), origin_points=()):
+    """Writes the inventory sheet (one row per photo, with its thumbnail) and a map sheet."""
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.drawing.image import Image
+    from openpyxl.styles import Alignment, Font
+    from openpyxl.utils import get_column_letter
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(get_text(lang, "report_inventory_sheet"))
+    columns = [get_text(lang, "summary_filename"), get_text(lang, "report_photo")] + [
+        label for label, _ in report_fields({"analysis": None}, lang)
+    ]
+    for index, label in enumerate(columns, start=1):
+        sheet.column_dimensions[get_column_letter(index)].width = 14 if index == 2 else min(60, max(14, len(label) + 4))
+    sheet.freeze_panes = "C2"
+    header = []
+    for label in columns:
+        cell = WriteOnlyCell(sheet, value=label)
+        cell.font = Font(bold=True)
+        header.append(cell)
+    sheet.append(header)
+    wrap = Alignment(wrap_text=True, vertical="top")
+    for row_number, result in enumerate(results, start=2):
+        # Row heights are written with the row, so they are set just before it
+        sheet.row_dimensions[row_number].height = XLSX_THUMBNAIL_PX * 0.75 + 6
+        values = [result.get("filename", ""), None] + [value for _, value in report_fields(result, lang)]
+        row = []
+        for value in values:
+            cell = WriteOnlyCell(sheet, value=value)
+            cell.alignment = wrap
+            row.append(cell)
+        sheet.append(row)
+        with open(image_store.path(result["image_id"], "thumbnail"), "rb") as f:
+            thumbnail = Image(io.BytesIO(f.read()))
+        thumbnail.height = round(thumbnail.height * XLSX_THUMBNAIL_PX / thumbnail.width)
+        thumbnail.width = XLSX_THUMBNAIL_PX
+        sheet.add_image(thumbnail, f"B{row_number}")
+
+    map_sheet = workbook.create_sheet(get_text(lang, "report_map_sheet"))
+    map_sheet.append([get_text(lang, "map_header")])
+    map_image = Image(io.BytesIO(render_map_image(location_points, origin_points, font_path=find_fonts()[0])))
+    map_image.width, map_image.height = map_image.width // 2, map_image.height // 2
+    map_sheet.add_image(map_image, "A2")
+    workbook.save(path)
+
+def write_pdf(path, results, lang, image_store, location_points=(), origin_points=()):
+    """Writes the inspection report: grade counts and the map, then one section per photo.
+
+    Raises RuntimeError, with a message in ``lang``, for a Chinese report without a CJK font.
+    """
+    from fpdf import FPDF
+
+    regular, bold, cjk = find_fonts()
+    if lang == "中文" and not cjk:
+        # Without one every Chinese character would come out as a missing glyph
+        raise RuntimeError(get_text(lang, "export_no_cjk_font"))
+    pdf = FPDF(format="A4")
+    pdf.set_auto_page_break(True, margin=15)
+    pdf.set_title(get_text(lang, "report_title"))
+    if regular:
+        pdf.add_font("report", "", regular)
+        pdf.add_font("report", "B", bold)
+        family = "report"
+        if cjk:
+            pdf.add_font("report-cjk", "", cjk)
+            pdf.add_font("report-cjk", "B", cjk)
+            pdf.set_fallback_fonts(["report-cjk"], exact_match=False)
+    else:
+        family = "helvetica"
+    # Chinese has no spaces to break lines at
+    wrapmode = "CHAR" if lang == "中文" else "WORD"
+
+    def text(value):
+        # The built-in font only covers Latin-1
+        return str(value) if regular else str(value).encode("latin-1", "replace").decode("latin-1")
+
+    pdf.add_page()
+    pdf.set_font(family, "B", 18)
+    pdf.cell(text=text(get_text(lang, "report_title")), new_x="LMARGIN", new_y="NEXT")
+    pdf.set_font(family, "", 10)
+    pdf.cell(text=text(get_text(lang, "report_generated").format(
+        date=datetime.now().strftime("%Y-%m-%d %H:%M"), count=len(results)
+    )), new_x="LMARGIN", new_y="NEXT")
+    pdf.ln(4)
+
+    health_counts, risk_counts = {}, {}
+    for result in results:
+        if result["analysis"]:
+            grade = result["analysis"].get("health_grade", "N/A")
+            risk = get_risk_grade_details((result["analysis"].get("risk_assessment") or {}).get("infection_and_hazard_potential_grade"), lang)["desc"]
+            health_counts[grade] = health_counts.get(grade, 0) + 1
+            risk_counts[risk] = risk_counts.get(risk, 0) + 1
+    for label, counts in ((get_text(lang, "health_grade"), health_counts), (get_text(lang, "risk_grade"), risk_counts)):
+        pdf.multi_cell(pdf.epw, 6, text(f"**{label}:** " + " · ".join(f"{key}: {count}" for key, count in sorted(counts.items()))),
+                       markdown=True, new_x="LMARGIN", new_y="NEXT")
+    pdf.ln(4)
+    pdf.set_font(family, "B", 12)
+    pdf.cell(text=text(get_text(lang, "map_header")), new_x="LMARGIN", new_y="NEXT")
+    pdf.image(io.BytesIO(render_map_image(location_points, origin_points, font_path=regular)), w=pdf.epw)
+
+    text_x = pdf.l_margin + PDF_THUMBNAIL_MM + 4
+    text_width = pdf.epw - PDF_THUMBNAIL_MM - 4
+    pdf.add_page()
+    for i, result in enumerate(results):
+        if pdf.get_y() > pdf.h - 60:
+            # Keep a tree's heading and photo together
+            pdf.add_page()
+        top = pdf.get_y()
+        info = pdf.image(image_store.path(result["image_id"], "thumbnail"), x=pdf.l_margin, y=top, w=PDF_THUMBNAIL_MM)
+        pdf.set_xy(text_x, top)
+        pdf.set_font(family, "B", 12)
+        pdf.multi_cell(text_width, 6, text(f"{i + 1}. {result.get('filename', '')}"), new_x="LEFT", new_y="NEXT", wrapmode=wrapmode)
+        pdf.set_font(family, "", 9)
+        for label, value in report_fields(result, lang):
+            if value:
+                pdf.set_x(text_x)
+                pdf.multi_cell(text_width, 4.5, text(f"**{label}:** {value}"), markdown=True, new_x="LEFT", new_y="NEXT", wrapmode=wrapmode)
+        pdf.set_y(max(pdf.get_y(), top + info.rendered_height) + 3)
+        pdf.line(pdf.l_margin, pdf.get_y(), pdf.l_margin + pdf.epw, pdf.get_y())
+        pdf.ln(3)
+    pdf.output(path)
@@ -0,0 +1,15 @@
+import os
+import sys
+
+import pytest
+
+# The modules live at the repository root and are run as scripts, not installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metrics import METRICS
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    METRICS.reset()
+    yield
+    METRICS.reset()
@@ -0,0 +1,125 @@
+"""In-process stand-ins shared by the tests: an OpenAI client answering from a script, and photos.
+
+FakeOpenAI plays the part benchmarks/mock_services.py plays for the benchmarks, without
+the HTTP server: ``reply(request)`` decides each answer. Photos get a distinct width per
+number, so a reply can tell which photos a request holds (request_photos).
+"""
+import base64
+import io
+import json
+import random
+import threading
+import time
+import types
+
+import httpx
+from PIL import Image
+
+from image_store import ImageStore
+
+LANG = "English"
+
+def tree_analysis(**fields):
+    """A complete analysis as the model returns it under the response schema."""
+    analysis = {
+        "no_tree": False, "tree_type": "Pedunculate Oak (Quercus robur)", "health_grade": "B", "health_status": "Healthy",
+        "is_diseased": False, "approximate_age": "60 years", "location": "Bonn, Germany", "native_origins": ["Europe"],
+        "disease_identification": "None",
+        "risk_assessment": {
+            "infection_and_hazard_potential_grade": "Low", "infectious_risk_summary": "Low risk of spreading.",
+            "structural_stability_summary": "Root plate intact.", "consequence_of_failure_summary": "Footpath nearby.",
+        },
+        "felling_recommendations": {"recommended_method": "Standard Felling", "safety_parameters": {
+            "minimum_safety_distance_meters": "30", "required_personnel": "2 arborists", "required_equipment": "Chainsaw"}},
+        "detailed_observations": "Leaves show normal colour.", "rehabilitation_advice": "Mulch the root zone.",
+    }
+    analysis.update(fields)
+    return analysis
+
+def api_error(error_class, status, headers=None):
+    response = httpx.Response(status, headers=headers, request=httpx.Request("POST", "https://example.invalid/chat/completions"))
+    return error_class(f"HTTP {status}", response=response, body=None)
+
+class FakeStream:
+    """The chunks of a streamed completion: the text in pieces, the finish reason, then the usage."""
+
+    def __init__(self, text, finish_reason, usage, piece=16, chunk_seconds=0):
+        chunk = lambda content=None, finish_reason=None: types.SimpleNamespace(
+            choices=[types.SimpleNamespace(delta=types.SimpleNamespace(content=content), finish_reason=finish_reason)], usage=None
+        )
+        self.chunks = [chunk(text[start:start + piece]) for start in range(0, len(text or ""), piece)]
+        self.chunks += [chunk(finish_reason=finish_reason), types.SimpleNamespace(choices=[], usage=usage)]
+        self.chunk_seconds = chunk_seconds
+        self.closed = False
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            time.sleep(self.chunk_seconds)
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+class FakeOpenAI:
+    """Stands in for an OpenAI client: records chat completion requests and answers them with ``reply(request)``.
+
+    ``reply`` returns the reply text, a (text, finish_reason) pair or an exception to raise;
+    by default every request gets tree_analysis(). Streamed requests get a FakeStream that
+    delivers a chunk every ``chunk_seconds``.
+    """
+
+    def __init__(self, reply=None, chunk_seconds=0):
+        self.reply = reply or (lambda request: json.dumps(tree_analysis()))
+        self.chunk_seconds = chunk_seconds
+        self.requests = []
+        self._lock = threading.Lock()
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self.create))
+
+    def create(self, **request):
+        with self._lock:
+            self.requests.append(request)
+        outcome = self.reply(request)
+        if isinstance(outcome, BaseException):
+            raise outcome
+        text, finish_reason = outcome if isinstance(outcome, tuple) else (outcome, "stop")
+        usage = types.SimpleNamespace(prompt_tokens=100 * max(1, len(request_photos(request))), completion_tokens=len(text or "") // 4)
+        if request.get("stream"):
+            return FakeStream(text, finish_reason, usage, chunk_seconds=self.chunk_seconds)
+        choice = types.SimpleNamespace(message=types.SimpleNamespace(content=text), finish_reason=finish_reason)
+        return types.SimpleNamespace(choices=[choice], usage=usage)
+
+    def models(self):
+        return [request["model"] for request in self.requests]
+
+PHOTO_HEIGHT = 120
+
+def photo(number, pattern=None, brightness=0, quality=90):
+    """JPEG bytes of photo ``number``: a coarse random pattern (seeded by ``pattern``, default
+    ``number``) that gives it its own perceptual hash, 100 + 10 * number pixels wide.
+
+    The same pattern with another ``brightness`` or ``quality`` is a near-duplicate.
+    """
+    rng = random.Random(number if pattern is None else pattern)
+    cells = Image.frombytes("L", (9, 8), bytes(rng.randrange(256) for _ in range(72)))
+    image = cells.resize((100 + 10 * number, PHOTO_HEIGHT), Image.Resampling.NEAREST).point(lambda v: max(0, min(255, v + brightness)))
+    buffer = io.BytesIO()
+    image.convert("RGB").save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+def request_photos(request):
+    """Numbers of the photos in a vision request, in request order (see photo)."""
+    numbers = []
+    for message in request.get("messages", []):
+        if not isinstance(message.get("content"), list):
+            continue
+        for part in message["content"]:
+            if part.get("type") == "image_url":
+                data = base64.b64decode(part["image_url"]["url"].split(",", 1)[1])
+                with Image.open(io.BytesIO(data)) as image:
+                    numbers.append(round((image.width * PHOTO_HEIGHT / image.height - 100) / 10))
+    return numbers
+
+def store_photos(tmp_path, photos):
+    """An ImageStore holding ``photos`` (bytes), and their (filename, image_id) pairs."""
+    store = ImageStore(root=str(tmp_path / "photos"))
+    return store, [(f"tree{n}.jpg", store.put(data)) for n, data in enumerate(photos)]
@@ -0,0 +1,67 @@
+import json
+
+import pytest
+
+import tree_pipeline
+from metrics import METRICS
+from tree_pipeline import AnalysisCache
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Controls time.time() as seen by the cache, so access order and expiry are deterministic."""
+    now = [1_000_000.0]
+    monkeypatch.setattr(tree_pipeline.time, "time", lambda: now[0])
+    return now
+
+def entry_size(analysis):
+    return len(json.dumps(analysis, ensure_ascii=False).encode("utf-8"))
+
+def analysis(n):
+    return {"tree_type": f"Tree {n}", "notes": "x" * 100}
+
+def test_get_returns_what_was_put_and_counts_hits_and_misses(tmp_path):
+    cache = AnalysisCache(str(tmp_path / "cache.sqlite3"))
+    assert cache.get("a") is None
+    cache.put("a", analysis(1))
+    assert cache.get("a") == analysis(1)
+    assert cache.stats() == {"hits": 1, "misses": 1, "entries": 1, "bytes": entry_size(analysis(1))}
+    assert METRICS.counter("cache_requests_total", cache="analysis", result="hit") == 1
+
+def test_least_recently_used_entries_are_evicted_beyond_max_bytes(tmp_path, clock):
+    cache = AnalysisCache(str(tmp_path / "cache.sqlite3"), max_bytes=3 * entry_size(analysis(1)))
+    for key in "abc":
+        cache.put(key, analysis(1))
+        clock[0] += 1
+    assert cache.get("a") is not None # a is now more recent than b and c
+    clock[0] += 1
+    cache.put("d", analysis(1))
+    assert cache.stats()["entries"] == 3
+    assert cache.get("b") is None
+    assert [cache.get(key) is not None for key in "acd"] == [True, True, True]
+
+def test_eviction_frees_enough_for_a_large_entry(tmp_path, clock):
+    small = analysis(1)
+    large = dict(small, notes="x" * 200) # needs the space of two small entries
+    cache = AnalysisCache(str(tmp_path / "cache.sqlite3"), max_bytes=3 * entry_size(small))
+    for key in "abc":
+        cache.put(key, small)
+        clock[0] += 1
+    cache.put("big", large)
+    assert cache.stats()["bytes"] <= cache.max_bytes
+    assert cache.get("big") == large
+    assert cache.get("c") == small
+    assert cache.get("a") is None and cache.get("b") is None
+
+def test_expired_entries_are_misses_and_are_dropped(tmp_path, clock):
+    cache = AnalysisCache(str(tmp_path / "cache.sqlite3"), max_age_seconds=60)
+    cache.put("a", analysis(1))
+    clock[0] += 61
+    assert cache.get("a") is None
+    assert cache.stats()["entries"] == 0
+
+def test_clear_drops_entries_and_counters(tmp_path):
+    cache = AnalysisCache(str(tmp_path / "cache.sqlite3"))
+    cache.put("a", analysis(1))
+    cache.get("a")
+    cache.clear()
+    assert cache.stats() == {"hits": 0, "misses": 0, "entries": 0, "bytes": 0}
@@ -0,0 +1,158 @@
+import json
+import random
+import threading
+import time
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from openai import BadRequestError, InternalServerError, RateLimitError
+
+import tree_pipeline
+from fakes import LANG, FakeOpenAI, api_error, photo, request_photos, store_photos, tree_analysis
+from metrics import METRICS
+from translations import get_text
+from tree_pipeline import (
+    MAX_RETRIES, AnalysisCache, AnalysisCancelled, analysis_cache_key, create_completion_with_retry, retry_delay, run_batch_analysis
+)
+
+MODEL = "gpt-4.1"
+
+def named_by_photo(request):
+    """Names each tree after the photo it was sent with, after a random delay that shuffles completion order."""
+    time.sleep(random.uniform(0, 0.02))
+    return json.dumps(tree_analysis(tree_type=f"Tree {request_photos(request)[0]}"))
+
+def run(client, store, images, cancel_events=None, **kwargs):
+    cancel_events = cancel_events or [threading.Event() for _ in images]
+    return list(run_batch_analysis(client, images, store, LANG, MODEL, kwargs.pop("max_workers", 3), cancel_events, **kwargs))
+
+def test_every_image_is_yielded_once_with_its_own_analysis(tmp_path):
+    store, images = store_photos(tmp_path, [photo(n) for n in range(6)])
+    client = FakeOpenAI(named_by_photo)
+    results = run(client, store, images)
+    assert sorted(i for i, _ in results) == list(range(6))
+    for i, payload in results:
+        assert (payload["image_id"], payload["filename"], payload["model"]) == (images[i][1], images[i][0], MODEL)
+        assert payload["analysis"]["tree_type"] == f"Tree {i}"
+        assert payload["error"] is None and len(payload["requests"]) == 1
+    assert len(client.requests) == 6
+    assert METRICS.counter("images_total", result="ok") == 6
+
+def test_cached_results_come_first_without_a_request(tmp_path):
+    store, images = store_photos(tmp_path, [photo(n) for n in range(3)])
+    cache = AnalysisCache(str(tmp_path / "cache.sqlite3"))
+    cache.put(analysis_cache_key(images[2][1], MODEL, LANG), tree_analysis(tree_type="Cached"))
+    client = FakeOpenAI(named_by_photo)
+    results = run(client, store, images, cache=cache)
+    assert results[0][0] == 2 and results[0][1]["analysis"]["tree_type"] == "Cached"
+    assert sorted(request_photos(request)[0] for request in client.requests) == [0, 1]
+    # The new analyses are cached as they arrive
+    assert cache.get(analysis_cache_key(images[0][1], MODEL, LANG))["tree_type"] == "Tree 0"
+
+def test_use_cached_false_sends_every_image(tmp_path):
+    store, images = store_photos(tmp_path, [photo(0)])
+    cache = AnalysisCache(str(tmp_path / "cache.sqlite3"))
+    cache.put(analysis_cache_key(images[0][1], MODEL, LANG), tree_analysis(tree_type="Cached"))
+    client = FakeOpenAI(named_by_photo)
+    [(_, payload)] = run(client, store, images, cache=cache, use_cached=False)
+    assert payload["analysis"]["tree_type"] == "Tree 0"
+    assert cache.get(analysis_cache_key(images[0][1], MODEL, LANG))["tree_type"] == "Tree 0"
+
+def test_cancelled_image_is_not_sent(tmp_path):
+    store, images = store_photos(tmp_path, [photo(n) for n in range(3)])
+    cancel_events = [threading.Event() for _ in images]
+    cancel_events[1].set()
+    client = FakeOpenAI(named_by_photo)
+    results = dict(run(client, store, images, cancel_events))
+    assert results[1]["analysis"] is None and results[1]["error"] == get_text(LANG, "cancelled_text")
+    assert sorted(request_photos(request)[0] for request in client.requests) == [0, 2]
+    assert METRICS.counter("images_total", result="cancelled") == 1
+
+def test_closing_the_batch_cancels_the_images_still_outstanding(tmp_path):
+    store, images = store_photos(tmp_path, [photo(n) for n in range(4)])
+    cancel_events = [threading.Event() for _ in images]
+    release = threading.Event()
+    def reply(request):
+        # Requests after the first wait, so the batch is closed while one is in flight
+        if request_photos(request) != [0]:
+            release.wait(5)
+        return json.dumps(tree_analysis())
+    client = FakeOpenAI(reply)
+    batch = run_batch_analysis(client, images, store, LANG, MODEL, 1, cancel_events)
+    next(batch)
+    batch.close()
+    assert all(event.is_set() for event in cancel_events)
+    release.set()
+    time.sleep(0.2)
+    # The request in flight when the batch was closed may finish; the queued ones are never sent
+    assert len(client.requests) <= 2
+
+def test_failed_request_becomes_an_error_payload(tmp_path):
+    store, images = store_photos(tmp_path, [photo(0)])
+    [(_, payload)] = run(FakeOpenAI(lambda request: api_error(BadRequestError, 400)), store, images)
+    assert payload["analysis"] is None and "400" in payload["error"]
+    assert METRICS.counter("images_total", result="error") == 1
+
+class RecordingEvent(threading.Event):
+    """A cancel event whose waits return at once and are recorded, so backoff needs no real sleeping."""
+
+    def __init__(self, cancel_after=None):
+        super().__init__()
+        self.waits = []
+        self.cancel_after = cancel_after
+
+    def wait(self, timeout=None):
+        self.waits.append(timeout)
+        if self.cancel_after is not None and len(self.waits) >= self.cancel_after:
+            self.set()
+        return self.is_set()
+
+def script(*outcomes):
+    outcomes = list(outcomes)
+    return FakeOpenAI(lambda request: outcomes.pop(0) if outcomes else "ok")
+
+@pytest.mark.parametrize("headers, delay", [
+    ({"retry-after-ms": "1500"}, 1.5),
+    ({"retry-after": "7"}, 7.0),
+    ({"retry-after-ms": "250", "retry-after": "7"}, 0.25),
+    ({"retry-after": "3600"}, tree_pipeline.BACKOFF_MAX_SECONDS),
+])
+def test_retry_delay_honours_retry_after_headers(headers, delay):
+    assert retry_delay(api_error(RateLimitError, 429, headers), 0) == delay
+
+def test_retry_delay_accepts_an_http_date():
+    when = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True)
+    assert 25 < retry_delay(api_error(RateLimitError, 429, {"retry-after": when}), 0) <= 30
+
+def test_retry_delay_without_headers_backs_off_exponentially_with_jitter():
+    for attempt in range(4):
+        full = tree_pipeline.BACKOFF_BASE_SECONDS * 2 ** attempt
+        assert full / 2 <= retry_delay(api_error(InternalServerError, 500), attempt) <= full
+
+def test_rate_limited_request_waits_as_told_and_is_retried():
+    client = script(api_error(RateLimitError, 429, {"retry-after-ms": "1500"}), api_error(InternalServerError, 503, {"retry-after": "2"}))
+    event = RecordingEvent()
+    response = create_completion_with_retry(client, event, model=MODEL, messages=[])
+    assert response.choices[0].message.content == "ok"
+    assert event.waits == [1.5, 2.0] and len(client.requests) == 3
+    assert METRICS.counter("retries_total", error="RateLimitError") == 1
+
+def test_cancelling_during_backoff_stops_the_retries():
+    client = script(*[api_error(RateLimitError, 429, {"retry-after": "5"})] * 3)
+    with pytest.raises(AnalysisCancelled):
+        create_completion_with_retry(client, RecordingEvent(cancel_after=1), model=MODEL, messages=[])
+    assert len(client.requests) == 1
+
+def test_transient_errors_are_raised_after_the_last_retry():
+    client = script(*[api_error(InternalServerError, 500)] * (MAX_RETRIES + 2))
+    event = RecordingEvent()
+    with pytest.raises(InternalServerError):
+        create_completion_with_retry(client, event, model=MODEL, messages=[])
+    assert len(client.requests) == MAX_RETRIES + 1 and len(event.waits) == MAX_RETRIES
+
+def test_other_errors_are_not_retried():
+    client = script(api_error(BadRequestError, 400))
+    with pytest.raises(BadRequestError):
+        create_completion_with_retry(client, RecordingEvent(), model=MODEL, messages=[])
+    assert len(client.requests) == 1
@@ -0,0 +1,65 @@
+import json
+import threading
+
+from fakes import LANG, FakeOpenAI, photo, store_photos, tree_analysis
+from metrics import METRICS
+from translations import get_text
+from tree_pipeline import (
+    CASCADE_ESCALATION_MODEL, CASCADE_MODEL, CASCADE_TRIAGE_MODEL, AnalysisCache, analysis_cache_key, run_batch_analysis
+)
+
+def by_model(**analyses):
+    """Replies with the analysis given for the request's model (gpt_4_1_mini=... for gpt-4.1-mini)."""
+    return lambda request: json.dumps(analyses[request["model"].replace("-", "_").replace(".", "_")])
+
+def run(client, store, images, cache=None):
+    return dict(run_batch_analysis(client, images, store, LANG, CASCADE_MODEL, 2, [threading.Event() for _ in images], cache=cache))
+
+def test_a_healthy_low_risk_tree_keeps_its_triage(tmp_path):
+    store, images = store_photos(tmp_path, [photo(0)])
+    client = FakeOpenAI(by_model(gpt_4_1_mini=tree_analysis(health_grade="A")))
+    payload = run(client, store, images)[0]
+    assert client.models() == [CASCADE_TRIAGE_MODEL]
+    assert payload["model"] == CASCADE_TRIAGE_MODEL and "escalated" not in payload
+
+def test_a_poor_grade_or_high_risk_is_escalated(tmp_path):
+    store, images = store_photos(tmp_path, [photo(0)])
+    triage = tree_analysis(health_grade="C", risk_assessment={"infection_and_hazard_potential_grade": "High"})
+    client = FakeOpenAI(by_model(gpt_4_1_mini=triage, gpt_4_1=tree_analysis(tree_type="Checked")))
+    payload = run(client, store, images)[0]
+    assert client.models() == [CASCADE_TRIAGE_MODEL, CASCADE_ESCALATION_MODEL]
+    assert (payload["model"], payload["escalated"], payload["analysis"]["tree_type"]) == (CASCADE_ESCALATION_MODEL, "grade", "Checked")
+    assert [request["model"] for request in payload["requests"]] == [CASCADE_TRIAGE_MODEL, CASCADE_ESCALATION_MODEL]
+    assert METRICS.counter("cascade_escalations_total", reason="grade") == 1
+
+def test_a_photo_without_a_tree_is_not_escalated(tmp_path):
+    store, images = store_photos(tmp_path, [photo(0)])
+    client = FakeOpenAI(by_model(gpt_4_1_mini={"no_tree": True}))
+    payload = run(client, store, images)[0]
+    assert client.models() == [CASCADE_TRIAGE_MODEL]
+    assert payload["analysis"] is None and payload["error"] == get_text(LANG, "no_tree_text")
+    assert METRICS.counter("cascade_escalations_total") == 0
+
+def test_a_cached_large_model_analysis_wins(tmp_path):
+    store, images = store_photos(tmp_path, [photo(0)])
+    cache = AnalysisCache(str(tmp_path / "cache.sqlite3"))
+    cache.put(analysis_cache_key(images[0][1], CASCADE_TRIAGE_MODEL, LANG), tree_analysis(tree_type="Triage"))
+    cache.put(analysis_cache_key(images[0][1], CASCADE_ESCALATION_MODEL, LANG), tree_analysis(tree_type="Checked"))
+    client = FakeOpenAI()
+    payload = run(client, store, images, cache)[0]
+    assert client.requests == []
+    assert (payload["model"], payload["analysis"]["tree_type"]) == (CASCADE_ESCALATION_MODEL, "Checked")
+
+def test_a_cached_triage_that_needs_escalating_goes_straight_to_the_large_model(tmp_path):
+    store, images = store_photos(tmp_path, [photo(0), photo(1)])
+    cache = AnalysisCache(str(tmp_path / "cache.sqlite3"))
+    cache.put(analysis_cache_key(images[0][1], CASCADE_TRIAGE_MODEL, LANG), tree_analysis(health_grade="A"))
+    cache.put(analysis_cache_key(images[1][1], CASCADE_TRIAGE_MODEL, LANG), tree_analysis(health_grade="D"))
+    client = FakeOpenAI(by_model(gpt_4_1=tree_analysis(tree_type="Checked")))
+    results = run(client, store, images, cache)
+    assert client.models() == [CASCADE_ESCALATION_MODEL]
+    assert results[0]["model"] == CASCADE_TRIAGE_MODEL and results[0]["requests"] == []
+    assert (results[1]["model"], results[1]["escalated"], results[1]["analysis"]["tree_type"]) == (CASCADE_ESCALATION_MODEL, "grade", "Checked")
+    assert [request["model"] for request in results[1]["requests"]] == [CASCADE_ESCALATION_MODEL]
+    # The next run finds the large model's analysis
+    assert run(FakeOpenAI(), store, images[1:], cache)[0]["analysis"]["tree_type"] == "Checked"
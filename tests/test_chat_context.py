@@ -0,0 +1,97 @@
+import json
+import types
+
+import pytest
+
+import chat_context
+from chat_context import (
+    SUMMARY_BUDGET_SHARE, build_chat_messages, compact_analysis, count_message_tokens, estimate_tokens, extractive_summary,
+    model_summarizer, system_prefix
+)
+from fakes import tree_analysis
+
+@pytest.fixture(autouse=True)
+def estimated_tokens(monkeypatch):
+    """Token counts from the character estimate, whether or not tiktoken is installed."""
+    monkeypatch.setattr(chat_context, "_encoding", False)
+
+def conversation(exchanges, words=40):
+    history = []
+    for n in range(exchanges):
+        history.append({"role": "user", "content": f"Question {n}: " + "why " * words})
+        history.append({"role": "assistant", "content": f"Answer {n}: " + "because " * words})
+    return history
+
+def test_estimate_counts_cjk_characters_as_tokens():
+    assert estimate_tokens("abcdefgh") == 2
+    assert estimate_tokens("橡树") == 2
+
+def test_compact_analysis_drops_empty_and_placeholder_fields():
+    analysis = tree_analysis(disease_identification="None", native_origins=[], approximate_age="N/A")
+    compact = json.loads(compact_analysis(analysis))
+    assert "disease_identification" not in compact and "native_origins" not in compact and "approximate_age" not in compact
+    assert compact["risk_assessment"]["infection_and_hazard_potential_grade"] == "Low"
+    assert "\": " not in compact_analysis(analysis) # minified
+
+def test_short_conversation_is_sent_as_is():
+    history = conversation(2) + [{"role": "user", "content": "And now?"}]
+    state = {}
+    messages, report = build_chat_messages(tree_analysis(), history, state)
+    assert messages == [system_prefix(tree_analysis())] + history
+    assert report["folded_turns"] == 0 and report["summary_tokens"] == 0
+    assert report["total_tokens"] == count_message_tokens(messages)
+
+def test_older_exchanges_are_folded_into_a_summary_within_the_budget():
+    analysis = tree_analysis()
+    history = conversation(12) + [{"role": "user", "content": "What should I do first?"}]
+    state = {}
+    budget = count_message_tokens([system_prefix(analysis)]) + 300
+    messages, report = build_chat_messages(analysis, history, state, budget_tokens=budget)
+    assert report["total_tokens"] <= budget
+    assert state["folded"] == report["folded_turns"] and state["folded"] % 2 == 0 and state["folded"] > 0
+    # Prefix, summary, then the unfolded turns ending with the new question
+    assert messages[0] == system_prefix(analysis)
+    assert messages[1]["role"] == "system" and messages[1]["content"].endswith(state["summary"])
+    assert messages[2:] == history[state["folded"]:]
+    assert messages[-1]["content"] == "What should I do first?"
+
+def test_the_prefix_stays_identical_as_the_conversation_grows():
+    analysis = tree_analysis()
+    state, history, prefixes = {}, [], []
+    budget = count_message_tokens([system_prefix(analysis)]) + 300
+    for exchange in conversation(10):
+        history.append(exchange)
+        if exchange["role"] == "user":
+            messages, _ = build_chat_messages(analysis, history, state, budget_tokens=budget)
+            prefixes.append(messages[0])
+    assert all(prefix == prefixes[0] for prefix in prefixes)
+    assert state["folded"] > 0
+
+def test_the_summary_keeps_within_its_share_of_the_budget():
+    analysis = tree_analysis()
+    prefix_tokens = count_message_tokens([system_prefix(analysis)])
+    budget = prefix_tokens + 200
+    state = {}
+    build_chat_messages(analysis, conversation(30) + [{"role": "user", "content": "?"}], state, budget_tokens=budget)
+    assert estimate_tokens(state["summary"]) <= (budget - prefix_tokens) * SUMMARY_BUDGET_SHARE
+    # The oldest lines go first
+    assert "Question 0" not in state["summary"]
+
+def test_the_newest_question_is_always_sent():
+    question = {"role": "user", "content": "why " * 2000}
+    messages, report = build_chat_messages(tree_analysis(), conversation(1) + [question], {}, budget_tokens=100)
+    assert messages[-1] == question and report["folded_turns"] == 2
+
+def test_extractive_summary_clips_long_turns():
+    summary = extractive_summary("user: earlier", [{"role": "assistant", "content": "word " * 100}])
+    first, second = summary.splitlines()
+    assert first == "user: earlier"
+    assert second.startswith("assistant: word") and second.endswith("…") and len(second) < 200
+
+def test_model_summarizer_falls_back_to_the_extractive_summary():
+    turns = [{"role": "user", "content": "Is it safe?"}]
+    def failing(**request):
+        raise RuntimeError("unavailable")
+    assert model_summarizer(failing, "gpt-4.1-mini")("", turns) == extractive_summary("", turns)
+    answer = types.SimpleNamespace(choices=[types.SimpleNamespace(message=types.SimpleNamespace(content="- Safe for now"))])
+    assert model_summarizer(lambda **request: answer, "gpt-4.1-mini")("", turns) == "- Safe for now"
@@ -0,0 +1,161 @@
+import threading
+import types
+
+import pytest
+from openai import BadRequestError, InternalServerError
+
+import client_pool
+from client_pool import EndpointPool, endpoint_configs
+from fakes import api_error
+from metrics import METRICS
+
+class FakeCompletions:
+    """Stands in for an endpoint's ``client``: records requests and answers or raises from a script."""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.requests = []
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self.create))
+
+    def create(self, **kwargs):
+        self.requests.append(kwargs)
+        outcome = self.outcomes.pop(0) if self.outcomes else "ok"
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return {"model": kwargs["model"], "reply": outcome}
+
+@pytest.fixture
+def make_pool():
+    pools = []
+    def make(*configs):
+        pool = EndpointPool(endpoint_configs({"azure_endpoints": [
+            dict({"endpoint": "https://example.invalid", "api_key": "k", "api_version": "2024-10-21"}, **config) for config in configs
+        ]}))
+        pools.append(pool)
+        return pool
+    yield make
+    for pool in pools:
+        pool.http_client.close()
+
+@pytest.fixture
+def prefer_heaviest(monkeypatch):
+    """Makes the TPM-weighted choice deterministic: always the endpoint with the largest quota."""
+    monkeypatch.setattr(client_pool.random, "choices", lambda population, weights: [population[weights.index(max(weights))]])
+
+def request(pool, **kwargs):
+    return pool.chat.completions.create(**dict({"model": "gpt-4.1", "messages": [{"role": "user", "content": "hi"}], "max_completion_tokens": 100}, **kwargs))
+
+def test_requests_go_only_to_endpoints_serving_the_model(make_pool):
+    pool = make_pool({"name": "mini", "deployments": {"gpt-4.1-mini": "mini-prod"}}, {"name": "large", "deployments": {"gpt-4.1": "large-prod"}})
+    mini, large = (FakeCompletions() for _ in pool.endpoints)
+    pool.endpoints[0].client, pool.endpoints[1].client = mini, large
+    for _ in range(5):
+        assert request(pool)["model"] == "large-prod"
+    assert request(pool, model="gpt-4.1-mini")["model"] == "mini-prod"
+    assert (len(mini.requests), len(large.requests)) == (1, 5)
+    with pytest.raises(ValueError):
+        request(pool, model="gpt-5")
+
+def test_requests_are_spread_by_tpm(make_pool):
+    pool = make_pool({"name": "a", "tpm": 900_000}, {"name": "b", "tpm": 100_000})
+    a, b = (FakeCompletions() for _ in pool.endpoints)
+    pool.endpoints[0].client, pool.endpoints[1].client = a, b
+    for _ in range(200):
+        request(pool)
+    assert len(a.requests) > 3 * len(b.requests) > 0
+
+def test_transient_error_fails_over_and_cools_the_endpoint_down(make_pool, prefer_heaviest):
+    pool = make_pool({"name": "a", "tpm": 900_000}, {"name": "b", "tpm": 100_000})
+    a, b = FakeCompletions(api_error(InternalServerError, 500)), FakeCompletions()
+    pool.endpoints[0].client, pool.endpoints[1].client = a, b
+    # b is only chosen after a failed
+    assert request(pool)["reply"] == "ok"
+    assert (len(a.requests), len(b.requests)) == (1, 1)
+    status = {row["endpoint"]: row for row in pool.status()}
+    assert not status["a"]["healthy"] and status["a"]["cooldown s"] > 0 and status["b"]["healthy"]
+    assert pool.endpoints[0].failures == 1
+    # While a cools down every request goes to b
+    for _ in range(3):
+        request(pool)
+    assert (len(a.requests), len(b.requests)) == (1, 4)
+    assert METRICS.counter("endpoint_requests_total", endpoint="a", result="InternalServerError") == 1
+
+def test_cooldown_grows_with_consecutive_failures(make_pool, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(client_pool.time, "monotonic", lambda: now[0])
+    pool = make_pool({"name": "a"})
+    endpoint = pool.endpoints[0]
+    cooldowns = []
+    for _ in range(3):
+        pool._mark_failed(endpoint, api_error(InternalServerError, 500))
+        cooldowns.append(endpoint.cooldown_until - now[0])
+        now[0] = endpoint.cooldown_until
+    assert cooldowns == [client_pool.COOLDOWN_BASE_SECONDS * 2 ** n for n in range(3)]
+
+def test_error_is_raised_once_every_endpoint_failed(make_pool):
+    pool = make_pool({"name": "a"}, {"name": "b"})
+    for endpoint in pool.endpoints:
+        endpoint.client = FakeCompletions(api_error(InternalServerError, 503))
+    with pytest.raises(InternalServerError):
+        request(pool)
+    assert all(endpoint.cooldown_until > 0 for endpoint in pool.endpoints)
+
+def cooled_down(endpoint):
+    """An endpoint that failed before and whose cooldown has just ended: its next request is a probe."""
+    endpoint.failures = 1
+    endpoint.cooldown_until = 0.0
+    return endpoint
+
+def test_successful_probe_returns_the_endpoint_to_rotation(make_pool):
+    pool = make_pool({"name": "a"})
+    endpoint = cooled_down(pool.endpoints[0])
+    seen = []
+    fake = FakeCompletions()
+    original = fake.create
+    def create(**kwargs):
+        seen.append(endpoint.probe_in_flight)
+        return original(**kwargs)
+    fake.chat.completions.create = create
+    endpoint.client = fake
+    request(pool)
+    assert seen == [True]
+    assert (endpoint.failures, endpoint.probe_in_flight) == (0, False)
+
+def test_probe_in_flight_keeps_other_requests_away(make_pool, prefer_heaviest):
+    pool = make_pool({"name": "a", "tpm": 900_000}, {"name": "b", "tpm": 100_000})
+    a = cooled_down(pool.endpoints[0])
+    a.probe_in_flight = True
+    a.client, pool.endpoints[1].client = FakeCompletions(), FakeCompletions()
+    for _ in range(3):
+        request(pool)
+    assert (len(a.client.requests), len(pool.endpoints[1].client.requests)) == (0, 3)
+
+def test_failed_probe_cools_the_endpoint_down_again(make_pool):
+    pool = make_pool({"name": "a"})
+    endpoint = cooled_down(pool.endpoints[0])
+    endpoint.client = FakeCompletions(api_error(InternalServerError, 500))
+    with pytest.raises(InternalServerError):
+        request(pool)
+    assert (endpoint.failures, endpoint.probe_in_flight) == (2, False)
+    assert endpoint.cooldown_until > 0
+
+def test_non_retryable_error_during_a_probe_releases_the_probe(make_pool):
+    pool = make_pool({"name": "a"})
+    endpoint = cooled_down(pool.endpoints[0])
+    endpoint.client = FakeCompletions(api_error(BadRequestError, 400), "ok")
+    with pytest.raises(BadRequestError):
+        request(pool)
+    assert not endpoint.probe_in_flight
+    assert pool.status()[0]["healthy"]
+    assert METRICS.counter("endpoint_requests_total", endpoint="a", result="BadRequestError") == 1
+    # The endpoint answered, so it is tried again rather than left out of rotation
+    assert request(pool)["reply"] == "ok"
+    assert (endpoint.failures, endpoint.probe_in_flight) == (0, False)
+
+def test_cancelled_quota_wait_returns_none(make_pool):
+    pool = make_pool({"name": "a", "rpm": 1})
+    pool.endpoints[0].client = FakeCompletions()
+    request(pool)
+    cancel_event = threading.Event()
+    cancel_event.set()
+    assert request(pool, cancel_event=cancel_event) is None
@@ -0,0 +1,85 @@
+import io
+import json
+import threading
+
+from openai import BadRequestError
+from PIL import Image
+
+from fakes import LANG, FakeOpenAI, api_error, photo, request_photos, store_photos, tree_analysis
+from image_preprocessing import DEDUPE_THRESHOLD, hash_distance, perceptual_hash
+from metrics import METRICS
+from translations import get_text
+from tree_pipeline import AnalysisCache, analysis_cache_key, find_near_duplicate, run_batch_analysis
+
+MODEL = "gpt-4.1"
+
+def named_by_photo(request):
+    return json.dumps(tree_analysis(tree_type=f"Tree {request_photos(request)[0]}"))
+
+def run(client, store, images, cancel_events=None, **kwargs):
+    cancel_events = cancel_events or [threading.Event() for _ in images]
+    return dict(run_batch_analysis(client, images, store, LANG, MODEL, 2, cancel_events, dedupe_threshold=DEDUPE_THRESHOLD, **kwargs))
+
+def test_near_duplicates_hash_alike_and_other_photos_do_not():
+    original = perceptual_hash(photo(0))
+    assert hash_distance(original, perceptual_hash(photo(1, pattern=0, brightness=8, quality=60))) <= DEDUPE_THRESHOLD
+    assert hash_distance(original, perceptual_hash(photo(1))) > DEDUPE_THRESHOLD
+
+def test_uniform_images_have_no_hash():
+    buffer = io.BytesIO()
+    Image.new("RGB", (200, 100), "grey").save(buffer, format="JPEG")
+    assert perceptual_hash(buffer.getvalue()) is None
+
+def test_find_near_duplicate_picks_the_closest_candidate_within_the_threshold():
+    candidates = [("far", 0b1111), ("close", 0b0001), ("closer", 0b0000)]
+    assert find_near_duplicate(0b0000, candidates, 2) == ("closer", 0)
+    assert find_near_duplicate(0b1111_0000, candidates, 2) is None
+
+def test_near_duplicates_in_a_batch_are_analyzed_once(tmp_path):
+    store, images = store_photos(tmp_path, [photo(0), photo(1, pattern=0, brightness=8), photo(2)])
+    client = FakeOpenAI(named_by_photo)
+    results = run(client, store, images)
+    assert sorted(request_photos(request)[0] for request in client.requests) == [0, 2]
+    duplicate = results[1]
+    assert duplicate["analysis"] == results[0]["analysis"] and duplicate["analysis"] is not results[0]["analysis"]
+    assert duplicate["duplicate_of"]["image_id"] == images[0][1] and duplicate["duplicate_of"]["filename"] == "tree0.jpg"
+    assert duplicate["duplicate_of"]["distance"] <= DEDUPE_THRESHOLD
+    assert results[2]["analysis"]["tree_type"] == "Tree 2" and results[2]["duplicate_of"] is None
+    assert METRICS.counter("images_total", result="duplicate") == 1
+
+def test_without_a_threshold_every_photo_is_sent(tmp_path):
+    store, images = store_photos(tmp_path, [photo(0), photo(1, pattern=0, brightness=8)])
+    client = FakeOpenAI(named_by_photo)
+    list(run_batch_analysis(client, images, store, LANG, MODEL, 2, [threading.Event() for _ in images]))
+    assert len(client.requests) == 2
+
+def test_a_near_duplicate_of_a_cached_photo_reuses_its_analysis(tmp_path):
+    store, images = store_photos(tmp_path, [photo(0), photo(1, pattern=0, quality=60)])
+    cache = AnalysisCache(str(tmp_path / "cache.sqlite3"))
+    cache.put(analysis_cache_key(images[0][1], MODEL, LANG), tree_analysis(tree_type="Cached"), perceptual_hash(store.path(images[0][1])))
+    client = FakeOpenAI(named_by_photo)
+    results = run(client, store, images[1:], cache=cache)
+    assert client.requests == []
+    assert results[0]["analysis"]["tree_type"] == "Cached"
+    assert results[0]["duplicate_of"]["image_id"] == images[0][1] and results[0]["duplicate_of"]["filename"] is None
+    # Re-uploading the duplicate is now an exact cache hit
+    assert cache.get(analysis_cache_key(images[1][1], MODEL, LANG))["tree_type"] == "Cached"
+
+def test_the_next_photo_of_a_group_is_analyzed_when_the_first_fails(tmp_path):
+    store, images = store_photos(tmp_path, [photo(0), photo(1, pattern=0, brightness=8), photo(2, pattern=0, brightness=-8)])
+    def reply(request):
+        return api_error(BadRequestError, 400) if request_photos(request) == [0] else named_by_photo(request)
+    client = FakeOpenAI(reply)
+    results = run(client, store, images)
+    assert [request_photos(request)[0] for request in client.requests] == [0, 1]
+    assert results[0]["analysis"] is None
+    assert results[1]["analysis"]["tree_type"] == "Tree 1" and results[1]["duplicate_of"] is None
+    assert results[2]["analysis"]["tree_type"] == "Tree 1" and results[2]["duplicate_of"]["filename"] == "tree1.jpg"
+
+def test_a_cancelled_duplicate_does_not_get_the_analysis(tmp_path):
+    store, images = store_photos(tmp_path, [photo(0), photo(1, pattern=0, brightness=8)])
+    cancel_events = [threading.Event(), threading.Event()]
+    cancel_events[1].set()
+    results = run(FakeOpenAI(named_by_photo), store, images, cancel_events)
+    assert results[0]["analysis"]["tree_type"] == "Tree 0"
+    assert results[1]["analysis"] is None and results[1]["error"] == get_text(LANG, "cancelled_text")
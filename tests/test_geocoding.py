@@ -0,0 +1,72 @@
+import pytest
+
+import geocoding
+from geocoding import GeocodeCache, Geocoder
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(geocoding.time, "time", lambda: now[0])
+    return now
+
+@pytest.fixture
+def cache(tmp_path):
+    return GeocodeCache(str(tmp_path / "geocode.sqlite3"), max_age_seconds=100, negative_max_age_seconds=10)
+
+def test_unknown_query_is_not_found(cache):
+    assert cache.get("bonn") == (False, (None, None))
+
+def test_negative_results_expire_sooner_than_positive_ones(cache, clock):
+    cache.put("bonn", (50.73, 7.1))
+    cache.put("atlantis", (None, None))
+    assert cache.get("atlantis") == (True, (None, None))
+    clock[0] += 11
+    assert cache.get("atlantis") == (False, (None, None))
+    assert cache.get("bonn") == (True, (50.73, 7.1))
+    clock[0] += 90
+    assert cache.get("bonn") == (False, (None, None))
+
+def test_put_refreshes_an_expired_entry(cache, clock):
+    cache.put("atlantis", (None, None))
+    clock[0] += 11
+    cache.put("atlantis", (None, None))
+    assert cache.get("atlantis") == (True, (None, None))
+
+@pytest.fixture
+def offline_geocoder(cache, monkeypatch):
+    geocoder = Geocoder(cache=cache)
+    def nominatim():
+        raise AssertionError("unexpected Nominatim lookup")
+    monkeypatch.setattr(geocoder, "nominatim", nominatim)
+    return geocoder
+
+def test_gazetteer_resolves_regions_and_qualified_names_offline(offline_geocoder):
+    germany = offline_geocoder.places["germany"]
+    coordinates = offline_geocoder.geocode_many(["Germany", "Northern Germany", "the Germany.", "n/a", "Unknown region", None])
+    assert coordinates == {"Germany": germany, "Northern Germany": germany, "the Germany.": germany,
+                           "n/a": (None, None), "Unknown region": (None, None)}
+
+def test_cached_negative_result_avoids_a_remote_lookup(offline_geocoder, cache):
+    cache.put("atlantis", (None, None))
+    assert offline_geocoder.geocode_many(["Atlantis"]) == {"Atlantis": (None, None)}
+
+def test_each_distinct_place_is_looked_up_once(cache, monkeypatch):
+    geocoder = Geocoder(cache=cache)
+    queries = []
+    class Location:
+        latitude, longitude = 1.5, 2.5
+    def lookup(query):
+        queries.append(query)
+        return Location() if query == "bonn" else None
+    monkeypatch.setattr(geocoder, "nominatim", lambda: lookup)
+    assert geocoder.geocode_many(["Bonn", "bonn", "Atlantis"]) == {"Bonn": (1.5, 2.5), "bonn": (1.5, 2.5), "Atlantis": (None, None)}
+    assert sorted(queries) == ["atlantis", "bonn"]
+    assert cache.get("atlantis") == (True, (None, None))
+
+def test_failed_lookups_are_not_cached(cache, monkeypatch):
+    geocoder = Geocoder(cache=cache)
+    def lookup(query):
+        raise OSError("network down")
+    monkeypatch.setattr(geocoder, "nominatim", lambda: lookup)
+    assert geocoder.geocode_many(["Bonn"]) == {"Bonn": (None, None)}
+    assert cache.get("bonn") == (False, (None, None))
@@ -0,0 +1,75 @@
+import base64
+import io
+import threading
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+from PIL import Image
+
+from fakes import LANG, FakeOpenAI, store_photos
+from image_preprocessing import VISION_SHORT_EDGE, downscale_image, preprocess_image, vision_target_size
+from tree_pipeline import prepare_image, run_batch_analysis
+
+def encoded(size, mode="RGB", format="JPEG", exif_orientation=None):
+    image = Image.new(mode, size, (90, 140, 60, 128)[:len(mode)])
+    buffer = io.BytesIO()
+    if exif_orientation:
+        exif = Image.Exif()
+        exif[0x0112] = exif_orientation
+        image.save(buffer, format=format, exif=exif)
+    else:
+        image.save(buffer, format=format)
+    return buffer.getvalue()
+
+def decoded_size(data):
+    with Image.open(io.BytesIO(data)) as image:
+        return image.size
+
+@pytest.mark.parametrize("size, target", [
+    ((4000, 3000), (1024, 768)), # short edge limited to 768
+    ((3000, 4000), (768, 1024)),
+    ((8000, 1000), (2048, 256)), # long edge limited to 2048 first
+    ((1000, 500), (1000, 500)), # never enlarged
+])
+def test_vision_target_size(size, target):
+    assert vision_target_size(size) == target
+
+def test_short_edge_none_only_limits_the_long_edge():
+    assert vision_target_size((4000, 3000), max_edge=1024, short_edge=None) == (1024, 768)
+    assert vision_target_size((4000, 3000), short_edge=None) == (2048, 1536)
+
+def test_large_jpeg_is_sent_at_the_size_the_model_sees():
+    data, mime_type = downscale_image(encoded((4000, 3000)))
+    assert mime_type == "image/jpeg"
+    assert decoded_size(data) == (1024, 768)
+
+def test_exif_orientation_is_applied_before_resizing():
+    data, _ = downscale_image(encoded((1600, 1200), exif_orientation=6)) # rotated 90° clockwise
+    assert decoded_size(data) == (VISION_SHORT_EDGE, 1024)
+
+def test_transparent_images_stay_png():
+    data, mime_type = downscale_image(encoded((1600, 1200), mode="RGBA", format="PNG"))
+    assert mime_type == "image/png" and decoded_size(data) == (1024, 768)
+    _, mime_type = downscale_image(encoded((1600, 1200), format="PNG"))
+    assert mime_type == "image/jpeg"
+
+def test_preprocess_image_returns_base64():
+    data, mime_type = preprocess_image(encoded((800, 600)), short_edge=300)
+    assert mime_type == "image/jpeg" and decoded_size(base64.b64decode(data)) == (400, 300)
+
+class BrokenPool:
+    def submit(self, *args, **kwargs):
+        raise BrokenProcessPool()
+
+def test_broken_process_pool_falls_back_to_the_calling_thread(tmp_path):
+    path = tmp_path / "tree.jpg"
+    path.write_bytes(encoded((1600, 1200)))
+    data, _ = prepare_image(str(path), BrokenPool(), {"short_edge": 512})
+    assert decoded_size(base64.b64decode(data)) == (683, 512)
+
+def test_short_edge_option_sets_the_uploaded_size(tmp_path):
+    store, images = store_photos(tmp_path, [encoded((1600, 1200))])
+    client = FakeOpenAI()
+    list(run_batch_analysis(client, images, store, LANG, "gpt-4.1", 1, [threading.Event()], preprocess_options={"short_edge": 256}))
+    url = client.requests[0]["messages"][1]["content"][1]["image_url"]["url"]
+    assert decoded_size(base64.b64decode(url.split(",", 1)[1])) == (341, 256)
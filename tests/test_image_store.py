@@ -0,0 +1,49 @@
+import os
+import time
+
+import pytest
+
+import image_store
+from fakes import photo
+from image_store import ImageStore, static_url
+
+@pytest.fixture(autouse=True)
+def no_sweeps_yet(monkeypatch):
+    monkeypatch.setattr(image_store, "_published_sweeps", {})
+
+def published_file(static_dir, name, age_seconds):
+    path = static_dir / "thumbnail" / name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"jpeg")
+    os.utime(path, (time.time() - age_seconds,) * 2)
+    return path
+
+def test_derivatives_are_rendered_once_and_kept_in_the_store(tmp_path):
+    store = ImageStore(static_dir=str(tmp_path / "static"), root=str(tmp_path / "photos"))
+    image_id = store.put(photo(0))
+    thumbnail = store.path(image_id, "thumbnail")
+    assert thumbnail.startswith(store.root) and store.path(image_id, "thumbnail") == thumbnail
+    assert store.read(image_id) == photo(0)
+
+def test_published_urls_are_absolute_and_honor_the_base_path(tmp_path):
+    static_dir = tmp_path / "static"
+    store = ImageStore(static_dir=str(static_dir), root=str(tmp_path / "photos"))
+    image_id = store.put(photo(0))
+    assert store.publish(image_id) == f"/app/static/thumbnail/{image_id}.jpg"
+    assert store.publish(image_id, "display", "/trees/") == f"/trees/app/static/display/{image_id}.jpg"
+    assert (static_dir / "thumbnail" / f"{image_id}.jpg").read_bytes() == store.read(image_id, "thumbnail")
+    assert static_url("x.png", "a/b") == "/a/b/app/static/x.png"
+
+def test_published_files_are_swept_at_most_once_per_interval(tmp_path):
+    static_dir = tmp_path / "static"
+    stale = published_file(static_dir, "stale.jpg", image_store.IMAGE_STORE_MAX_IDLE_SECONDS + 60)
+    fresh = published_file(static_dir, "fresh.jpg", 0)
+    ImageStore(static_dir=str(static_dir), root=str(tmp_path / "a"))
+    assert not stale.exists() and fresh.exists()
+    # Within the interval no other store stats the static files again
+    stale = published_file(static_dir, "stale.jpg", image_store.IMAGE_STORE_MAX_IDLE_SECONDS + 60)
+    ImageStore(static_dir=str(static_dir), root=str(tmp_path / "b"))
+    assert stale.exists()
+    image_store._published_sweeps[str(static_dir)] -= image_store.PUBLISHED_SWEEP_INTERVAL_SECONDS
+    ImageStore(static_dir=str(static_dir), root=str(tmp_path / "c"))
+    assert not stale.exists()
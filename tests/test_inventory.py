@@ -0,0 +1,109 @@
+import io
+
+import pytest
+from PIL import Image
+
+import job_queue
+from image_store import ImageStore
+from inventory import TreeInventory, bounding_box, distance_km
+from job_queue import JobQueue, run_job
+from tree_pipeline import AnalysisCache
+
+# (lat, lon) of the places used below
+PLACES = {"Bonn": (50.7374, 7.0982), "Cologne": (50.9375, 6.9603), "Berlin": (52.52, 13.405),
+          "Suva": (-18.1416, 178.4419), "Taveuni": (-16.8, -179.9)}
+
+@pytest.fixture
+def photos(tmp_path):
+    return ImageStore(root=str(tmp_path / "photos"))
+
+@pytest.fixture
+def inventory(tmp_path):
+    return TreeInventory(str(tmp_path / "inventory"))
+
+def result(photos, n, location, health_grade="B", risk_grade="Low", tree_type="Oak"):
+    buffer = io.BytesIO()
+    Image.new("RGB", (320, 240), (n * 10 % 256, 120, 60)).save(buffer, format="JPEG")
+    analysis = {"tree_type": tree_type, "health_grade": health_grade, "location": location,
+                "risk_assessment": {"infection_and_hazard_potential_grade": risk_grade}}
+    return {"id": f"r{n}", "filename": f"tree{n}.jpg", "image_id": photos.put(buffer.getvalue()), "model": "gpt-4.1", "analysis": analysis}
+
+def add(inventory, photos, *results, **kwargs):
+    return inventory.add(list(results), PLACES, photos, "English", **kwargs)
+
+def test_trees_are_added_once_with_a_thumbnail(inventory, photos):
+    bonn = result(photos, 1, "Bonn")
+    failed = dict(result(photos, 2, "Bonn"), analysis=None)
+    assert add(inventory, photos, bonn, failed) == 1
+    assert add(inventory, photos, bonn) == 0
+    assert inventory.stats()["trees"] == 1
+    thumbnail = inventory.images.path(bonn["image_id"], "thumbnail")
+    with Image.open(thumbnail) as image:
+        assert max(image.size) == 100
+
+def test_radius_query_returns_the_nearest_trees_first(inventory, photos):
+    add(inventory, photos, *(result(photos, n, place) for n, place in enumerate(["Berlin", "Cologne", "Bonn", None])))
+    total, rows = inventory.query(near=PLACES["Bonn"], radius_km=50)
+    assert total == 2
+    assert [row["location"] for row in rows] == ["Bonn", "Cologne"]
+    assert rows[0]["distance_km"] == pytest.approx(0, abs=1e-6)
+    assert rows[1]["distance_km"] == pytest.approx(distance_km(*PLACES["Bonn"], *PLACES["Cologne"]))
+    assert inventory.query(near=PLACES["Bonn"], radius_km=1000)[0] == 3
+
+def test_radius_query_crosses_the_antimeridian(inventory, photos):
+    add(inventory, photos, result(photos, 1, "Suva"), result(photos, 2, "Taveuni"))
+    total, rows = inventory.query(near=PLACES["Suva"], radius_km=300)
+    assert total == 2
+    assert [row["location"] for row in rows] == ["Suva", "Taveuni"]
+
+def test_bounding_box_contains_the_circle():
+    min_lat, max_lat, min_lon, max_lon = bounding_box(*PLACES["Bonn"], 50)
+    assert min_lat < PLACES["Cologne"][0] < max_lat and min_lon < PLACES["Cologne"][1] < max_lon
+    assert max_lat - min_lat == pytest.approx(2 * 50 / 111.195, rel=1e-3)
+
+@pytest.mark.parametrize("lat, lon", [(89.9, 0), (-89.9, 45), (0, 179.9), (-18.1, -179.95)])
+def test_bounding_box_spans_every_longitude_at_the_poles_and_the_antimeridian(lat, lon):
+    min_lat, max_lat, min_lon, max_lon = bounding_box(lat, lon, 50)
+    assert (min_lon, max_lon) == (-180, 180)
+    assert -90 <= min_lat < lat < max_lat <= 90
+
+def test_filters_by_grade_species_and_date(inventory, photos):
+    add(inventory, photos, result(photos, 1, "Bonn", health_grade="a"), analyzed_at=1000)
+    add(inventory, photos, result(photos, 2, "Berlin", health_grade="C", risk_grade="High", tree_type="Beech"), analyzed_at=2000)
+    assert [row["health_grade"] for row in inventory.query(health_grades=["A"])[1]] == ["A"]
+    assert inventory.query(risk_grades=["HIGH"])[0] == 1
+    assert [row["species"] for row in inventory.query(species=["Beech"])[1]] == ["Beech"]
+    assert [row["filename"] for row in inventory.query(since=1500)[1]] == ["tree2.jpg"]
+    assert [row["filename"] for row in inventory.query(until=1500)[1]] == ["tree1.jpg"]
+    assert [row["filename"] for row in inventory.query()[1]] == ["tree2.jpg", "tree1.jpg"]
+    assert inventory.species() == [("Beech", 1), ("Oak", 1)]
+
+def test_points_cover_only_geocoded_matches(inventory, photos):
+    add(inventory, photos, result(photos, 1, "Bonn"), result(photos, 2, "Nowhere"))
+    assert inventory.points() == [{"lat": PLACES["Bonn"][0], "lon": PLACES["Bonn"][1], "place": "Bonn", "species": "Oak", "filename": "tree1.jpg"}]
+    assert inventory.points(near=PLACES["Berlin"], radius_km=50) == []
+
+class FixedGeocoder:
+    def geocode_many(self, locations):
+        return {location: PLACES.get(location, (None, None)) for location in locations}
+
+class FakeClient:
+    def status(self):
+        return []
+
+def test_finished_job_adds_its_trees(inventory, tmp_path, monkeypatch):
+    def run_batch_analysis(client, images, image_store, *args, **kwargs):
+        for i, (filename, image_id) in enumerate(images):
+            yield i, {"id": f"r-{filename}", "filename": filename, "image_id": image_id, "model": "gpt-4.1",
+                      "analysis": {"tree_type": "Oak", "health_grade": "B", "location": "Bonn"}}
+    monkeypatch.setattr(job_queue, "run_batch_analysis", run_batch_analysis)
+    queue = JobQueue(str(tmp_path / "jobs"))
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 48), "green").save(buffer, format="JPEG")
+    options = {"lang": "English", "model": "gpt-4.1", "max_concurrency": 1, "use_cached": True, "preprocess_options": {},
+               "stream": False, "dedupe_threshold": None, "pack_size": 1}
+    job_id = queue.submit([("oak.jpg", buffer.getvalue())], options)
+    run_job(queue, queue.claim(), FakeClient(), AnalysisCache(str(tmp_path / "cache.sqlite3")), None, inventory, FixedGeocoder())
+    total, rows = inventory.query(near=PLACES["Bonn"], radius_km=1)
+    assert total == 1
+    assert (rows[0]["job_id"], rows[0]["filename"]) == (job_id, "oak.jpg")
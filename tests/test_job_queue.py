@@ -0,0 +1,195 @@
+import io
+import os
+import sqlite3
+import stat
+
+import pytest
+from PIL import Image
+
+import job_queue
+from job_queue import ENDPOINTS_FILE, JobQueue, load_worker_endpoints, run_job, run_worker, start_worker
+from metrics import METRICS
+from tree_pipeline import AnalysisCache
+
+OPTIONS = {"lang": "English", "model": "gpt-4.1", "max_concurrency": 2, "use_cached": True, "preprocess_options": {},
+           "stream": False, "dedupe_threshold": None, "pack_size": 1}
+
+def photo(color):
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 48), color).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(str(tmp_path / "jobs"))
+
+def submit(queue, count=3):
+    return queue.submit([(f"tree{n}.jpg", photo((40 * n, 120, 60))) for n in range(count)], OPTIONS)
+
+def payload(item, partial=False):
+    analysis = {"tree_type": item["filename"], "location": None}
+    return {"id": f"r-{item['position']}", "filename": item["filename"], "image_id": item["image_id"], "analysis": analysis, "partial": partial}
+
+class FakeClient:
+    def status(self):
+        return [{"endpoint": "a", "healthy": True}]
+
+@pytest.fixture
+def fake_batch(monkeypatch):
+    """Replaces run_batch_analysis: answers every image, and records which ones it was given."""
+    calls = []
+    def run_batch_analysis(client, images, image_store, lang, model, max_workers, cancel_events, **kwargs):
+        calls.append([filename for filename, _ in images])
+        for i, (filename, image_id) in enumerate(images):
+            yield i, {"id": f"r-{filename}", "filename": filename, "image_id": image_id, "analysis": {"tree_type": filename}}
+    monkeypatch.setattr(job_queue, "run_batch_analysis", run_batch_analysis)
+    return calls
+
+def test_submitted_job_is_claimed_once(queue):
+    job_id = submit(queue)
+    job = queue.claim()
+    assert (job["id"], job["status"], job["total"], job["done"], job["options"]) == (job_id, "running", 3, 0, OPTIONS)
+    assert queue.claim() is None
+    assert [item["filename"] for item in queue.items(job_id)] == ["tree0.jpg", "tree1.jpg", "tree2.jpg"]
+
+def test_jobs_are_claimed_oldest_first(queue):
+    first, second = submit(queue, 1), submit(queue, 1)
+    assert [queue.claim()["id"], queue.claim()["id"]] == [first, second]
+
+def test_final_results_are_not_overwritten(queue):
+    job_id = submit(queue, 1)
+    item = queue.items(job_id)[0]
+    queue.record(job_id, 0, payload(item, partial=True))
+    assert queue.items(job_id)[0]["status"] == "partial"
+    queue.record(job_id, 0, payload(item))
+    queue.record(job_id, 0, dict(payload(item), id="late"))
+    assert (queue.items(job_id)[0]["status"], queue.items(job_id)[0]["payload"]["id"]) == ("done", "r-0")
+
+def test_interrupted_job_is_requeued_without_its_partial_results(queue):
+    job_id = submit(queue)
+    queue.claim()
+    first, second, _ = queue.items(job_id)
+    queue.record(job_id, 0, payload(first))
+    queue.record(job_id, 1, payload(second, partial=True))
+    queue.requeue_interrupted()
+    assert queue.job(job_id)["status"] == "queued"
+    assert [(item["status"], item["payload"] is not None) for item in queue.items(job_id)] == [("done", True), ("pending", False), ("pending", False)]
+
+def test_resumed_job_only_analyzes_the_photos_without_a_result(queue, fake_batch, tmp_path):
+    job_id = submit(queue)
+    queue.claim()
+    queue.record(job_id, 0, payload(queue.items(job_id)[0]))
+    queue.requeue_interrupted()
+    run_job(queue, queue.claim(), FakeClient(), AnalysisCache(str(tmp_path / "cache.sqlite3")), None)
+    assert fake_batch == [["tree1.jpg", "tree2.jpg"]]
+    job = queue.job(job_id)
+    assert (job["status"], job["done"]) == ("done", 3)
+    assert queue.items(job_id)[0]["payload"]["id"] == "r-0"
+
+def test_cancelling_one_photo(queue):
+    job_id = submit(queue)
+    queue.cancel(job_id, position=1)
+    assert queue.cancelled_positions(job_id) == {1}
+    assert not queue.job(job_id)["cancel_requested"]
+    queue.finish(job_id)
+    assert queue.job(job_id)["status"] == "done"
+
+def test_cancelling_the_job_spares_finished_photos(queue):
+    job_id = submit(queue)
+    queue.record(job_id, 0, payload(queue.items(job_id)[0]))
+    queue.cancel(job_id)
+    assert queue.cancelled_positions(job_id) == {1, 2}
+    assert queue.job(job_id)["cancel_requested"]
+    queue.finish(job_id)
+    assert queue.job(job_id)["status"] == "cancelled"
+
+def test_failed_job_keeps_its_error(queue, monkeypatch, tmp_path):
+    def run_batch_analysis(*args, **kwargs):
+        raise RuntimeError("boom")
+        yield
+    monkeypatch.setattr(job_queue, "run_batch_analysis", run_batch_analysis)
+    job_id = submit(queue, 1)
+    run_job(queue, queue.claim(), FakeClient(), AnalysisCache(str(tmp_path / "cache.sqlite3")), None)
+    assert (queue.job(job_id)["status"], queue.job(job_id)["error"]) == ("failed", "RuntimeError: boom")
+
+def test_worker_stats_round_trip(queue, fake_batch, tmp_path):
+    assert queue.worker_stats() is None
+    cache = AnalysisCache(str(tmp_path / "cache.sqlite3"))
+    cache.get("missing")
+    submit(queue, 2)
+    run_job(queue, queue.claim(), FakeClient(), cache, None)
+    stats = queue.worker_stats()
+    assert stats["cache"] == {"hits": 0, "misses": 1}
+    assert stats["endpoints"] == FakeClient().status()
+    assert stats["saved_at"] > 0
+    METRICS.reset()
+    METRICS.merge(stats["metrics"])
+    assert METRICS.counter("cache_requests_total", cache="analysis", result="miss") == 1
+
+def test_purge_deletes_old_finished_jobs_with_their_photos(queue):
+    job_id = submit(queue, 1)
+    store_root = queue.image_store(job_id).root
+    queue.finish(job_id)
+    queue.purge(max_age_seconds=3600)
+    assert queue.job(job_id) is not None
+    queue.purge(max_age_seconds=-1)
+    assert queue.job(job_id) is None and queue.items(job_id) == []
+    assert not os.path.exists(store_root)
+
+ENDPOINTS = [{"name": "a", "endpoint": "https://a.example", "api_key": "secret", "api_version": "2024-10-21", "deployments": {}}]
+
+def age_worker_start(queue, seconds):
+    with sqlite3.connect(queue.path) as conn:
+        conn.execute("UPDATE worker_starts SET attempted_at = attempted_at - ?", (seconds,))
+
+@pytest.fixture
+def spawned(monkeypatch):
+    """Replaces the worker process spawn by a record of its command lines."""
+    commands = []
+    monkeypatch.setattr(job_queue.subprocess, "Popen", lambda command, **kwargs: commands.append(command))
+    return commands
+
+def test_the_worker_gets_the_dashboards_endpoints_readable_by_their_owner_only(queue, spawned):
+    start_worker(queue.jobs_dir, endpoints=ENDPOINTS)
+    assert len(spawned) == 1 and spawned[0][-2:] == ["--jobs-dir", queue.jobs_dir]
+    path = os.path.join(queue.jobs_dir, ENDPOINTS_FILE)
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    assert load_worker_endpoints(queue.jobs_dir) == ENDPOINTS
+
+def test_worker_starts_wait_for_the_grace_period(queue, spawned):
+    start_worker(queue.jobs_dir)
+    start_worker(queue.jobs_dir)
+    assert len(spawned) == 1
+    age_worker_start(queue, job_queue.WORKER_START_GRACE_SECONDS)
+    start_worker(queue.jobs_dir)
+    assert len(spawned) == 2
+
+def test_failed_worker_starts_back_off(queue):
+    assert queue.claim_worker_start()
+    queue.record_worker_start("Missing Azure OpenAI credentials: auth_key")
+    queue.record_worker_start("Missing Azure OpenAI credentials: auth_key")
+    assert queue.worker_start()["failures"] == 2
+    age_worker_start(queue, job_queue.WORKER_RESTART_BASE_SECONDS)
+    assert not queue.claim_worker_start()
+    age_worker_start(queue, job_queue.WORKER_RESTART_BASE_SECONDS)
+    assert queue.claim_worker_start()
+    queue.record_worker_start()
+    assert queue.worker_start()["failures"] == 0 and queue.worker_start()["error"] is None
+
+def test_a_worker_without_credentials_fails_the_queued_jobs(queue, monkeypatch):
+    def load_worker_endpoints(jobs_dir):
+        raise SystemExit("Missing Azure OpenAI credentials: auth_key")
+    monkeypatch.setattr(job_queue, "load_worker_endpoints", load_worker_endpoints)
+    job_id = submit(queue, 1)
+    assert run_worker(queue.jobs_dir) == 1
+    job = queue.job(job_id)
+    assert (job["status"], job["error"]) == ("failed", "Missing Azure OpenAI credentials: auth_key")
+    assert queue.worker_start()["failures"] == 1
+    assert not job_queue.worker_running(queue.jobs_dir)
+
+def test_one_worker_lock_at_a_time(queue):
+    lock_file = job_queue._try_lock(queue.jobs_dir)
+    assert lock_file is not None
+    assert job_queue._try_lock(queue.jobs_dir) is None and job_queue.worker_running(queue.jobs_dir)
+    lock_file.close()
+    assert not job_queue.worker_running(queue.jobs_dir)
@@ -0,0 +1,71 @@
+import json
+
+from openai import BadRequestError
+
+from fakes import FakeOpenAI, api_error, tree_analysis
+from metrics import METRICS
+from translations import get_text
+from tree_pipeline import TRANSLATION_MODEL, AnalysisCache, localize_results
+
+LANG = "Deutsch"
+
+def translated(request):
+    """Prefixes every field sent for translation with "DE: "."""
+    fields = json.loads(request["messages"][-1]["content"])
+    return json.dumps({path: f"DE: {value}" for path, value in fields.items()})
+
+def result(analysis=None, error=None, **fields):
+    return dict({"id": "image", "analysis": analysis, "error": error, "model": "gpt-4.1"}, **fields)
+
+def test_free_text_is_translated_and_grades_stay_as_analyzed():
+    client = FakeOpenAI(translated)
+    (index, payload), = localize_results(client, [result(tree_analysis(), usage={"requests": 1})], LANG)
+    analysis = payload["analysis"]
+    assert index == 0 and payload["usage"] == {"requests": 1}
+    assert analysis["tree_type"] == "DE: Pedunculate Oak (Quercus robur)"
+    assert analysis["risk_assessment"]["structural_stability_summary"] == "DE: Root plate intact."
+    assert (analysis["health_grade"], analysis["location"], analysis["native_origins"]) == ("B", "Bonn, Germany", ["Europe"])
+    assert analysis["risk_assessment"]["infection_and_hazard_potential_grade"] == "Low"
+    assert client.models() == [TRANSLATION_MODEL]
+
+def test_fixed_texts_come_from_the_translations():
+    client = FakeOpenAI(translated)
+    analysis = tree_analysis(felling_recommendations={"recommended_method": get_text("English", "felling_preservation_method")})
+    results = [result(analysis), result(error=get_text("English", "no_tree_text")), result(error=get_text("English", "cancelled_text"))]
+    localized = dict(localize_results(client, results, LANG))
+    assert localized[0]["analysis"]["felling_recommendations"]["recommended_method"] == get_text(LANG, "felling_preservation_method")
+    assert "recommended_method" not in client.requests[0]["messages"][-1]["content"]
+    assert (localized[1]["error"], localized[2]["error"]) == (get_text(LANG, "no_tree_text"), get_text(LANG, "cancelled_text"))
+    assert localized[1]["analysis"] is None
+
+def test_results_sharing_an_analysis_are_translated_once():
+    client = FakeOpenAI(translated)
+    results = [result(tree_analysis()), result(tree_analysis()), result(tree_analysis(tree_type="Beech"))]
+    localized = dict(localize_results(client, results, LANG))
+    assert len(client.requests) == 2
+    assert localized[0]["analysis"] == localized[1]["analysis"]
+    assert localized[2]["analysis"]["tree_type"] == "DE: Beech"
+
+def test_a_failed_translation_keeps_the_analysis_and_sets_localize_error():
+    client = FakeOpenAI(lambda request: api_error(BadRequestError, 400))
+    (_, payload), = localize_results(client, [result(tree_analysis())], LANG)
+    assert payload["analysis"] == tree_analysis()
+    assert payload["localize_error"].startswith("BadRequestError")
+
+def test_a_second_run_is_served_from_the_cache(tmp_path):
+    cache = AnalysisCache(str(tmp_path / "cache.sqlite3"))
+    first = dict(localize_results(FakeOpenAI(translated), [result(tree_analysis())], LANG, cache=cache))
+    client = FakeOpenAI(translated)
+    second = dict(localize_results(client, [result(tree_analysis())], LANG, cache=cache))
+    assert client.requests == [] and second == first
+    assert METRICS.counter("translations_total", lang=LANG) == 1
+
+def test_translation_lookups_do_not_count_as_analysis_hits(tmp_path):
+    cache = AnalysisCache(str(tmp_path / "cache.sqlite3"))
+    cache.put("t", {"notes": "übersetzt"})
+    assert cache.get("t", kind="translation") == {"notes": "übersetzt"}
+    assert cache.get("missing", kind="translation") is None
+    assert (cache.stats()["hits"], cache.stats()["misses"]) == (0, 0)
+    assert METRICS.counter("cache_requests_total", cache="translation") == 2
+    assert METRICS.counter("cache_requests_total", cache="analysis") == 0
+
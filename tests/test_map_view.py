@@ -0,0 +1,73 @@
+import io
+import random
+
+import pytest
+from PIL import Image
+
+from map_view import (
+    MAP_MAX_LABELS, MAP_MAX_POINTS, MAP_TOOLTIP_TREES, aggregate_points, build_map_deck, cluster_points, layer_rows, point_label,
+    point_tooltip, render_map_image
+)
+
+def point(lat, lon, place="Bonn", n=0):
+    return {"lat": lat, "lon": lon, "place": place, "species": "Oak", "filename": f"tree{n}.jpg"}
+
+def scattered(count, seed=0):
+    rng = random.Random(seed)
+    return [point(rng.uniform(47, 55), rng.uniform(6, 15), place=f"Place {n}", n=n) for n in range(count)]
+
+def test_points_at_one_position_are_merged():
+    points = [point(50.73741, 7.09821, n=n) for n in range(8)] + [point(50.737412, 7.098211, "Bonn, Germany", 8), point(52.52, 13.405, "Berlin", 9)]
+    bonn, berlin = aggregate_points(points)
+    assert (bonn["n"], bonn["places"]) == (9, {"Bonn": 8, "Bonn, Germany": 1})
+    assert bonn["trees"] == [(f"tree{n}.jpg", "Oak") for n in range(MAP_TOOLTIP_TREES)]
+    assert (berlin["n"], berlin["lat"], berlin["lon"]) == (1, 52.52, 13.405)
+
+def test_few_positions_are_not_clustered():
+    entries = aggregate_points(scattered(50))
+    assert cluster_points(entries) is entries
+
+def test_many_positions_are_clustered_below_the_limit_keeping_every_tree():
+    entries = aggregate_points(scattered(3000))
+    clusters = cluster_points(entries)
+    assert len(clusters) <= MAP_MAX_POINTS
+    assert sum(cluster["n"] for cluster in clusters) == 3000
+    assert sum(sum(cluster["places"].values()) for cluster in clusters) == 3000
+    assert all(len(cluster["trees"]) <= MAP_TOOLTIP_TREES for cluster in clusters)
+    assert [cluster["n"] for cluster in clusters] == sorted((cluster["n"] for cluster in clusters), reverse=True)
+
+def test_a_cluster_sits_at_the_tree_weighted_mean():
+    entries = [
+        {"lon": 7.0, "lat": 50.0, "n": 3, "places": {"a": 3}, "trees": []},
+        {"lon": 7.0004, "lat": 50.0004, "n": 1, "places": {"b": 1}, "trees": []},
+        {"lon": 9.0, "lat": 52.0, "n": 1, "places": {"c": 1}, "trees": []},
+    ]
+    merged, single = cluster_points(entries, max_points=2)
+    assert (merged["n"], merged["places"]) == (4, {"a": 3, "b": 1})
+    assert (merged["lon"], merged["lat"]) == (pytest.approx(7.0001), pytest.approx(50.0001))
+    assert single["places"] == {"c": 1}
+
+def test_labels_and_tooltips_summarize_a_point():
+    entry = aggregate_points([point(50.7, 7.1, n=n) for n in range(7)] + [point(50.7, 7.1, "Beuel", 7)])[0]
+    assert point_label(entry) == "Bonn +1 (8)"
+    assert point_label(aggregate_points([point(50.7, 7.1)])[0]) == "Bonn"
+    tooltip = point_tooltip(entry, "Photographed Location")
+    assert tooltip.count("File: ") == MAP_TOOLTIP_TREES and tooltip.endswith("… 3 more")
+
+def test_point_radius_grows_with_the_tree_count_up_to_a_cap():
+    small, large = layer_rows([{"lon": 0, "lat": 0, "n": 1, "places": {"a": 1}, "trees": []},
+                               {"lon": 0, "lat": 0, "n": 10_000, "places": {"a": 10_000}, "trees": []}], "")
+    assert small["r"] == 6.0 and large["r"] == 30
+    assert set(small) == {"lon", "lat", "r", "tooltip"}
+
+def test_deck_draws_each_layer_and_labels_only_the_largest_points():
+    deck = build_map_deck(scattered(3000), [point(50, 10, "Europe")])
+    scatter, labels, origins = deck.layers
+    assert len(scatter.data) <= MAP_MAX_POINTS and len(labels.data) == MAP_MAX_LABELS and len(origins.data) == 1
+    assert 47 <= deck.initial_view_state.latitude <= 55
+    assert build_map_deck([], []) is None
+
+def test_report_map_image_is_a_png_of_the_requested_size():
+    data = render_map_image(scattered(20), [], width=400, height=250)
+    with Image.open(io.BytesIO(data)) as image:
+        assert (image.format, image.size) == ("PNG", (400, 250))
@@ -0,0 +1,91 @@
+import json
+import threading
+
+import pytest
+from openai import BadRequestError
+
+from fakes import LANG, FakeOpenAI, api_error, photo, request_photos, store_photos, tree_analysis
+from metrics import METRICS
+from translations import get_text
+from tree_pipeline import analyze_pack, parse_packed_analyses, run_batch_analysis, summarize_usage
+
+MODEL = "gpt-4.1"
+
+def entry(number, index, **fields):
+    return dict(tree_analysis(tree_type=f"Tree {number}", **fields), image_index=index)
+
+def packed_reply(request, skip=()):
+    """Answers a packed request with one entry per photo, in reverse order; a single-photo request with its analysis."""
+    numbers = request_photos(request)
+    if len(numbers) == 1:
+        return json.dumps(tree_analysis(tree_type=f"Tree {numbers[0]}"))
+    return json.dumps({"trees": [entry(number, index) for index, number in reversed(list(enumerate(numbers, 1))) if number not in skip]})
+
+def run(client, store, images, pack_size=3):
+    return dict(run_batch_analysis(client, images, store, LANG, MODEL, 2, [threading.Event() for _ in images], pack_size=pack_size))
+
+def test_photos_are_sent_pack_size_per_request_and_matched_by_index(tmp_path):
+    store, images = store_photos(tmp_path, [photo(n) for n in range(5)])
+    client = FakeOpenAI(packed_reply)
+    results = run(client, store, images)
+    assert sorted(request_photos(request) for request in client.requests) == [[0, 1, 2], [3, 4]]
+    for i, payload in results.items():
+        assert payload["analysis"]["tree_type"] == f"Tree {i}" and "image_index" not in payload["analysis"]
+    assert summarize_usage(results.values())[MODEL]["requests"] == 2
+    assert METRICS.counter("analysis_images_total", model=MODEL, pack_size="3") == 3
+
+def test_a_photo_missing_from_the_reply_is_analyzed_on_its_own(tmp_path):
+    store, images = store_photos(tmp_path, [photo(n) for n in range(3)])
+    client = FakeOpenAI(lambda request: packed_reply(request, skip=(1,)))
+    results = run(client, store, images)
+    assert [request_photos(request) for request in client.requests] == [[0, 1, 2], [1]]
+    assert results[1]["analysis"]["tree_type"] == "Tree 1"
+    # Its share of the pack was paid for as well as its own request
+    assert [request["share"] for request in results[1]["requests"]] == [pytest.approx(1 / 3), 1]
+
+def test_a_truncated_reply_keeps_its_complete_entries(tmp_path):
+    store, images = store_photos(tmp_path, [photo(n) for n in range(3)])
+    def reply(request):
+        if len(request_photos(request)) == 1:
+            return packed_reply(request)
+        text = json.dumps({"trees": [entry(0, 1), entry(1, 2), entry(2, 3)]})
+        return text[:text.index('"image_index": 3') - 40], "length"
+    client = FakeOpenAI(reply)
+    results = run(client, store, images)
+    assert [request_photos(request) for request in client.requests] == [[0, 1, 2], [2]]
+    assert [results[i]["analysis"]["tree_type"] for i in range(3)] == ["Tree 0", "Tree 1", "Tree 2"]
+    assert METRICS.counter("reply_repairs_total", kind="salvaged") == 1
+
+def test_a_failed_pack_falls_back_to_one_request_per_photo(tmp_path):
+    store, images = store_photos(tmp_path, [photo(n) for n in range(3)])
+    client = FakeOpenAI(lambda request: api_error(BadRequestError, 400) if len(request_photos(request)) > 1 else packed_reply(request))
+    results = run(client, store, images)
+    assert sorted(request_photos(request) for request in client.requests) == [[0], [0, 1, 2], [1], [2]]
+    assert all(results[i]["analysis"]["tree_type"] == f"Tree {i}" for i in range(3))
+    assert METRICS.counter("pack_fallbacks_total", reason="BadRequestError", model=MODEL) == 1
+
+def test_an_unparsable_pack_falls_back_too(tmp_path):
+    store, images = store_photos(tmp_path, [photo(n) for n in range(2)])
+    client = FakeOpenAI(lambda request: "Sorry, I cannot help." if len(request_photos(request)) > 1 else packed_reply(request))
+    results = run(client, store, images)
+    assert len(client.requests) == 3 and results[1]["analysis"]["tree_type"] == "Tree 1"
+
+def test_unexpected_errors_are_not_hidden_by_the_fallback(tmp_path):
+    store, images = store_photos(tmp_path, [photo(n) for n in range(2)])
+    def reply(request):
+        raise KeyError("bug")
+    with pytest.raises(KeyError):
+        analyze_pack(FakeOpenAI(reply), images, store, LANG, MODEL, [threading.Event() for _ in images])
+    assert METRICS.counter("pack_fallbacks_total") == 0
+
+def test_no_tree_entries_become_errors(tmp_path):
+    store, images = store_photos(tmp_path, [photo(n) for n in range(2)])
+    client = FakeOpenAI(lambda request: json.dumps({"trees": [entry(0, 1), entry(1, 2, no_tree=True)]}))
+    payloads = analyze_pack(client, images, store, LANG, MODEL, [threading.Event() for _ in images])
+    assert payloads[0]["analysis"]["tree_type"] == "Tree 0"
+    assert payloads[1]["analysis"] is None and payloads[1]["error"] == get_text(LANG, "no_tree_text")
+
+def test_entries_without_a_usable_index_are_matched_by_position():
+    reply = json.dumps({"trees": [{"tree_type": "first"}, {"tree_type": "second", "image_index": 9}, {"tree_type": "third", "image_index": 1}]})
+    assert parse_packed_analyses(reply, 3) == [{"tree_type": "first"}, {"tree_type": "second"}, None]
+    assert parse_packed_analyses("", 2) == [None, None]
@@ -0,0 +1,92 @@
+import json
+import threading
+
+import pytest
+
+from fakes import LANG, FakeOpenAI, photo, store_photos, tree_analysis
+from metrics import METRICS
+from translations import get_text
+from tree_pipeline import (
+    CONTINUATION_PROMPT, NoTreeDetected, analyze_image, extract_json_object, join_continuation, parse_analysis
+)
+
+# --- extract_json_object ---
+def test_extract_json_object_plain_reply_is_not_a_repair():
+    assert extract_json_object('{"tree_type": "Oak"}') == {"tree_type": "Oak"}
+    assert METRICS.counter("reply_repairs_total") == 0
+
+@pytest.mark.parametrize("text", [
+    '```json\n{"tree_type": "Oak"}\n```',
+    'Here is the analysis:\n{"tree_type": "Oak"}\nLet me know if you need more.',
+])
+def test_extract_json_object_ignores_fences_and_surrounding_text(text):
+    assert extract_json_object(text) == {"tree_type": "Oak"}
+    assert METRICS.counter("reply_repairs_total", kind="extracted") == 1
+
+@pytest.mark.parametrize("text", ['{"tree_type": "Oak", "health', "No JSON here", '["Oak"]', ""])
+def test_extract_json_object_rejects_incomplete_or_non_object_replies(text):
+    with pytest.raises(json.JSONDecodeError):
+        extract_json_object(text)
+
+# --- join_continuation ---
+def test_join_continuation_appends_a_clean_continuation():
+    assert join_continuation('{"tree_type": "Oak", "no', 'tes": "ok"}') == '{"tree_type": "Oak", "notes": "ok"}'
+
+def test_join_continuation_drops_text_the_continuation_repeats():
+    text = '{"tree_type": "Oak", "notes": "Crown die'
+    joined = join_continuation(text, '"notes": "Crown dieback on the south side"}')
+    assert json.loads(joined) == {"tree_type": "Oak", "notes": "Crown dieback on the south side"}
+
+def test_join_continuation_uses_a_restarted_object():
+    restarted = '{"tree_type": "Oak", "notes": "ok"}'
+    assert join_continuation('{"tree_type": "Oa', restarted) == restarted
+
+def test_join_continuation_strips_markdown_fences():
+    assert json.loads(join_continuation('{"tree_type": "Oak", ', '```json\n"notes": "ok"}\n```')) == {"tree_type": "Oak", "notes": "ok"}
+
+def test_join_continuation_without_a_parsable_reading_returns_the_plain_join():
+    assert join_continuation('{"a": ', '"b') == '{"a": "b'
+
+# --- parse_analysis ---
+@pytest.mark.parametrize("reply", ["No tree", "`No tree`.", json.dumps({"no_tree": True})])
+def test_no_tree_replies(reply):
+    with pytest.raises(NoTreeDetected):
+        parse_analysis(reply)
+
+def test_empty_reply_is_no_analysis():
+    assert parse_analysis("") is None
+
+# --- repairs during an analysis ---
+def analyze(tmp_path, client):
+    store, [(filename, image_id)] = store_photos(tmp_path, [photo(0)])
+    return analyze_image(client, image_id, filename, store, LANG, "gpt-4.1", threading.Event())
+
+def test_fenced_reply_is_used_without_another_request(tmp_path):
+    client = FakeOpenAI(lambda request: "```json\n" + json.dumps(tree_analysis()) + "\n```\nHope this helps!")
+    payload = analyze(tmp_path, client)
+    assert payload["analysis"]["tree_type"] == tree_analysis()["tree_type"]
+    assert len(client.requests) == 1
+
+def test_truncated_reply_is_continued_instead_of_analyzed_again(tmp_path):
+    text = json.dumps(tree_analysis())
+    cut = len(text) // 2
+    def reply(request):
+        if request["messages"][-1]["content"] == CONTINUATION_PROMPT:
+            return text[cut - 20:] # repeats the end of the cut-off part
+        return text[:cut], "length"
+    client = FakeOpenAI(reply)
+    payload = analyze(tmp_path, client)
+    assert payload["analysis"] == {key: value for key, value in tree_analysis().items() if key != "no_tree"}
+    first, follow_up = client.requests
+    assert "response_format" in first and "response_format" not in follow_up
+    assert follow_up["messages"][:2] == first["messages"] and follow_up["messages"][2] == {"role": "assistant", "content": text[:cut]}
+    assert len(payload["requests"]) == 2
+    assert METRICS.counter("reply_repairs_total", kind="continuation") == 1
+
+def test_reply_without_json_is_an_error_with_the_raw_text(tmp_path):
+    payload = analyze(tmp_path, FakeOpenAI(lambda request: "I cannot analyze this image."))
+    assert payload["analysis"] is None and payload["raw_text"] == "I cannot analyze this image."
+
+def test_no_tree_reply_is_reported_as_such(tmp_path):
+    payload = analyze(tmp_path, FakeOpenAI(lambda request: json.dumps({"no_tree": True})))
+    assert payload["error"] == get_text(LANG, "no_tree_text")
@@ -0,0 +1,36 @@
+import re
+
+import pytest
+
+import report_export
+from fakes import photo, store_photos, tree_analysis
+from report_export import report_fields, write_pdf, write_xlsx
+from translations import get_text
+
+@pytest.fixture
+def batch(tmp_path):
+    store, images = store_photos(tmp_path, [photo(0), photo(1)])
+    results = [
+        {"filename": images[0][0], "image_id": images[0][1], "analysis": tree_analysis(), "model": "gpt-4.1"},
+        {"filename": images[1][0], "image_id": images[1][1], "analysis": None, "error": "No tree detected in the image."},
+    ]
+    return store, results
+
+def test_failed_photos_only_report_their_error():
+    fields = dict(report_fields({"analysis": None, "error": "boom"}, "English"))
+    assert fields[get_text("English", "report_error")] == "boom"
+    assert not any(value for label, value in fields.items() if label != get_text("English", "report_error"))
+
+def test_pdf_and_xlsx_are_written(tmp_path, batch):
+    store, results = batch
+    write_pdf(str(tmp_path / "report.pdf"), results, "English", store, [{"lat": 50.7, "lon": 7.1, "place": "Bonn", "species": "Oak", "filename": "tree0.jpg"}])
+    write_xlsx(str(tmp_path / "inventory.xlsx"), results, "English", store)
+    assert (tmp_path / "report.pdf").read_bytes().startswith(b"%PDF")
+    assert (tmp_path / "inventory.xlsx").read_bytes().startswith(b"PK")
+
+def test_a_chinese_pdf_without_a_cjk_font_fails_with_a_translated_message(tmp_path, batch, monkeypatch):
+    monkeypatch.setattr(report_export, "CJK_FONTS", [])
+    store, results = batch
+    with pytest.raises(RuntimeError, match=re.escape(get_text("中文", "export_no_cjk_font"))):
+        write_pdf(str(tmp_path / "report.pdf"), results, "中文", store)
+    assert not (tmp_path / "report.pdf").exists()
@@ -0,0 +1,72 @@
+import json
+import threading
+
+import pytest
+
+import tree_pipeline
+from fakes import LANG, FakeOpenAI, photo, store_photos, tree_analysis
+from tree_pipeline import AnalysisCancelled, parse_partial_json, run_batch_analysis, stream_completion_text
+
+def test_partial_json_keeps_complete_fields_and_drops_an_unfinished_key():
+    assert parse_partial_json('{"tree_type": "Oak", "health_gr') == {"tree_type": "Oak"}
+
+def test_partial_json_returns_a_string_value_as_far_as_received():
+    assert parse_partial_json('{"tree_type": "Oak", "notes": "Crown die') == {"tree_type": "Oak", "notes": "Crown die"}
+
+def test_partial_json_waits_for_numbers_and_literals_to_finish():
+    assert parse_partial_json('{"a": 1, "b": 12') == {"a": 1}
+    assert parse_partial_json('{"a": 1, "b": tru') == {"a": 1}
+    assert parse_partial_json('{"a": 1, "b": true,') == {"a": 1, "b": True}
+
+def test_partial_json_closes_open_arrays_and_objects():
+    assert parse_partial_json('{"origins": ["Japan", "Chi') == {"origins": ["Japan", "Chi"]}
+    assert parse_partial_json('{"risk": {"grade": "Low"}, "trees": [{"a": 1}, {"b"') == {"risk": {"grade": "Low"}, "trees": [{"a": 1}, {}]}
+
+def test_partial_json_drops_an_incomplete_escape():
+    assert parse_partial_json('{"a": "x\\u00') == {"a": "x"}
+    assert parse_partial_json('{"a": "x\\') == {"a": "x"}
+
+def test_partial_json_before_the_first_field():
+    assert parse_partial_json("") is None
+    assert parse_partial_json("```json\n") is None
+    assert not parse_partial_json('```json\n{"tre')
+
+def test_partial_json_of_a_complete_object_matches_json_loads():
+    text = json.dumps({"tree_type": "Oak", "grade": "B", "n": 3, "ok": False, "origins": ["Japan"], "risk": {"grade": None}})
+    assert parse_partial_json(text + "\n```") == json.loads(text)
+
+@pytest.fixture
+def every_chunk(monkeypatch):
+    """Parses and hands on partial results after every chunk instead of every STREAM_UPDATE_SECONDS."""
+    monkeypatch.setattr(tree_pipeline, "STREAM_UPDATE_SECONDS", 0)
+
+def test_streamed_text_is_passed_on_as_growing_partial_analyses(every_chunk):
+    partials = []
+    client = FakeOpenAI()
+    text, usage, finish_reason = stream_completion_text(client, threading.Event(), partials.append, model="gpt-4.1", messages=[])
+    assert json.loads(text) == tree_analysis()
+    assert (finish_reason, usage.completion_tokens) == ("stop", len(text) // 4)
+    assert client.requests[0]["stream"] and client.requests[0]["stream_options"] == {"include_usage": True}
+    assert partials and all(set(partial) <= set(tree_analysis()) for partial in partials)
+    assert [len(partial) for partial in partials] == sorted(len(partial) for partial in partials)
+
+def test_cancelling_closes_the_stream(every_chunk):
+    cancel_event = threading.Event()
+    streams = []
+    client = FakeOpenAI()
+    create = client.create
+    client.chat.completions.create = lambda **request: streams.append(create(**request)) or streams[-1]
+    with pytest.raises(AnalysisCancelled):
+        stream_completion_text(client, cancel_event, lambda partial: cancel_event.set(), model="gpt-4.1", messages=[])
+    assert streams[0].closed
+
+def test_batch_yields_partial_payloads_before_the_final_one(tmp_path, every_chunk):
+    store, images = store_photos(tmp_path, [photo(0), photo(1)])
+    client = FakeOpenAI(chunk_seconds=0.005)
+    results = list(run_batch_analysis(client, images, store, LANG, "gpt-4.1", 2, [threading.Event() for _ in images], stream=True))
+    for i in range(2):
+        payloads = [payload for j, payload in results if j == i]
+        assert len(payloads) > 1
+        *partials, final = payloads
+        assert all(payload.get("partial") for payload in partials) and not final.get("partial")
+        assert final["analysis"] == {key: value for key, value in tree_analysis().items() if key != "no_tree"}
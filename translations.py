@@ -0,0 +1,412 @@
+"""UI strings for every supported dashboard language."""
+
+translations = {
+    "English": {
+        "title": "🌳 Tree Health Dashboard",
+        "select_lang": "Select Language",
+        "select_model": "Select AI Model",
+        "cascade_option": "Cascade (gpt-4.1-mini, escalating to gpt-4.1)",
+        "clear_button": "Clear & Start Over",
+        "upload_prompt": "📤 Drag & drop or click to upload tree images",
+        "analyze_button": "Analyze Images",
+        "health_grade_header": "Health Grade Assessment",
+        "health_grade": "Health Grade",
+        "tree_type": "Tree Type",
+        "approx_age": "Approx. Age",
+        "location": "Photographed Location", # Origin / Location
+        "native_origins": "Native Origins",
+        "details_expander": "View Details & Chat",
+        "observations": "Observations",
+        "rehab_advice": "Rehabilitation Advice",
+        "chat_prompt": "Ask a follow-up question...",
+        "spinner_text": "Analyzing image {i} of {n}... 🌿",
+        "clear_toast": "✅ Reset complete. Ready for new images.",
+        "legend_header": "Health Grade Legend",
+        "summary_table_header": "Batch Analysis Summary",
+        "map_header": "Geographic Distribution of Trees",
+        "debug_expander": "Debug Info",
+        "map_fail_header": "Locations Not Found on Map",
+        "map_fail_info": "The following locations were too general to be plotted:",
+        "summary_filename": "Filename",
+        "map_legend_header": "Map Legend",
+        "map_legend_location": "Photographed Location",
+        "map_legend_origin": "Native Origin",
+        "risk_assessment_header": "Infection & Hazard Potential",
+        "risk_grade": "Risk Grade",
+        "felling_header": "Felling & Safety Recommendations",
+        "felling_method": "Recommended Method",
+        "felling_safety": "Safety Parameters",
+        "felling_preservation_method": "Tree is healthy. Prioritize preservation measures like pruning, reinforcement, or transplanting.",
+        "risk_grade_low": "Low",
+        "risk_grade_medium": "Medium",
+        "risk_grade_high": "High",
+        "risk_grade_critical": "Critical",
+        "risk_grade_unknown": "Unknown",
+        "risk_legend_header": "Risk Grade Legend",
+        "max_concurrency": "Max Concurrent Requests",
+        "cancelled_text": "Analysis cancelled.",
+        "job_progress": "{done} of {total} photos analyzed",
+        "job_queued": "Job {job_id} is waiting for the analysis worker…",
+        "job_attach_hint": "Job {job_id} runs in the background: this page can be closed and reopened later from the same link.",
+        "job_cancel": "Cancel remaining photos",
+        "job_cancel_photo": "Cancel",
+        "job_not_found": "Job {job_id} was not found; finished jobs are kept for 7 days.",
+        "job_failed": "The analysis job failed: {error}",
+        "no_tree_text": "No tree detected in the image.",
+        "pack_size": "Trees per request (1 = one request per photo)",
+        "model_caption": "Analyzed by {model}",
+        "model_escalated_caption": "Analyzed by {model} after triage by {triage} ({reason})",
+        "escalation_grade": "grade C–F",
+        "escalation_risk": "high risk",
+        "escalation_error": "triage failed",
+        "batch_usage": "Last batch: {images} photos in {seconds:.1f} s with {option}",
+        "batch_usage_model": "{model}: {requests} requests, {prompt} prompt + {completion} completion tokens, {seconds:.1f} s model time",
+        "preprocess_header": "Image Preprocessing",
+        "image_short_edge": "Short image edge (px)",
+        "image_short_edge_help": "Photos are downsized to this length on their short side before upload. The model itself works at 768 px, so smaller values trade detail for fewer tokens.",
+        "jpeg_quality": "JPEG quality",
+        "dedupe_toggle": "Analyze near-duplicate photos once",
+        "dedupe_threshold": "Near-duplicate threshold (differing bits of 64)",
+        "duplicate_caption": "Near-duplicate of {source} (distance {distance}/64): analysis reused.",
+        "duplicate_cached_source": "a previously analyzed photo",
+        "summary_group": "Duplicate group",
+        "summary_group_cached": "cached (≈{distance})",
+        "summary_sort": "Sort by",
+        "summary_sort_upload": "Upload order",
+        "summary_sort_health": "Health grade (worst first)",
+        "summary_sort_risk": "Risk grade (highest first)",
+        "summary_page": "Page",
+        "summary_rows_caption": "Rows {first}–{last} of {shown} ({total} photos in the batch)",
+        "export_header": "Export",
+        "export_pdf": "Create PDF report",
+        "export_xlsx": "Create XLSX inventory",
+        "export_running": "Writing the file in the background…",
+        "export_download_pdf": "Download PDF report",
+        "export_download_xlsx": "Download XLSX inventory",
+        "export_failed": "Export failed: {error}",
+        "export_no_cjk_font": "A Chinese PDF report needs a CJK font, and none is installed. Install fonts-noto-cjk or set TREE_REPORT_CJK_FONT to a CJK font file.",
+        "inventory_header": "Tree Inventory",
+        "inventory_empty": "Trees are added to the inventory when their analysis job finishes.",
+        "inventory_near": "Near place or coordinates",
+        "inventory_near_help": "A place name, or latitude and longitude such as 50.73, 7.10. Leave empty to search everywhere.",
+        "inventory_radius": "Radius (km)",
+        "inventory_dates": "Analyzed between",
+        "inventory_near_unknown": "\"{place}\" could not be located.",
+        "inventory_matches": "{total} of {trees} trees match; showing {shown}.",
+        "inventory_analyzed": "Analyzed",
+        "inventory_distance": "Distance (km)",
+        "translate_results": "Translate results into the selected language",
+        "translate_results_help": "Analyses are translated by text-only requests when the language is switched; the photos are not analyzed again.",
+        "translating": "Translating analyses… {done} of {total}",
+        "translation_failed": "{count} analyses could not be translated and are shown in their original language.",
+        "translation_retry": "Retry translation",
+        "report_title": "Tree Inspection Report",
+        "report_generated": "Generated {date} · {count} photos",
+        "report_photo": "Photo",
+        "report_disease": "Disease / Pests",
+        "report_safety_distance": "Min. Safety Distance (m)",
+        "report_personnel": "Personnel",
+        "report_equipment": "Equipment",
+        "report_infection_risk": "Infectious Risk",
+        "report_structural_risk": "Structural Stability",
+        "report_failure_consequence": "Consequence of Failure",
+        "report_model": "Model",
+        "report_error": "Error",
+        "report_inventory_sheet": "Inventory",
+        "report_map_sheet": "Map",
+        "stream_responses": "Stream responses",
+        "streaming_text": "receiving analysis…",
+        "chat_header": "Follow-up Chat",
+        "chat_context_budget": "Context budget (tokens)",
+        "chat_context_stats": "Context: {total} tokens (analysis {prefix}, summary {summary}, recent turns {history}) · {folded} earlier messages summarized",
+        "chat_usage_stats": "billed {prompt_tokens} prompt ({cached_tokens} cached) + {completion_tokens} completion tokens",
+        "cache_header": "Analysis Cache",
+        "cache_bypass": "Bypass cache (always call the model)",
+        "cache_clear_button": "Clear Cache",
+        "cache_stats": "{hits} hits / {misses} misses · {entries} entries ({size_mb:.1f} MB)",
+        "diagnostics_toggle": "Show performance diagnostics",
+        "diagnostics_header": "Diagnostics",
+        "diagnostics_stages": "Stage timings in this server process and the analysis worker (seconds)",
+        "diagnostics_endpoints": "Azure OpenAI endpoints (quota left in this process)",
+        "diagnostics_worker_endpoints": "Azure OpenAI endpoints of the analysis worker (as of {age:.0f} s ago)",
+        "diagnostics_packing": "Prompt tokens per photo, by trees per request: {stats}",
+        "diagnostics_cascade": "Cascade escalations: {stats}",
+        "diagnostics_summary": "Tokens: {prompt} prompt ({cached} cached), {completion} completion · Retries: {retries} · Cache hit rate: analyses {analysis_hits}, geocoding {geocode_hits}",
+        "diagnostics_download_prometheus": "Download metrics (Prometheus)",
+        "diagnostics_download_json": "Download metrics (JSON)",
+        "diagnostics_startup": "Startup: imports {imports:.2f} s this run ({cold_imports:.2f} s cold) · first paint of this session {first_paint:.2f} s"
+    },
+    "Deutsch": {
+        "title": "🌳 Baumgesundheits-Dashboard",
+        "select_lang": "Sprache auswählen",
+        "select_model": "KI-Modell auswählen",
+        "cascade_option": "Kaskade (gpt-4.1-mini, bei Bedarf gpt-4.1)",
+        "clear_button": "Löschen & Neustarten",
+        "upload_prompt": "📤 Bilder per Drag & Drop oder Klick hochladen",
+        "analyze_button": "Bilder analysieren",
+        "health_grade_header": "Gesundheitsbewertung",
+        "health_grade": "Gesundheitsgrad",
+        "tree_type": "Baumart",
+        "approx_age": "Ungefähres Alter",
+        "location": "Fotografierter Standort", # Herkunft / Standort
+        "native_origins": "Heimische Herkunft",
+        "details_expander": "Details & Chat anzeigen",
+        "observations": "Beobachtungen",
+        "rehab_advice": "Rehabilitationsratschläge",
+        "chat_prompt": "Stellen Sie eine Folgefrage...",
+        "spinner_text": "Analysiere Bild {i} von {n}... 🌿",
+        "clear_toast": "✅ Zurücksetzen abgeschlossen. Bereit für neue Bilder.",
+        "legend_header": "Legende der Gesundheitsgrade",
+        "summary_table_header": "Zusammenfassung der Stapelanalyse",
+        "map_header": "Geografische Verteilung der Bäume",
+        "debug_expander": "Debug-Informationen",
+        "map_fail_header": "Standorte, die nicht auf der Karte gefunden wurden",
+        "map_fail_info": "Die folgenden Standorte waren zu allgemein, um dargestellt zu werden:",
+        "summary_filename": "Dateiname",
+        "map_legend_header": "Kartenlegende",
+        "map_legend_location": "Fotografierter Standort",
+        "map_legend_origin": "Heimische Herkunft",
+        "risk_assessment_header": "Infektions- und Gefahrenpotenzial",
+        "risk_grade": "Risikograd",
+        "felling_header": "Fäll- und Sicherheitsempfehlungen",
+        "felling_method": "Empfohlene Methode",
+        "felling_safety": "Sicherheitsparameter",
+        "felling_preservation_method": "Baum ist gesund. Priorisieren Sie Erhaltungsmaßnahmen wie Schnitt, Verstärkung oder Umpflanzung.",
+        "risk_grade_low": "Niedrig",
+        "risk_grade_medium": "Mittel",
+        "risk_grade_high": "Hoch",
+        "risk_grade_critical": "Kritisch",
+        "risk_grade_unknown": "Unbekannt",
+        "risk_legend_header": "Legende der Risikograde",
+        "max_concurrency": "Max. gleichzeitige Anfragen",
+        "cancelled_text": "Analyse abgebrochen.",
+        "job_progress": "{done} von {total} Fotos analysiert",
+        "job_queued": "Auftrag {job_id} wartet auf den Analyse-Worker…",
+        "job_attach_hint": "Auftrag {job_id} läuft im Hintergrund: Diese Seite kann geschlossen und später über denselben Link wieder geöffnet werden.",
+        "job_cancel": "Restliche Fotos abbrechen",
+        "job_cancel_photo": "Abbrechen",
+        "job_not_found": "Auftrag {job_id} wurde nicht gefunden; abgeschlossene Aufträge werden 7 Tage aufbewahrt.",
+        "job_failed": "Der Analyseauftrag ist fehlgeschlagen: {error}",
+        "no_tree_text": "Auf dem Bild wurde kein Baum erkannt.",
+        "pack_size": "Bäume pro Anfrage (1 = eine Anfrage pro Foto)",
+        "model_caption": "Analysiert von {model}",
+        "model_escalated_caption": "Analysiert von {model} nach Vorprüfung durch {triage} ({reason})",
+        "escalation_grade": "Note C–F",
+        "escalation_risk": "hohes Risiko",
+        "escalation_error": "Vorprüfung fehlgeschlagen",
+        "batch_usage": "Letzter Durchlauf: {images} Fotos in {seconds:.1f} s mit {option}",
+        "batch_usage_model": "{model}: {requests} Anfragen, {prompt} Prompt- + {completion} Antwort-Tokens, {seconds:.1f} s Modellzeit",
+        "preprocess_header": "Bildvorverarbeitung",
+        "image_short_edge": "Kurze Bildkante (px)",
+        "image_short_edge_help": "Fotos werden vor dem Hochladen auf diese Länge der kurzen Seite verkleinert. Das Modell selbst arbeitet mit 768 px; kleinere Werte sparen Tokens auf Kosten von Details.",
+        "jpeg_quality": "JPEG-Qualität",
+        "dedupe_toggle": "Fast identische Fotos nur einmal analysieren",
+        "dedupe_threshold": "Schwelle für Duplikate (abweichende Bits von 64)",
+        "duplicate_caption": "Fast identisch mit {source} (Abstand {distance}/64): Analyse übernommen.",
+        "duplicate_cached_source": "einem bereits analysierten Foto",
+        "summary_group": "Duplikatgruppe",
+        "summary_group_cached": "Cache (≈{distance})",
+        "summary_sort": "Sortieren nach",
+        "summary_sort_upload": "Upload-Reihenfolge",
+        "summary_sort_health": "Gesundheitsgrad (schlechteste zuerst)",
+        "summary_sort_risk": "Risikograd (höchste zuerst)",
+        "summary_page": "Seite",
+        "summary_rows_caption": "Zeilen {first}–{last} von {shown} ({total} Fotos im Stapel)",
+        "export_header": "Export",
+        "export_pdf": "PDF-Bericht erstellen",
+        "export_xlsx": "XLSX-Inventar erstellen",
+        "export_running": "Datei wird im Hintergrund geschrieben…",
+        "export_download_pdf": "PDF-Bericht herunterladen",
+        "export_download_xlsx": "XLSX-Inventar herunterladen",
+        "export_failed": "Export fehlgeschlagen: {error}",
+        "export_no_cjk_font": "Ein chinesischer PDF-Bericht benötigt eine CJK-Schriftart, es ist aber keine installiert. Installieren Sie fonts-noto-cjk oder setzen Sie TREE_REPORT_CJK_FONT auf eine CJK-Schriftdatei.",
+        "inventory_header": "Baumkataster",
+        "inventory_empty": "Bäume werden ins Kataster übernommen, sobald ihr Analyseauftrag abgeschlossen ist.",
+        "inventory_near": "In der Nähe von Ort oder Koordinaten",
+        "inventory_near_help": "Ein Ortsname oder Breiten- und Längengrad wie 50.73, 7.10. Leer lassen, um überall zu suchen.",
+        "inventory_radius": "Radius (km)",
+        "inventory_dates": "Analysiert zwischen",
+        "inventory_near_unknown": "„{place}“ konnte nicht gefunden werden.",
+        "inventory_matches": "{total} von {trees} Bäumen passen; {shown} werden angezeigt.",
+        "inventory_analyzed": "Analysiert",
+        "inventory_distance": "Entfernung (km)",
+        "translate_results": "Ergebnisse in die gewählte Sprache übersetzen",
+        "translate_results_help": "Beim Sprachwechsel werden die Analysen per Textanfrage übersetzt; die Fotos werden nicht erneut analysiert.",
+        "translating": "Analysen werden übersetzt… {done} von {total}",
+        "translation_failed": "{count} Analysen konnten nicht übersetzt werden und werden in ihrer Originalsprache angezeigt.",
+        "translation_retry": "Übersetzung wiederholen",
+        "report_title": "Baumkontrollbericht",
+        "report_generated": "Erstellt am {date} · {count} Fotos",
+        "report_photo": "Foto",
+        "report_disease": "Krankheit / Schädlinge",
+        "report_safety_distance": "Min. Sicherheitsabstand (m)",
+        "report_personnel": "Personal",
+        "report_equipment": "Ausrüstung",
+        "report_infection_risk": "Infektionsrisiko",
+        "report_structural_risk": "Standsicherheit",
+        "report_failure_consequence": "Folgen eines Versagens",
+        "report_model": "Modell",
+        "report_error": "Fehler",
+        "report_inventory_sheet": "Inventar",
+        "report_map_sheet": "Karte",
+        "stream_responses": "Antworten streamen",
+        "streaming_text": "Analyse wird empfangen…",
+        "chat_header": "Rückfragen-Chat",
+        "chat_context_budget": "Kontextbudget (Tokens)",
+        "chat_context_stats": "Kontext: {total} Tokens (Analyse {prefix}, Zusammenfassung {summary}, letzte Nachrichten {history}) · {folded} frühere Nachrichten zusammengefasst",
+        "chat_usage_stats": "abgerechnet {prompt_tokens} Prompt- ({cached_tokens} aus Cache) + {completion_tokens} Antwort-Tokens",
+        "cache_header": "Analyse-Cache",
+        "cache_bypass": "Cache umgehen (Modell immer aufrufen)",
+        "cache_clear_button": "Cache leeren",
+        "cache_stats": "{hits} Treffer / {misses} Fehlgriffe · {entries} Einträge ({size_mb:.1f} MB)",
+        "diagnostics_toggle": "Leistungsdiagnose anzeigen",
+        "diagnostics_header": "Diagnose",
+        "diagnostics_stages": "Dauer je Verarbeitungsschritt in diesem Serverprozess und im Analyse-Worker (Sekunden)",
+        "diagnostics_endpoints": "Azure-OpenAI-Endpunkte (verbleibendes Kontingent in diesem Prozess)",
+        "diagnostics_worker_endpoints": "Azure-OpenAI-Endpunkte des Analyse-Workers (Stand vor {age:.0f} s)",
+        "diagnostics_packing": "Prompt-Tokens pro Foto, nach Bäumen pro Anfrage: {stats}",
+        "diagnostics_cascade": "Eskalationen der Kaskade: {stats}",
+        "diagnostics_summary": "Tokens: {prompt} Prompt ({cached} aus Cache), {completion} Antwort · Wiederholungen: {retries} · Cache-Trefferquote: Analysen {analysis_hits}, Geokodierung {geocode_hits}",
+        "diagnostics_download_prometheus": "Metriken herunterladen (Prometheus)",
+        "diagnostics_download_json": "Metriken herunterladen (JSON)",
+        "diagnostics_startup": "Start: Importe {imports:.2f} s in diesem Lauf ({cold_imports:.2f} s beim Kaltstart) · erste vollständige Darstellung dieser Sitzung {first_paint:.2f} s"
+    },
+    "中文": {
+        "title": "🌳 树木健康仪表板",
+        "select_lang": "选择语言",
+        "select_model": "选择AI模型",
+        "cascade_option": "级联（gpt-4.1-mini，必要时升级到 gpt-4.1）",
+        "clear_button": "清除并重新开始",
+        "upload_prompt": "📤 拖拽或点击上传树木图片",
+        "analyze_button": "分析图片",
+        "health_grade_header": "健康等级评估",
+        "health_grade": "健康等级",
+        "tree_type": "树木种类",
+        "approx_age": "大约年龄",
+        "location": "拍摄地 / 位置",
+        "native_origins": "主要原产地",
+        "details_expander": "查看详情与对话",
+        "observations": "观察结果",
+        "rehab_advice": "复健建议",
+        "chat_prompt": "提出后续问题...",
+        "spinner_text": "正在分析第 {i} 张图片，共 {n} 张... 🌿",
+        "clear_toast": "✅ 重置完成，请上传新图片。",
+        "legend_header": "健康等级图例",
+        "summary_table_header": "批量分析总览",
+        "map_header": "树木地理位置分布",
+        "debug_expander": "调试信息",
+        "map_fail_header": "地图上未找到的位置",
+        "map_fail_info": "以下位置因过于宽泛而无法标示：",
+        "summary_filename": "文件名",
+        "map_legend_header": "地图图例",
+        "map_legend_location": "拍摄位置",
+        "map_legend_origin": "原生栖息地",
+        "risk_assessment_header": "感染与危险潜力评估",
+        "risk_grade": "风险等级",
+        "felling_header": "伐木技术及安全建议",
+        "felling_method": "推荐方法",
+        "felling_safety": "安全参数",
+        "felling_preservation_method": "树木健康，优先考虑修剪、加固或移植等保护措施。",
+        "risk_grade_low": "低",
+        "risk_grade_medium": "中",
+        "risk_grade_high": "高",
+        "risk_grade_critical": "危急",
+        "risk_grade_unknown": "未知",
+        "risk_legend_header": "风险等级图例",
+        "max_concurrency": "最大并发请求数",
+        "cancelled_text": "分析已取消。",
+        "job_progress": "已分析 {done} / {total} 张照片",
+        "job_queued": "任务 {job_id} 正在等待分析进程…",
+        "job_attach_hint": "任务 {job_id} 在后台运行：可以关闭此页面，稍后通过同一链接重新打开。",
+        "job_cancel": "取消剩余照片",
+        "job_cancel_photo": "取消",
+        "job_not_found": "未找到任务 {job_id}；已完成的任务保留 7 天。",
+        "job_failed": "分析任务失败：{error}",
+        "no_tree_text": "图像中未检测到树木。",
+        "pack_size": "每次请求的树木数量（1 = 每张照片一次请求）",
+        "model_caption": "由 {model} 分析",
+        "model_escalated_caption": "经 {triage} 初筛后由 {model} 分析（{reason}）",
+        "escalation_grade": "等级 C–F",
+        "escalation_risk": "高风险",
+        "escalation_error": "初筛失败",
+        "batch_usage": "上一批次：{images} 张照片，用时 {seconds:.1f} 秒，模型：{option}",
+        "batch_usage_model": "{model}：{requests} 次请求，{prompt} 提示词 + {completion} 生成 token，模型耗时 {seconds:.1f} 秒",
+        "preprocess_header": "图像预处理",
+        "image_short_edge": "图像短边长度（像素）",
+        "image_short_edge_help": "上传前将照片短边缩小到此长度。模型本身按 768 像素处理，较小的值以细节换取更少的 token。",
+        "jpeg_quality": "JPEG 质量",
+        "dedupe_toggle": "近似重复的照片只分析一次",
+        "dedupe_threshold": "近似重复阈值（64 位中不同的位数）",
+        "duplicate_caption": "与 {source} 近似重复（距离 {distance}/64）：已复用其分析结果。",
+        "duplicate_cached_source": "先前分析过的照片",
+        "summary_group": "重复组",
+        "summary_group_cached": "缓存（≈{distance}）",
+        "summary_sort": "排序方式",
+        "summary_sort_upload": "上传顺序",
+        "summary_sort_health": "健康等级（最差优先）",
+        "summary_sort_risk": "风险等级（最高优先）",
+        "summary_page": "页码",
+        "summary_rows_caption": "第 {first}–{last} 行，共 {shown} 行（本批次 {total} 张照片）",
+        "export_header": "导出",
+        "export_pdf": "生成 PDF 报告",
+        "export_xlsx": "生成 XLSX 清单",
+        "export_running": "正在后台写入文件…",
+        "export_download_pdf": "下载 PDF 报告",
+        "export_download_xlsx": "下载 XLSX 清单",
+        "export_failed": "导出失败：{error}",
+        "export_no_cjk_font": "中文 PDF 报告需要 CJK 字体，但系统未安装。请安装 fonts-noto-cjk，或将 TREE_REPORT_CJK_FONT 设置为 CJK 字体文件。",
+        "inventory_header": "树木档案",
+        "inventory_empty": "分析任务完成后，树木会被加入档案。",
+        "inventory_near": "地点或坐标附近",
+        "inventory_near_help": "地名，或纬度和经度，例如 50.73, 7.10。留空则不限地点。",
+        "inventory_radius": "半径（公里）",
+        "inventory_dates": "分析日期",
+        "inventory_near_unknown": "无法定位“{place}”。",
+        "inventory_matches": "{trees} 棵树中有 {total} 棵符合条件；显示 {shown} 棵。",
+        "inventory_analyzed": "分析日期",
+        "inventory_distance": "距离（公里）",
+        "translate_results": "将结果翻译为所选语言",
+        "translate_results_help": "切换语言时，通过纯文本请求翻译分析结果，不会重新分析照片。",
+        "translating": "正在翻译分析结果… {done} / {total}",
+        "translation_failed": "{count} 条分析结果未能翻译，以原始语言显示。",
+        "translation_retry": "重试翻译",
+        "report_title": "树木检查报告",
+        "report_generated": "生成于 {date} · {count} 张照片",
+        "report_photo": "照片",
+        "report_disease": "病害 / 虫害",
+        "report_safety_distance": "最小安全距离（米）",
+        "report_personnel": "人员",
+        "report_equipment": "设备",
+        "report_infection_risk": "传染风险",
+        "report_structural_risk": "结构稳定性",
+        "report_failure_consequence": "倒伏后果",
+        "report_model": "模型",
+        "report_error": "错误",
+        "report_inventory_sheet": "清单",
+        "report_map_sheet": "地图",
+        "stream_responses": "流式显示回复",
+        "streaming_text": "正在接收分析结果…",
+        "chat_header": "追问对话",
+        "chat_context_budget": "上下文预算（tokens）",
+        "chat_context_stats": "上下文：{total} tokens（分析 {prefix}，摘要 {summary}，最近消息 {history}）· 已摘要 {folded} 条较早消息",
+        "chat_usage_stats": "计费 {prompt_tokens} 提示（{cached_tokens} 命中缓存）+ {completion_tokens} 生成 tokens",
+        "cache_header": "分析缓存",
+        "cache_bypass": "绕过缓存（始终调用模型）",
+        "cache_clear_button": "清除缓存",
+        "cache_stats": "命中 {hits} 次 / 未命中 {misses} 次 · {entries} 条记录（{size_mb:.1f} MB）",
+        "diagnostics_toggle": "显示性能诊断",
+        "diagnostics_header": "诊断",
+        "diagnostics_stages": "本服务器进程及分析进程中各处理阶段耗时（秒）",
+        "diagnostics_endpoints": "Azure OpenAI 端点（本进程剩余配额）",
+        "diagnostics_worker_endpoints": "分析进程的 Azure OpenAI 端点（{age:.0f} 秒前的状态）",
+        "diagnostics_packing": "每张照片的提示词 token，按每次请求的树木数量：{stats}",
+        "diagnostics_cascade": "级联升级次数：{stats}",
+        "diagnostics_summary": "Tokens：提示 {prompt}（缓存 {cached}），生成 {completion} · 重试：{retries} 次 · 缓存命中率：分析 {analysis_hits}，地理编码 {geocode_hits}",
+        "diagnostics_download_prometheus": "下载指标（Prometheus）",
+        "diagnostics_download_json": "下载指标（JSON）",
+        "diagnostics_startup": "启动：本次运行导入 {imports:.2f} 秒（冷启动 {cold_imports:.2f} 秒）· 本会话首次完整渲染 {first_paint:.2f} 秒"
+    }
+}
+
+def get_text(lang, key):
+    return translations.get(lang, translations["English"]).get(key)
@@ -0,0 +1,270 @@
+"""Headless batch analysis of tree photos, for nightly jobs over large surveys.
+
+    python tree_batch.py photos/ --output survey.jsonl
+    python tree_batch.py --manifest survey.csv --output survey.parquet --format parquet
+
+Results are appended to a JSONL checkpoint as each image completes (the output
+itself for --format jsonl). Re-running the same command skips every image that
+already has a successful record, so an interrupted run resumes where it stopped.
+Near-duplicate photos (burst shots of one tree) are analyzed once, see --dedupe-threshold.
+With --model cascade every photo is triaged by gpt-4.1-mini and only poor grades, high
+risks and failed triages are re-analyzed by gpt-4.1; the model requests and tokens
+used per model are printed at the end for comparison with single-model runs.
+Analyzed trees are added to the dashboard's tree inventory (inventory.py) after every
+chunk, unless --no-inventory is given.
+Credentials come from AZURE_OPENAI_ENDPOINT / AZURE_OPENAI_API_KEY /
+AZURE_OPENAI_API_VERSION, falling back to the dashboard's .streamlit/secrets.toml
+(including its azure_endpoints list, see client_pool.py).
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import threading
+import tomllib
+from datetime import datetime, timezone
+
+from image_preprocessing import create_preprocess_pool, VISION_MAX_EDGE, VISION_SHORT_EDGE, JPEG_QUALITY, DEDUPE_THRESHOLD
+from client_pool import EndpointPool, endpoint_configs
+from geocoding import Geocoder
+from inventory import TreeInventory
+from metrics import METRICS
+from tree_pipeline import (
+    CACHE_DIR, MAX_PACK_SIZE, CASCADE_MODEL, AnalysisCache, FileImageSource, get_grade_details, get_risk_grade_details,
+    prompt_version, run_batch_analysis, summarize_usage
+)
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp"}
+# Images handed to the engine at once; bounds how much hashing happens before requests start
+CHUNK_SIZE = 256
+PARQUET_BATCH_ROWS = 1000
+RECORD_FIELDS = [
+    "path", "filename", "image_sha256", "model", "escalated", "lang", "prompt_version", "status",
+    "health_grade", "health_grade_desc", "risk_grade", "risk_grade_desc", "tree_type", "location",
+    "analysis", "error", "raw_text", "duplicate_of", "analyzed_at",
+]
+
+def iter_image_paths(inputs, manifest=None):
+    """Yields absolute image paths from directories/files and an optional .txt or .csv manifest."""
+    if manifest:
+        base_dir = os.path.dirname(os.path.abspath(manifest))
+        with open(manifest, newline="", encoding="utf-8") as f:
+            if manifest.lower().endswith(".csv"):
+                reader = csv.DictReader(f)
+                column = "path" if "path" in (reader.fieldnames or []) else reader.fieldnames[0]
+                entries = [row[column] for row in reader]
+            else:
+                entries = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+        for entry in entries:
+            yield os.path.normpath(os.path.join(base_dir, entry))
+    for item in inputs:
+        if os.path.isdir(item):
+            for dirpath, dirnames, filenames in os.walk(item):
+                dirnames.sort()
+                for name in sorted(filenames):
+                    if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                        yield os.path.abspath(os.path.join(dirpath, name))
+        else:
+            yield os.path.abspath(item)
+
+def load_completed(checkpoint_path, retry_failed=True):
+    """Paths that already have a final record in the checkpoint."""
+    completed = set()
+    if not os.path.exists(checkpoint_path):
+        return completed
+    with open(checkpoint_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue # Torn last line from a killed run
+            if record.get("status") == "ok" or not retry_failed:
+                completed.add(record["path"])
+            else:
+                completed.discard(record["path"])
+    return completed
+
+def build_record(path, image_id, payload, lang, model):
+    """Flattens a result payload into an output row, using the dashboard's grade mappings."""
+    res = payload["analysis"] or {}
+    health_grade = res.get("health_grade")
+    risk_grade = (res.get("risk_assessment") or {}).get("infection_and_hazard_potential_grade")
+    return {
+        "path": path,
+        "filename": os.path.basename(path),
+        "image_sha256": image_id,
+        # The model that produced the analysis; with the cascade, why it was escalated
+        "model": payload.get("model") or model,
+        "escalated": payload.get("escalated"),
+        "lang": lang,
+        "prompt_version": prompt_version(lang),
+        "status": "ok" if payload["analysis"] else "error",
+        "health_grade": health_grade,
+        "health_grade_desc": get_grade_details(health_grade)["desc"] if payload["analysis"] else None,
+        "risk_grade": risk_grade,
+        "risk_grade_desc": get_risk_grade_details(risk_grade, lang)["desc"] if payload["analysis"] else None,
+        "tree_type": res.get("tree_type"),
+        "location": res.get("location"),
+        "analysis": payload["analysis"],
+        "error": payload["error"],
+        "raw_text": payload["raw_text"],
+        # image_sha256 of the near-duplicate photo whose analysis was reused
+        "duplicate_of": (payload.get("duplicate_of") or {}).get("image_id"),
+        "analyzed_at": datetime.now(timezone.utc).isoformat(),
+    }
+
+def load_endpoints():
+    """Endpoint configs for EndpointPool: the environment first, then the dashboard's secrets."""
+    credentials = {
+        "auth_endpoint": os.getenv("AZURE_OPENAI_ENDPOINT"),
+        "auth_key": os.getenv("AZURE_OPENAI_API_KEY"),
+        "auth_version": os.getenv("AZURE_OPENAI_API_VERSION"),
+    }
+    secrets_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".streamlit", "secrets.toml")
+    if not all(credentials.values()) and os.path.exists(secrets_path):
+        with open(secrets_path, "rb") as f:
+            secrets = tomllib.load(f)
+        if "azure_endpoints" in secrets:
+            return endpoint_configs(secrets)
+        for name in credentials:
+            credentials[name] = credentials[name] or secrets.get(name)
+    missing = [name for name, value in credentials.items() if not value]
+    if missing:
+        raise SystemExit(f"Missing Azure OpenAI credentials: {', '.join(missing)}")
+    return endpoint_configs(credentials)
+
+def write_parquet(checkpoint_path, output_path):
+    """Converts the JSONL checkpoint to Parquet, keeping the latest record per path."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise SystemExit("Parquet output requires pyarrow (pip install pyarrow)")
+
+    latest_line = {}
+    with open(checkpoint_path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f):
+            try:
+                latest_line[json.loads(line)["path"]] = line_no
+            except json.JSONDecodeError:
+                continue
+    keep = set(latest_line.values())
+
+    schema = pa.schema([(field, pa.string()) for field in RECORD_FIELDS])
+    with pq.ParquetWriter(output_path, schema) as writer, open(checkpoint_path, encoding="utf-8") as f:
+        rows = []
+        for line_no, line in enumerate(f):
+            if line_no not in keep:
+                continue
+            record = json.loads(line)
+            record["analysis"] = json.dumps(record["analysis"], ensure_ascii=False) if record["analysis"] else None
+            rows.append({field: None if record.get(field) is None else str(record[field]) for field in RECORD_FIELDS})
+            if len(rows) >= PARQUET_BATCH_ROWS:
+                writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+                rows = []
+        if rows:
+            writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Analyze tree photos in bulk and stream results to JSONL or Parquet.")
+    parser.add_argument("inputs", nargs="*", help="Image files or directories (searched recursively)")
+    parser.add_argument("--manifest", help="Text file with one image path per line, or a CSV with a 'path' column")
+    parser.add_argument("--output", required=True, help="Output file (.jsonl or .parquet)")
+    parser.add_argument("--format", choices=["jsonl", "parquet"], help="Output format (default: from --output extension)")
+    parser.add_argument("--lang", default="English", choices=["English", "Deutsch", "中文"])
+    parser.add_argument("--model", default="gpt-4.1", choices=["gpt-4.1", "gpt-4.1-mini", CASCADE_MODEL],
+                        help="Model, or 'cascade' to escalate from gpt-4.1-mini to gpt-4.1 only where needed")
+    parser.add_argument("--concurrency", type=int, default=8, help="Maximum concurrent model requests")
+    parser.add_argument("--pack-size", type=int, default=1, choices=range(1, MAX_PACK_SIZE + 1), metavar=f"1-{MAX_PACK_SIZE}",
+                        help="Photos sent per model request; larger packs share one system prompt")
+    parser.add_argument("--max-edge", type=int, default=VISION_MAX_EDGE, help="Maximum image edge sent to the model (px)")
+    parser.add_argument("--short-edge", type=int, default=VISION_SHORT_EDGE,
+                        help="Short image edge sent to the model (px); the model works at %(default)s, so only smaller values change anything")
+    parser.add_argument("--quality", type=int, default=JPEG_QUALITY, help="JPEG quality of the uploaded image")
+    parser.add_argument("--no-cache", action="store_true", help="Always call the model instead of reusing cached analyses")
+    parser.add_argument("--dedupe-threshold", type=int, default=DEDUPE_THRESHOLD,
+                        help="Reuse the analysis of a near-duplicate photo whose perceptual hash differs in at most this many of 64 bits")
+    parser.add_argument("--no-dedupe", action="store_true", help="Analyze every photo, even near-duplicates")
+    parser.add_argument("--skip-failed", action="store_true", help="On resume, do not retry images whose analysis failed")
+    parser.add_argument("--no-inventory", action="store_true", help="Do not add the analyzed trees to the dashboard's tree inventory")
+    parser.add_argument("--metrics-file", help="Write Prometheus text-format metrics here after every chunk")
+    parser.add_argument("--metrics-log", help="Append one JSON line per timed stage here")
+    args = parser.parse_args(argv)
+    if not args.inputs and not args.manifest:
+        parser.error("give at least one input path or --manifest")
+    args.format = args.format or ("parquet" if args.output.lower().endswith(".parquet") else "jsonl")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    checkpoint_path = args.output if args.format == "jsonl" else args.output + ".checkpoint.jsonl"
+    completed = load_completed(checkpoint_path, retry_failed=not args.skip_failed)
+    paths = [path for path in dict.fromkeys(iter_image_paths(args.inputs, args.manifest)) if path not in completed]
+    print(f"{len(completed)} already done, {len(paths)} to analyze", file=sys.stderr)
+
+    client = EndpointPool(load_endpoints())
+    cache = AnalysisCache(os.path.join(CACHE_DIR, "analysis_cache.sqlite3"))
+    preprocess_pool = create_preprocess_pool()
+    preprocess_options = {"max_edge": args.max_edge, "short_edge": args.short_edge, "quality": args.quality}
+    inventory = None if args.no_inventory else TreeInventory()
+    geocoder = None if args.no_inventory else Geocoder()
+    METRICS.textfile_path = args.metrics_file or METRICS.textfile_path
+    METRICS.log_path = args.metrics_log or METRICS.log_path
+    counts = {"ok": 0, "error": 0}
+    requests = [] # Model requests of this run, for the usage summary
+
+    try:
+        with open(checkpoint_path, "a", encoding="utf-8") as out:
+            for start in range(0, len(paths), CHUNK_SIZE):
+                source = FileImageSource()
+                images = []
+                for path in paths[start:start + CHUNK_SIZE]:
+                    try:
+                        images.append((path, source.add(path)))
+                    except OSError as e:
+                        record = build_record(path, None, {"analysis": None, "error": str(e), "raw_text": None}, args.lang, args.model)
+                        out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                        counts["error"] += 1
+
+                cancel_events = [threading.Event() for _ in images]
+                batch = run_batch_analysis(
+                    client, images, source, args.lang, args.model, args.concurrency, cancel_events,
+                    cache=cache, use_cached=not args.no_cache,
+                    preprocess_pool=preprocess_pool, preprocess_options=preprocess_options,
+                    dedupe_threshold=None if args.no_dedupe else args.dedupe_threshold, pack_size=args.pack_size
+                )
+                payloads = []
+                with METRICS.timer("batch", images=len(images), pack_size=args.pack_size, model=args.model):
+                    for i, payload in batch:
+                        payloads.append(payload)
+                        record = build_record(images[i][0], images[i][1], payload, args.lang, args.model)
+                        out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                        out.flush()
+                        counts[record["status"]] += 1
+                        requests.extend(payload["requests"])
+                        done = len(completed) + counts["ok"] + counts["error"]
+                        print(f"[{done}/{len(completed) + len(paths)}] {record['status']:5} {record['path']}", file=sys.stderr)
+                if inventory is not None:
+                    with METRICS.timer("inventory_add"):
+                        coordinates = geocoder.geocode_many(payload["analysis"].get("location") for payload in payloads if payload["analysis"])
+                        inventory.add(payloads, coordinates, source, args.lang)
+                METRICS.flush()
+    except KeyboardInterrupt:
+        print("Interrupted; re-run the same command to resume.", file=sys.stderr)
+        return 130
+    finally:
+        if preprocess_pool is not None:
+            preprocess_pool.shutdown(cancel_futures=True)
+        METRICS.flush()
+
+    if args.format == "parquet":
+        write_parquet(checkpoint_path, args.output)
+    print(f"Done: {counts['ok']} analyzed, {counts['error']} failed", file=sys.stderr)
+    for model, usage in sorted(summarize_usage([{"requests": requests}]).items()):
+        print(f"{model}: {usage['requests']} requests, {usage['prompt_tokens']} prompt + {usage['completion_tokens']} completion tokens, "
+              f"{usage['seconds']:.1f} s model time", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
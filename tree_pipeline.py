@@ -0,0 +1,1214 @@
+"""Tree analysis pipeline shared by the Streamlit dashboard and the headless batch CLI.
+
+Nothing here imports Streamlit; the dashboard wraps the process-wide pieces
+(cache, preprocessing pool) in ``st.cache_resource`` itself.
+"""
+import copy
+import functools
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+import uuid
+import queue
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+
+from image_preprocessing import preprocess_image, perceptual_hash, hash_distance
+from metrics import METRICS
+from translations import get_text, translations
+
+logger = logging.getLogger(__name__)
+
+# --- PROMPT & GRADE MAPPINGS ---
+# Trees sent in one request at most with the packed prompt
+MAX_PACK_SIZE = 8
+# Analysis replies are constrained to ANALYSIS_SCHEMA; set TREE_STRUCTURED_OUTPUTS=0 for
+# deployments or API versions without structured outputs
+STRUCTURED_OUTPUTS = os.getenv("TREE_STRUCTURED_OUTPUTS", "1") != "0"
+
+@functools.lru_cache(maxsize=None)
+def build_system_prompt(lang):
+    """Builds the vision analysis system prompt for the given response language (once per language)."""
+    return """
+                You are a professional botanist, tree pathologist, certified arborist, tree risk assessor, and experienced forestry worker.
+                Analyze the user-submitted tree image for two separate goals:
+                1)  **Clear Health Assessment** and 2) **Comprehensive Risk Assessment**.
+
+                ### **Health Assessment**
+
+                Please check specifically for the following indicators, but do not limit your analysis to them:
+
+                * **Deadwood and loose branches** → risk of falling branches
+                * **Fungal fruiting bodies** → signs of white rot, brown rot, or soft rot
+                * **Diseased or weak fork (branch junction)** → increased risk of breakage
+                * **Loose or peeling bark** → possible internal stem decay
+                * **Cavities or broken branches** → structural instability
+
+                If none of these indicators are present, state that the tree appears healthy. If no tree is detected in the image, skip the analysis: set "no_tree" to true and leave every other text field empty.
+
+                -----
+
+                ### **Risk Assessment**
+
+                Drawing on your expertise as a forestry worker, evaluate the following critical risk factors:
+
+                * **Infection Potential:** Determine if any detected disease is infectious (e.g., fungus, beetle infestation) and assess if immediate removal is necessary to protect neighboring trees.
+                * **Trunk Stability:** Analyze if the trunk or rootstock is weakened by rot, pest infestation, or soil erosion, and evaluate the probability of a spontaneous collapse.
+                * **Consequences of Failure:** Identify any potential threats to people, animals, or buildings. Assess whether adjacent trees could be brought down in a domino effect.
+                * **Felling Technique:** If a high hazard exists, determine if a controlled method like rope-assisted or sectional felling is required and specify the necessary safety parameters.
+
+                ### **Output Format**
+                Your response MUST be a single, complete JSON object. Do not add any text outside of this object.
+                Emit the keys in exactly the order shown, so the short fields arrive before the long descriptions.
+
+                The JSON structure is:
+                { "no_tree": true or false (true only if the image shows no tree),
+                  "tree_type": "The common name and scientific name of the tree species, if identifiable.",
+                  "health_grade": "A single letter grade from A to F (A=Excellent, B=Good, C=Fair, D=Poor, E=Critical, F=Dead).",
+                  "health_status": "A brief summary (e.g., 'Healthy', 'Showing signs of stress', 'Diseased').",
+                  "is_diseased": true or false,
+                  "approximate_age": "An estimated age of the tree in years (e.g., '10-15 years', 'Mature').",
+                  "location": "The likely city and country where the photo was taken (e.g., 'Bonn, Germany'). If unknown, state 'Unknown'.",
+                  "native_origins": "A list of up to three primary native countries or regions for this tree species. Example: ['Japan', 'Korea', 'China']. If the species is a hybrid or its origin is unknown, provide an empty list [].",
+                  "disease_identification": "If is_diseased is true, name the potential disease(s) or pest(s). Otherwise, 'None'.",
+                  "risk_assessment": {
+                    "infection_and_hazard_potential_grade": "A final comprehensive risk grade (Low, Medium, High, or Critical) based on the factors below.",
+                    "infectious_risk_summary": "Summarize contagion risk, including whether removal is needed to protect adjacent trees (e.g., 'High risk of spreading oak wilt to adjacent trees, immediate removal recommended').",
+                    "structural_stability_summary": "Summarize structural risks, considering rootstock and trunk integrity, and the likelihood of collapse (e.g., 'Medium risk of spontaneous collapse due to deep trunk cavity').",
+                    "consequence_of_failure_summary": "Summarize the threat to targets and potential for a domino effect (e.g., 'Critical threat to a nearby house and power line; high risk of domino effect on two smaller trees')."
+                  },
+                  "felling_recommendations": {
+                    "recommended_method": "IMPORTANT: If health_grade is 'A' or 'B' AND risk_assessment.infection_and_hazard_potential_grade is 'Low', set this to the exact phrase: '" + get_text(lang, "felling_preservation_method") + "'. Otherwise, recommend a suitable felling method (e.g., 'Standard Felling', 'Controlled Sectional Felling').",
+                    "safety_parameters": "null if the recommended_method is the preservation phrase. Otherwise, an object with the following details:" {
+                      "minimum_safety_distance_meters": "Required minimum safety distance in meters. 'N/A' if not applicable.",
+                      "required_personnel": "Number of personnel and their roles. 'N/A' if not applicable.",
+                      "required_equipment": "List of essential technical equipment. 'N/A' if not applicable."
+                    }
+                  },
+                  "detailed_observations": "A paragraph describing what you see in the image (leaf color, bark condition, trunk damage, fungal bodies, structural issues like weak forks or cavities).",
+                  "rehabilitation_advice": "If is_diseased is true or health_grade is C or lower, provide a detailed, actionable rehabilitation plan. Otherwise, provide simple maintenance tips."
+                }
+               
+                """
+
+@functools.lru_cache(maxsize=None)
+def build_packed_system_prompt(lang):
+    """The system prompt plus instructions for analyzing several images in one request."""
+    return build_system_prompt(lang) + """
+                ### **Multiple Images**
+                This request contains several images, each introduced by a label "Image 1", "Image 2", and so on.
+                Analyze every image on its own, exactly as described above. This replaces the output format above:
+                respond with a single JSON object { "trees": [ ... ] } holding one entry per image, in label order.
+                Each entry starts with "image_index" (the number of its label), followed by the keys of the JSON structure above.
+                For an image without a tree, the entry has "no_tree" set to true as described above.
+                """
+
+def _strict_object(properties):
+    # Structured outputs in strict mode need every property listed as required and no others allowed
+    return {"type": "object", "properties": properties, "required": list(properties), "additionalProperties": False}
+
+# JSON schema of the analysis described in build_system_prompt, in the same key order
+ANALYSIS_SCHEMA = _strict_object({
+    "no_tree": {"type": "boolean"},
+    "tree_type": {"type": "string"},
+    "health_grade": {"type": "string", "enum": ["A", "B", "C", "D", "E", "F"]},
+    "health_status": {"type": "string"},
+    "is_diseased": {"type": "boolean"},
+    "approximate_age": {"type": "string"},
+    "location": {"type": "string"},
+    "native_origins": {"type": "array", "items": {"type": "string"}},
+    "disease_identification": {"type": "string"},
+    "risk_assessment": _strict_object({
+        "infection_and_hazard_potential_grade": {"type": "string", "enum": ["Low", "Medium", "High", "Critical"]},
+        "infectious_risk_summary": {"type": "string"},
+        "structural_stability_summary": {"type": "string"},
+        "consequence_of_failure_summary": {"type": "string"},
+    }),
+    "felling_recommendations": _strict_object({
+        "recommended_method": {"type": "string"},
+        "safety_parameters": {"anyOf": [_strict_object({
+            "minimum_safety_distance_meters": {"type": "string"},
+            "required_personnel": {"type": "string"},
+            "required_equipment": {"type": "string"},
+        }), {"type": "null"}]},
+    }),
+    "detailed_observations": {"type": "string"},
+    "rehabilitation_advice": {"type": "string"},
+})
+PACKED_ANALYSIS_SCHEMA = _strict_object({
+    "trees": {"type": "array", "items": _strict_object({"image_index": {"type": "integer"}, **ANALYSIS_SCHEMA["properties"]})},
+})
+
+def analysis_response_format(packed=False):
+    """``response_format`` constraining an analysis request to the result schema (None with TREE_STRUCTURED_OUTPUTS=0)."""
+    if not STRUCTURED_OUTPUTS:
+        return None
+    schema = PACKED_ANALYSIS_SCHEMA if packed else ANALYSIS_SCHEMA
+    return {"type": "json_schema", "json_schema": {"name": "tree_analyses" if packed else "tree_analysis", "strict": True, "schema": schema}}
+
+def get_grade_details(grade):
+    """Maps a health grade to a color, value, and description."""
+    grade_map = {
+        "A": {"color": "#28a745", "value": 100, "desc": "Excellent", "icon": "🌿"},
+        "B": {"color": "#90EE90", "value": 80, "desc": "Good", "icon": "🌳"},
+        "C": {"color": "#ffc107", "value": 60, "desc": "Fair", "icon": "⚠️"},
+        "D": {"color": "#fd7e14", "value": 40, "desc": "Poor", "icon": "❗️"},
+        "E": {"color": "#dc3545", "value": 20, "desc": "Critical", "icon": "🆘"},
+        "F": {"color": "#6c757d", "value": 0, "desc": "Failed / Dead", "icon": "💀"},
+    }
+    return grade_map.get(str(grade).upper(), {"color": "#6c757d", "value": 0, "desc": "Unknown", "icon": "❓"})
+
+def get_risk_grade_details(grade, lang):
+    """Maps a risk grade to a color, value, description, and icon."""
+    grade_map = {
+        "LOW":      {"color": "#28a745", "value": 25, "desc": get_text(lang, "risk_grade_low"), "icon": "🛡️"},
+        "MEDIUM":   {"color": "#ffc107", "value": 50, "desc": get_text(lang, "risk_grade_medium"), "icon": "⚠️"},
+        "HIGH":     {"color": "#fd7e14", "value": 75, "desc": get_text(lang, "risk_grade_high"), "icon": "🔥"},
+        "CRITICAL": {"color": "#dc3545", "value": 100, "desc": get_text(lang, "risk_grade_critical"), "icon": "🚨"},
+    }
+    return grade_map.get(str(grade).upper(), {"color": "#6c757d", "value": 0, "desc": get_text(lang, "risk_grade_unknown"), "icon": "❓"})
+
+# --- ANALYSIS RESULT CACHE ---
+CACHE_DIR = os.getenv("TREE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "tree_health_app"))
+ANALYSIS_CACHE_MAX_BYTES = 256 * 1024 * 1024
+ANALYSIS_CACHE_MAX_AGE_SECONDS = 30 * 24 * 3600
+def prompt_version(lang):
+    """Short fingerprint of the system prompt, so prompt edits invalidate cached analyses."""
+    return hashlib.sha256(build_system_prompt(lang).encode("utf-8")).hexdigest()[:16]
+
+def analysis_cache_variant(model, lang):
+    return f"{model}:{lang}:{prompt_version(lang)}"
+
+def analysis_cache_key(image_hash, model, lang):
+    """``image_hash`` is the SHA-256 hex digest of the original upload (its ImageStore id)."""
+    return f"{image_hash}:{analysis_cache_variant(model, lang)}"
+
+class AnalysisCache:
+    """Content-addressed SQLite store of parsed analyses, shared by all sessions in the process."""
+
+    def __init__(self, path, max_bytes=ANALYSIS_CACHE_MAX_BYTES, max_age_seconds=ANALYSIS_CACHE_MAX_AGE_SECONDS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS analyses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL, dhash TEXT)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS analyses_accessed_at ON analyses (accessed_at)")
+            if "dhash" not in {row[1] for row in conn.execute("PRAGMA table_info(analyses)")}:
+                conn.execute("ALTER TABLE analyses ADD COLUMN dhash TEXT") # Caches created before perceptual dedupe
+
+    def _connect(self):
+        # One short-lived connection per call keeps the cache safe to use from worker threads
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _count(self, hit, kind):
+        METRICS.incr("cache_requests_total", cache=kind, result="hit" if hit else "miss")
+        if kind != "analysis":
+            return # hits/misses are the analysis hit rate shown in the sidebar
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key, kind="analysis"):
+        """The stored value of ``key``, or None; ``kind`` labels the lookup in cache_requests_total."""
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute("SELECT value, created_at FROM analyses WHERE key = ?", (key,)).fetchone()
+            if row and now - row[1] <= self.max_age_seconds:
+                conn.execute("UPDATE analyses SET accessed_at = ? WHERE key = ?", (now, key))
+                self._count(True, kind)
+                return json.loads(row[0])
+            if row:
+                conn.execute("DELETE FROM analyses WHERE key = ?", (key,))
+        self._count(False, kind)
+        return None
+
+    def put(self, key, analysis, dhash=None):
+        """Stores ``analysis``; with the image's perceptual ``dhash`` it can also serve near-duplicates."""
+        value = json.dumps(analysis, ensure_ascii=False)
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO analyses (key, value, size, created_at, accessed_at, dhash) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, value, len(value.encode("utf-8")), now, now, None if dhash is None else f"{dhash:016x}"),
+            )
+            self._evict(conn, now)
+
+    def perceptual_index(self, model, lang):
+        """(image_hash, dhash) of every live analysis for ``model`` and ``lang`` stored with a perceptual hash."""
+        suffix = ":" + analysis_cache_variant(model, lang)
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT key, dhash FROM analyses WHERE dhash IS NOT NULL AND substr(key, -?) = ? AND created_at >= ?",
+                (len(suffix), suffix, time.time() - self.max_age_seconds),
+            ).fetchall()
+        return [(key[:-len(suffix)], int(dhash, 16)) for key, dhash in rows]
+
+    def _evict(self, conn, now):
+        """Drops expired entries, then least recently used ones until the store fits in max_bytes."""
+        conn.execute("DELETE FROM analyses WHERE created_at < ?", (now - self.max_age_seconds,))
+        excess = conn.execute("SELECT COALESCE(SUM(size), 0) FROM analyses").fetchone()[0] - self.max_bytes
+        if excess <= 0:
+            return
+        stale_keys = []
+        for key, size in conn.execute("SELECT key, size FROM analyses ORDER BY accessed_at"):
+            stale_keys.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        conn.executemany("DELETE FROM analyses WHERE key = ?", stale_keys)
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM analyses")
+        with self._lock:
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self._connect() as conn:
+            entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM analyses").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": size}
+
+# --- CONCURRENT ANALYSIS ENGINE ---
+MAX_RETRIES = 5
+MAX_COMPLETION_TOKENS = 1500
+# Output limit of a packed request, whatever the pack size
+PACK_MAX_COMPLETION_TOKENS = 16384
+# Follow-up requests asking the model to finish a reply cut off at max_completion_tokens
+MAX_CONTINUATIONS = 1
+CONTINUATION_PROMPT = "Your reply was cut off. Continue it exactly where it stopped, without repeating anything, so that both parts together form the complete JSON object."
+# How often a pack's request checks whether all of its images were cancelled
+CANCEL_POLL_SECONDS = 0.1
+# How often streamed partial analyses are parsed and handed to the caller
+STREAM_UPDATE_SECONDS = 0.25
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 60.0
+# Model option that triages every image with the small model and re-analyzes
+# only the trees needing a closer look (see needs_escalation) with the large one
+CASCADE_MODEL = "cascade"
+CASCADE_TRIAGE_MODEL = "gpt-4.1-mini"
+CASCADE_ESCALATION_MODEL = "gpt-4.1"
+ESCALATION_GRADES = ("C", "D", "E", "F")
+ESCALATION_RISKS = ("HIGH", "CRITICAL")
+
+def make_result_payload(image_id, filename, analysis=None, error=None, raw_text=None, duplicate_of=None, model=None, requests=None):
+    """Builds a batch result entry; ``id`` identifies it for memoized summary rendering.
+
+    The image itself lives in the session's ImageStore and is referenced by ``image_id``.
+    ``duplicate_of`` is set when the analysis was reused from a near-duplicate photo:
+    {"image_id", "filename" (None for a cached analysis), "distance"}. ``model`` is the
+    model that produced the analysis and ``requests`` the model requests made for this
+    image (see request_usage); empty for cached and duplicate results.
+    """
+    return {"id": uuid.uuid4().hex, "image_id": image_id, "analysis": analysis, "error": error, "raw_text": raw_text, "filename": filename,
+            "duplicate_of": duplicate_of, "model": model, "requests": requests or []}
+
+def request_usage(model, usage, seconds, images=1):
+    """One image's share of a model request: tokens and time are split evenly over a pack's ``images``."""
+    return {
+        "model": model, "share": 1 / images, "seconds": seconds / images,
+        "prompt_tokens": (getattr(usage, "prompt_tokens", None) or 0) / images,
+        "completion_tokens": (getattr(usage, "completion_tokens", None) or 0) / images,
+    }
+
+def summarize_usage(payloads):
+    """Model requests, tokens and request time of a batch's results, per model.
+
+    Returns {model: {"requests", "prompt_tokens", "completion_tokens", "seconds"}};
+    packed requests count once however many images they held.
+    """
+    totals = {}
+    for payload in payloads:
+        for request in payload.get("requests") or []:
+            entry = totals.setdefault(request["model"], {"requests": 0.0, "prompt_tokens": 0.0, "completion_tokens": 0.0, "seconds": 0.0})
+            entry["requests"] += request["share"]
+            for key in ("prompt_tokens", "completion_tokens", "seconds"):
+                entry[key] += request[key]
+    return {model: {key: round(value) if key != "seconds" else value for key, value in entry.items()} for model, entry in totals.items()}
+
+def retryable_errors():
+    """The openai errors worth retrying; imported on first use so importing this module stays cheap."""
+    from openai import RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
+    return (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+
+class NoTreeDetected(Exception):
+    """The model reported that the image shows no tree."""
+
+class AnalysisCancelled(Exception):
+    """Raised when an image's analysis is cancelled before it completes."""
+
+class PackCancelEvent:
+    """Stands in for a threading.Event over a pack's per-image events: set once all of them are."""
+
+    def __init__(self, events):
+        self.events = events
+
+    def is_set(self):
+        return all(event.is_set() for event in self.events)
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.is_set():
+            remaining = CANCEL_POLL_SECONDS if deadline is None else min(CANCEL_POLL_SECONDS, deadline - time.monotonic())
+            if remaining <= 0:
+                return False
+            time.sleep(remaining)
+        return True
+
+def retry_delay(error, attempt):
+    """Seconds to wait before the next attempt, honouring the server's Retry-After headers."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    delay = None
+    try:
+        if headers.get("retry-after-ms"):
+            delay = float(headers["retry-after-ms"]) / 1000
+        elif headers.get("retry-after"):
+            delay = float(headers["retry-after"])
+    except ValueError:
+        # Retry-After may also be an HTTP date
+        try:
+            delay = (parsedate_to_datetime(headers["retry-after"]) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            delay = None
+    if delay is None or delay < 0:
+        delay = BACKOFF_BASE_SECONDS * 2 ** attempt * random.uniform(0.5, 1.0)
+    return min(delay, BACKOFF_MAX_SECONDS)
+
+def create_completion_with_retry(client, cancel_event, **kwargs):
+    """Calls the chat completions API, backing off on 429s and transient errors."""
+    for attempt in range(MAX_RETRIES + 1):
+        if cancel_event.is_set():
+            raise AnalysisCancelled()
+        try:
+            if getattr(client, "accepts_cancel_event", False):
+                # EndpointPool waits for shared quota first and returns None if cancelled meanwhile
+                response = client.chat.completions.create(cancel_event=cancel_event, **kwargs)
+                if response is None:
+                    raise AnalysisCancelled()
+                return response
+            return client.chat.completions.create(**kwargs)
+        except retryable_errors() as e:
+            if attempt == MAX_RETRIES:
+                raise
+            METRICS.incr("retries_total", error=type(e).__name__)
+            # Event.wait doubles as an interruptible sleep
+            if cancel_event.wait(retry_delay(e, attempt)):
+                raise AnalysisCancelled()
+
+def prepare_image(image_path, preprocess_pool=None, preprocess_options=None):
+    """Runs preprocess_image in the process pool (if any) so decoding overlaps with other requests' network I/O."""
+    options = preprocess_options or {}
+    with METRICS.timer("preprocess"):
+        if preprocess_pool is not None:
+            try:
+                return preprocess_pool.submit(preprocess_image, image_path, **options).result()
+            except BrokenProcessPool:
+                pass # A crashed worker must not fail the image; fall back to this thread
+        return preprocess_image(image_path, **options)
+
+def compute_perceptual_hashes(paths, preprocess_pool=None):
+    """Perceptual hashes of image files, computed in the process pool (if any); None for undecodable or uniform images."""
+    hashes = []
+    with METRICS.timer("perceptual_hash", images=len(paths)):
+        futures = [preprocess_pool.submit(perceptual_hash, path) for path in paths] if preprocess_pool is not None else None
+        for i, path in enumerate(paths):
+            try:
+                try:
+                    hashes.append(futures[i].result() if futures else perceptual_hash(path))
+                except BrokenProcessPool:
+                    hashes.append(perceptual_hash(path))
+            except Exception:
+                hashes.append(None) # Analyzed on its own, where the decoding error is reported
+    return hashes
+
+def find_near_duplicate(dhash, candidates, max_distance):
+    """(key, distance) of the closest (key, hash) candidate at most ``max_distance`` bits away, or None."""
+    best = None
+    for key, candidate_hash in candidates:
+        distance = hash_distance(dhash, candidate_hash)
+        if distance <= max_distance and (best is None or distance < best[1]):
+            best = (key, distance)
+    return best
+
+def parse_partial_json(text):
+    """Best-effort parse of a JSON object that is still being streamed.
+
+    Returns the fields received so far (closing any open string, array or object),
+    or None before the first complete field. Incomplete keys, numbers and literals
+    are dropped until they finish; a string value that is still arriving is
+    returned as far as it has been received.
+    """
+    start = text.find("{")
+    if start < 0:
+        return None
+    stack = []          # open containers: "{" or "["
+    expect_key = []     # per open object: whether the next string is a key
+    safe_end, safe_stack = None, None
+    in_string = escaped = string_is_key = False
+    string_start = 0
+    i = start
+    while i < len(text):
+        char = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+                if not string_is_key:
+                    safe_end, safe_stack = i + 1, list(stack)
+        elif char == '"':
+            in_string, string_start = True, i
+            string_is_key = bool(stack) and stack[-1] == "{" and expect_key[-1]
+        elif char in "{[":
+            stack.append(char)
+            expect_key.append(char == "{")
+            safe_end, safe_stack = i + 1, list(stack)
+        elif char in "}]":
+            if not stack:
+                break
+            stack.pop()
+            expect_key.pop()
+            safe_end, safe_stack = i + 1, list(stack)
+            if not stack:
+                break
+        elif char == ":" and stack and stack[-1] == "{":
+            expect_key[-1] = False
+        elif char == "," and stack and stack[-1] == "{":
+            expect_key[-1] = True
+        elif char not in " \t\r\n,:":
+            # Number or literal: only safe once it is followed by a delimiter
+            end = i
+            while end < len(text) and text[end] not in ",}] \t\r\n":
+                end += 1
+            if end < len(text):
+                safe_end, safe_stack = end, list(stack)
+            i = end - 1
+        i += 1
+
+    closers = {"{": "}", "[": "]"}
+    if in_string and not string_is_key:
+        body = text[start:]
+        if escaped:
+            body = body[:-1]
+        # Drop a \uXXXX escape that has not fully arrived
+        tail = text[string_start:]
+        unicode_escape = tail.rfind("\\u")
+        if unicode_escape >= 0 and len(tail) - unicode_escape < 6:
+            body = body[:len(body) - (len(tail) - unicode_escape)]
+        candidate = body + '"' + "".join(closers[c] for c in reversed(stack))
+    elif safe_end is not None:
+        candidate = text[start:safe_end] + "".join(closers[c] for c in reversed(safe_stack))
+    else:
+        return None
+    try:
+        parsed = json.loads(candidate)
+    except json.JSONDecodeError:
+        return None
+    return parsed if isinstance(parsed, dict) else None
+
+def stream_completion_text(client, cancel_event, on_partial, **kwargs):
+    """Streams a completion, passing partially parsed JSON to ``on_partial`` as it arrives.
+
+    Returns the full text, the usage reported with the last chunk (None if absent)
+    and the finish reason.
+    """
+    stream = create_completion_with_retry(client, cancel_event, stream=True, stream_options={"include_usage": True}, **kwargs)
+    parts = []
+    usage = finish_reason = None
+    last_update = time.monotonic()
+    for chunk in stream:
+        if cancel_event.is_set():
+            stream.close()
+            raise AnalysisCancelled()
+        # With include_usage the last chunk carries the token counts and no choices
+        if getattr(chunk, "usage", None):
+            usage = chunk.usage
+        if chunk.choices and getattr(chunk.choices[0], "finish_reason", None):
+            finish_reason = chunk.choices[0].finish_reason
+        # Azure sends content-filter chunks without choices
+        if not chunk.choices or not chunk.choices[0].delta.content:
+            continue
+        parts.append(chunk.choices[0].delta.content)
+        if time.monotonic() - last_update >= STREAM_UPDATE_SECONDS:
+            last_update = time.monotonic()
+            partial = parse_partial_json("".join(parts))
+            if partial:
+                on_partial(partial)
+    return "".join(parts), usage, finish_reason
+
+def complete_text(client, cancel_event, on_partial, **request):
+    """Sends a completion request, streamed when ``on_partial`` is given; returns (text, usage, finish_reason)."""
+    if on_partial is not None:
+        return stream_completion_text(client, cancel_event, on_partial, **request)
+    response = create_completion_with_retry(client, cancel_event, **request)
+    choice = response.choices[0]
+    return choice.message.content, getattr(response, "usage", None), getattr(choice, "finish_reason", None)
+
+def join_continuation(text, continuation):
+    """Appends the continuation of a truncated reply, as the first of several readings that parses.
+
+    Replies sometimes repeat the end of the text before continuing, or restart the whole
+    object; fences around the continuation are dropped.
+    """
+    continuation = MARKDOWN_FENCE.sub("", continuation)
+    candidates = [text + continuation]
+    overlap = next((n for n in range(min(len(text), len(continuation), 200), 7, -1) if text.endswith(continuation[:n])), 0)
+    if overlap:
+        candidates.append(text + continuation[overlap:])
+    candidates.append(continuation)
+    for candidate in candidates:
+        try:
+            _decode_json_object(candidate)
+            return candidate
+        except ValueError:
+            continue
+    return candidates[0]
+
+def continue_truncated_reply(client, cancel_event, request, result_text, requests):
+    """Has the model finish a reply cut off at max_completion_tokens, instead of re-running the analysis.
+
+    The follow-up repeats the conversation with the partial reply as an assistant turn
+    (the image prefix is served from the prompt cache) and without the response schema,
+    which would force a fresh object. Returns the joined text; the follow-up requests
+    are appended to ``requests``.
+    """
+    model = request["model"]
+    follow_up = {key: value for key, value in request.items() if key != "response_format"}
+    for _ in range(MAX_CONTINUATIONS):
+        follow_up["messages"] = request["messages"] + [
+            {"role": "assistant", "content": result_text}, {"role": "user", "content": CONTINUATION_PROMPT}
+        ]
+        request_start = time.perf_counter()
+        with METRICS.timer("model_request", model=model, continuation=True):
+            continuation, usage, finish_reason = complete_text(client, cancel_event, None, **follow_up)
+        METRICS.record_usage(usage, model)
+        METRICS.incr("reply_repairs_total", kind="continuation")
+        requests.append(request_usage(model, usage, time.perf_counter() - request_start))
+        result_text = join_continuation(result_text, continuation or "")
+        if finish_reason != "length":
+            break
+    return result_text
+
+def record_analysis_usage(usage, model, images):
+    """Counts an analysis request's tokens, and its prompt tokens per pack size for per-image comparisons."""
+    METRICS.record_usage(usage, model)
+    METRICS.incr("analysis_images_total", images, model=model, pack_size=str(images))
+    if usage is not None:
+        METRICS.incr("analysis_prompt_tokens_total", usage.prompt_tokens or 0, model=model, pack_size=str(images))
+
+MARKDOWN_FENCE = re.compile(r"^\s*```[\w-]*[ \t]*\n?|\n?```\s*$")
+# The literal reply the prompt asked for before structured outputs, e.g. "`No tree`."
+NO_TREE_REPLY = re.compile(r"^\W*no tree\W*$", re.IGNORECASE)
+
+def _decode_json_object(text):
+    # (object, whether text around it had to be skipped)
+    try:
+        data, repaired = json.loads(text), False
+    except json.JSONDecodeError:
+        start = text.find("{")
+        if start < 0:
+            raise
+        data, repaired = json.JSONDecoder().raw_decode(text, start)[0], True
+    if not isinstance(data, dict):
+        raise json.JSONDecodeError("Expected a JSON object", text, 0)
+    return data, repaired
+
+def extract_json_object(text):
+    """The JSON object in a reply, ignoring markdown fences and any text before or after it.
+
+    Raises json.JSONDecodeError (a ValueError) when there is none or it is incomplete.
+    """
+    data, repaired = _decode_json_object(text)
+    if repaired:
+        METRICS.incr("reply_repairs_total", kind="extracted")
+    return data
+
+def complete_array_items(text, key):
+    """The complete objects of the array under ``key`` in a truncated JSON reply."""
+    match = re.search(r'"%s"\s*:\s*\[' % re.escape(key), text)
+    items = []
+    if match is None:
+        return items
+    decoder, position = json.JSONDecoder(), match.end()
+    while True:
+        while position < len(text) and text[position] in " \t\r\n,":
+            position += 1
+        try:
+            item, position = decoder.raw_decode(text, position)
+        except json.JSONDecodeError:
+            return items
+        items.append(item)
+
+def parse_analysis(result_text):
+    """Parses the model's reply into the analysis dict (None when the reply is empty).
+
+    Raises NoTreeDetected when the model reports no tree, and json.JSONDecodeError
+    when no complete JSON object can be recovered from the reply.
+    """
+    if not result_text:
+        logger.warning("No response from model.")
+        return None
+    with METRICS.timer("parse"):
+        if NO_TREE_REPLY.match(result_text):
+            raise NoTreeDetected()
+        data = extract_json_object(result_text)
+    if data.pop("no_tree", False):
+        raise NoTreeDetected()
+    return data
+
+def analyze_image(client, image_id, filename, image_store, lang, model, cancel_event, cache=None, preprocess_pool=None, preprocess_options=None, on_partial=None, dhash=None):
+    """Analyzes a single tree image and returns its result payload.
+
+    With ``on_partial`` the response is streamed and the callback receives the
+    partially parsed analysis every STREAM_UPDATE_SECONDS.
+
+    Successful analyses are written to ``cache`` as soon as they arrive, so a crashed
+    batch does not pay for them again, together with the image's perceptual ``dhash``
+    when given. The card's display and thumbnail derivatives are produced here too,
+    off the script thread.
+    """
+    result_text, requests = "", []
+    try:
+        if cancel_event.is_set():
+            raise AnalysisCancelled()
+        base64_image, mime_type = prepare_image(image_store.path(image_id), preprocess_pool, preprocess_options)
+        if hasattr(image_store, "prepare_derivatives"):
+            with METRICS.timer("derivatives"):
+                image_store.prepare_derivatives(image_id)
+        request = dict(
+            model=model,
+            messages=[
+                {"role": "system", "content": build_system_prompt(lang)},
+                {"role": "user", "content": [{"type": "text", "text": f"Analyze this tree. Respond in {lang}."}, {"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{base64_image}"}}]}
+            ],
+            max_completion_tokens=MAX_COMPLETION_TOKENS, temperature=0.5
+        )
+        if analysis_response_format():
+            request["response_format"] = analysis_response_format()
+        request_start = time.perf_counter()
+        with METRICS.timer("model_request", model=model):
+            result_text, usage, finish_reason = complete_text(client, cancel_event, on_partial, **request)
+        record_analysis_usage(usage, model, 1)
+        requests.append(request_usage(model, usage, time.perf_counter() - request_start))
+        if finish_reason == "length":
+            result_text = continue_truncated_reply(client, cancel_event, request, result_text, requests)
+        analysis_data = parse_analysis(result_text)
+        if cache is not None and analysis_data:
+            cache.put(analysis_cache_key(image_id, model, lang), analysis_data, dhash)
+        METRICS.incr("images_total", result="ok" if analysis_data else "error")
+        return make_result_payload(image_id, filename, analysis=analysis_data, model=model, requests=requests)
+    except AnalysisCancelled:
+        METRICS.incr("images_total", result="cancelled")
+        return make_result_payload(image_id, filename, error=get_text(lang, "cancelled_text"), raw_text="No response from model.", requests=requests)
+    except NoTreeDetected:
+        METRICS.incr("images_total", result="no_tree")
+        return make_result_payload(image_id, filename, error=get_text(lang, "no_tree_text"), raw_text=result_text, model=model, requests=requests)
+    except Exception as e:
+        METRICS.incr("images_total", result="error")
+        error_text = getattr(e, 'message', str(e))
+        raw_output = result_text if result_text else "No response from model."
+        return make_result_payload(image_id, filename, error=error_text, raw_text=raw_output, model=model, requests=requests)
+
+def parse_packed_analyses(result_text, count):
+    """Splits a packed reply into the entry of each of its ``count`` images, in request order.
+
+    Entries are matched by their image_index, or by position when that is missing or
+    out of range. A truncated reply keeps its complete entries. Images the reply does
+    not cover get None.
+    """
+    analyses = [None] * count
+    if not result_text:
+        return analyses
+    with METRICS.timer("parse", images=count):
+        try:
+            entries = extract_json_object(result_text).get("trees")
+        except json.JSONDecodeError:
+            entries = complete_array_items(result_text, "trees")
+            if entries:
+                METRICS.incr("reply_repairs_total", kind="salvaged")
+    for position, entry in enumerate(entries if isinstance(entries, list) else []):
+        if not isinstance(entry, dict):
+            continue
+        index = entry.pop("image_index", None)
+        slot = index - 1 if isinstance(index, int) and 1 <= index <= count else position
+        if slot < count and analyses[slot] is None:
+            analyses[slot] = entry
+    return analyses
+
+def analyze_pack(client, items, image_store, lang, model, cancel_events, cache=None, preprocess_pool=None, preprocess_options=None, on_partial=None, dhashes=None):
+    """Analyzes several (filename, image_id) items in one request with the packed prompt; returns their result payloads in order.
+
+    The request is only cancelled once every item's cancel event is set. Items the reply
+    does not cover (including the incomplete ones of a truncated reply), or all of them
+    when it cannot be parsed or the request fails, are analyzed one by one with
+    analyze_image. With ``on_partial`` the reply is streamed and the callback receives
+    (position, partial analysis).
+    """
+    from openai import APIError
+    dhashes = dhashes or [None] * len(items)
+    cancel_event = PackCancelEvent(cancel_events)
+    entries, pack_requests = [None] * len(items), []
+    try:
+        if cancel_event.is_set():
+            raise AnalysisCancelled()
+        content = [{"type": "text", "text": f"Analyze these {len(items)} trees. Respond in {lang}."}]
+        for number, (filename, image_id) in enumerate(items, 1):
+            base64_image, mime_type = prepare_image(image_store.path(image_id), preprocess_pool, preprocess_options)
+            if hasattr(image_store, "prepare_derivatives"):
+                with METRICS.timer("derivatives"):
+                    image_store.prepare_derivatives(image_id)
+            content += [{"type": "text", "text": f"Image {number}"}, {"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{base64_image}"}}]
+        request = dict(
+            model=model,
+            messages=[{"role": "system", "content": build_packed_system_prompt(lang)}, {"role": "user", "content": content}],
+            max_completion_tokens=min(PACK_MAX_COMPLETION_TOKENS, MAX_COMPLETION_TOKENS * len(items)), temperature=0.5
+        )
+        if analysis_response_format(packed=True):
+            request["response_format"] = analysis_response_format(packed=True)
+
+        def split_partial(partial):
+            for position, entry in enumerate((partial.get("trees") or [])[:len(items)]):
+                if isinstance(entry, dict) and not cancel_events[position].is_set():
+                    on_partial(position, {key: value for key, value in entry.items() if key not in ("image_index", "no_tree")})
+
+        request_start = time.perf_counter()
+        with METRICS.timer("model_request", model=model, images=len(items)):
+            result_text, usage, _ = complete_text(client, cancel_event, split_partial if on_partial is not None else None, **request)
+        record_analysis_usage(usage, model, len(items))
+        pack_requests = [request_usage(model, usage, time.perf_counter() - request_start, len(items))]
+        entries = parse_packed_analyses(result_text, len(items))
+    except (APIError, AnalysisCancelled, ValueError, OSError) as e:
+        # Cancelled, failed, unparsable or with an unreadable photo: every item falls back to its own request below
+        reason = "cancelled" if isinstance(e, AnalysisCancelled) else type(e).__name__
+        METRICS.incr("pack_fallbacks_total", reason=reason, model=model)
+        if reason != "cancelled":
+            logger.warning("Packed request for %d photos failed (%s: %s); analyzing them one by one", len(items), reason, e)
+
+    payloads = []
+    for position, ((filename, image_id), entry) in enumerate(zip(items, entries)):
+        if entry is None:
+            single_partial = (lambda analysis, position=position: on_partial(position, analysis)) if on_partial is not None else None
+            payload = analyze_image(
+                client, image_id, filename, image_store, lang, model, cancel_events[position],
+                cache, preprocess_pool, preprocess_options, single_partial, dhashes[position]
+            )
+            # The pack request was paid for too
+            payload["requests"] = pack_requests + payload["requests"]
+            payloads.append(payload)
+        elif cancel_events[position].is_set():
+            METRICS.incr("images_total", result="cancelled")
+            payloads.append(make_result_payload(image_id, filename, error=get_text(lang, "cancelled_text"), raw_text="No response from model.", requests=pack_requests))
+        elif entry.pop("no_tree", False):
+            METRICS.incr("images_total", result="no_tree")
+            payloads.append(make_result_payload(image_id, filename, error=get_text(lang, "no_tree_text"), raw_text=json.dumps(entry), model=model, requests=pack_requests))
+        else:
+            if cache is not None:
+                cache.put(analysis_cache_key(image_id, model, lang), entry, dhashes[position])
+            METRICS.incr("images_total", result="ok")
+            payloads.append(make_result_payload(image_id, filename, analysis=entry, model=model, requests=pack_requests))
+    return payloads
+
+def escalation_reason(analysis):
+    """Why a triage analysis must be redone by the large model ("grade", "risk", or "error" when the triage failed), or None if it stands."""
+    if not analysis:
+        return "error"
+    if str(analysis.get("health_grade", "")).strip().upper() not in ("A", "B"):
+        return "grade" # C-F, or no usable grade
+    risk = (analysis.get("risk_assessment") or {}).get("infection_and_hazard_potential_grade", "")
+    return "risk" if str(risk).strip().upper() in ESCALATION_RISKS else None
+
+def analyze_cascade(client, items, image_store, lang, cancel_events, cache=None, preprocess_pool=None, preprocess_options=None, on_partial=None, dhashes=None, triaged=None):
+    """Analyzes (filename, image_id) items with CASCADE_TRIAGE_MODEL and re-analyzes those needing it with CASCADE_ESCALATION_MODEL.
+
+    Several items are sent as one pack in both rounds, like analyze_pack. Returns the
+    final payloads in order; an escalated payload has ``escalated`` set to the reason
+    and lists the requests of both rounds. Partial results of both rounds go to
+    ``on_partial(position, analysis)``. ``triaged`` holds, per item, a cached triage
+    analysis to use instead of triaging it again (see cached_analysis), or None.
+
+    A photo the triage finds no tree in is not escalated.
+    """
+    dhashes = dhashes or [None] * len(items)
+    triaged = triaged or [None] * len(items)
+
+    def analyze(model, positions):
+        if len(positions) == 1:
+            position = positions[0]
+            single_partial = (lambda analysis: on_partial(position, analysis)) if on_partial is not None else None
+            filename, image_id = items[position]
+            return [analyze_image(
+                client, image_id, filename, image_store, lang, model, cancel_events[position],
+                cache, preprocess_pool, preprocess_options, single_partial, dhashes[position]
+            )]
+        pack_partial = (lambda index, analysis: on_partial(positions[index], analysis)) if on_partial is not None else None
+        return analyze_pack(
+            client, [items[position] for position in positions], image_store, lang, model, [cancel_events[position] for position in positions],
+            cache, preprocess_pool, preprocess_options, pack_partial, [dhashes[position] for position in positions]
+        )
+
+    payloads = [
+        make_result_payload(image_id, filename, analysis=analysis, model=CASCADE_TRIAGE_MODEL) if analysis else None
+        for (filename, image_id), analysis in zip(items, triaged)
+    ]
+    to_triage = [position for position, payload in enumerate(payloads) if payload is None]
+    if to_triage:
+        for position, payload in zip(to_triage, analyze(CASCADE_TRIAGE_MODEL, to_triage)):
+            payloads[position] = payload
+    no_tree_text = get_text(lang, "no_tree_text")
+    reasons = {}
+    for position, payload in enumerate(payloads):
+        if payload["analysis"] is None and payload["error"] == no_tree_text:
+            continue
+        reason = escalation_reason(payload["analysis"])
+        if reason and not cancel_events[position].is_set():
+            METRICS.incr("cascade_escalations_total", reason=reason)
+            reasons[position] = reason
+    if reasons:
+        for position, payload in zip(reasons, analyze(CASCADE_ESCALATION_MODEL, list(reasons))):
+            payload["escalated"] = reasons[position]
+            payload["requests"] = payloads[position]["requests"] + payload["requests"]
+            payloads[position] = payload
+    return payloads
+
+def cascade_models(model):
+    """The models whose analyses serve ``model``, best first."""
+    return (CASCADE_ESCALATION_MODEL, CASCADE_TRIAGE_MODEL) if model == CASCADE_MODEL else (model,)
+
+def cached_analysis(cache, image_id, model, lang):
+    """(analysis, producing model, escalation reason) from the cache, or (None, None, None).
+
+    For the cascade a cached large-model analysis wins. A cached triage analysis that
+    would have been escalated comes with its escalation reason: it is no final result,
+    but spares the photo its triage (see analyze_cascade's ``triaged``).
+    """
+    for candidate in cascade_models(model):
+        analysis = cache.get(analysis_cache_key(image_id, candidate, lang))
+        if analysis:
+            reason = escalation_reason(analysis) if model == CASCADE_MODEL and candidate == CASCADE_TRIAGE_MODEL else None
+            return analysis, candidate, reason
+    return None, None, None
+
+def run_batch_analysis(client, images, image_store, lang, model, max_workers, cancel_events, cache=None, use_cached=True, preprocess_pool=None, preprocess_options=None, stream=False, dedupe_threshold=None, pack_size=1):
+    """Analyzes (filename, image_id) pairs from ``image_store`` concurrently, yielding (index, result_payload) as each call finishes.
+
+    ``image_store`` is anything with ``path(image_id)``, e.g. an ImageStore or FileImageSource.
+
+    Cache hits are yielded first without touching the network; ``use_cached=False``
+    bypasses lookups but still refreshes the cache. ``preprocess_options`` are passed
+    to preprocess_image (max_edge, short_edge, quality). Setting ``cancel_events[i]``
+    cancels image ``i`` only. Closing the generator early (e.g. when Streamlit
+    interrupts the script) cancels everything still outstanding.
+
+    With ``stream=True`` responses are streamed and in-progress results are yielded
+    too, as payloads with ``"partial": True`` holding the fields received so far.
+    The final payload for an index always comes after its last partial one.
+
+    With ``dedupe_threshold`` set, photos whose perceptual hashes differ in at most that
+    many bits are analyzed once: an image close to a cached analysis reuses it, and
+    within the batch only the first image of each group is sent to the model, its
+    result being fanned out to the others (with ``duplicate_of`` set). If that analysis
+    fails, the next image of the group is analyzed instead.
+
+    With ``pack_size`` > 1, images still to analyze are sent that many per request
+    with the packed prompt (see analyze_pack) and split back into one payload each.
+
+    ``model`` may be CASCADE_MODEL: images are triaged by the small model and only
+    those needing it re-analyzed by the large one (see analyze_cascade). Images whose
+    cached triage needs escalating go straight to the large one.
+    """
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tree-analysis")
+
+    def reuse(j, analysis, duplicate_of, produced_by):
+        # Cached under the duplicate's own key too, so re-uploading it is an exact hit
+        if cache is not None:
+            cache.put(analysis_cache_key(images[j][1], produced_by, lang), analysis, hashes.get(j))
+        METRICS.incr("images_total", result="duplicate")
+        return make_result_payload(images[j][1], images[j][0], analysis=copy.deepcopy(analysis), duplicate_of=duplicate_of, model=produced_by)
+
+    try:
+        pending = []
+        triaged = {} # index -> cached triage analysis still to escalate
+        for i, (filename, image_id) in enumerate(images):
+            cached, produced_by, reason = cached_analysis(cache, image_id, model, lang) if cache is not None and use_cached else (None, None, None)
+            if cached and not reason:
+                METRICS.incr("images_total", result="cached")
+                yield i, make_result_payload(image_id, filename, analysis=cached, model=produced_by)
+            else:
+                pending.append(i)
+                if cached:
+                    triaged[i] = cached
+
+        hashes = {}
+        groups = {i: [] for i in pending} # representative -> [(duplicate, distance)]
+        if dedupe_threshold is not None and pending:
+            hashes = dict(zip(pending, compute_perceptual_hashes([image_store.path(images[i][1]) for i in pending], preprocess_pool)))
+            cached_hashes = [entry for candidate in cascade_models(model) for entry in cache.perceptual_index(candidate, lang)] if cache is not None and use_cached else []
+            hashed_representatives = []
+            for i in pending:
+                if hashes[i] is None:
+                    continue
+                match = find_near_duplicate(hashes[i], cached_hashes, dedupe_threshold)
+                cached, produced_by, reason = cached_analysis(cache, match[0], model, lang) if match else (None, None, None)
+                if cached and not reason:
+                    del groups[i]
+                    yield i, reuse(i, cached, {"image_id": match[0], "filename": None, "distance": match[1]}, produced_by)
+                    continue
+                match = find_near_duplicate(hashes[i], ((j, hashes[j]) for j in hashed_representatives), dedupe_threshold)
+                if match:
+                    del groups[i]
+                    groups[match[0]].append((i, match[1]))
+                else:
+                    hashed_representatives.append(i)
+
+        partials = queue.Queue()
+
+        def submit(pack):
+            if model == CASCADE_MODEL:
+                on_partial = (lambda position, analysis: partials.put((pack[position], analysis))) if stream else None
+                return executor.submit(
+                    analyze_cascade, client, [images[i] for i in pack], image_store, lang, [cancel_events[i] for i in pack],
+                    cache, preprocess_pool, preprocess_options, on_partial, [hashes.get(i) for i in pack], [triaged.get(i) for i in pack]
+                )
+            if len(pack) == 1:
+                i = pack[0]
+                on_partial = (lambda analysis: partials.put((i, analysis))) if stream else None
+                return executor.submit(
+                    analyze_image, client, images[i][1], images[i][0], image_store, lang, model, cancel_events[i],
+                    cache, preprocess_pool, preprocess_options, on_partial, hashes.get(i)
+                )
+            on_partial = (lambda position, analysis: partials.put((pack[position], analysis))) if stream else None
+            return executor.submit(
+                analyze_pack, client, [images[i] for i in pack], image_store, lang, model, [cancel_events[i] for i in pack],
+                cache, preprocess_pool, preprocess_options, on_partial, [hashes.get(i) for i in pack]
+            )
+
+        to_analyze = list(groups)
+        pack_size = max(1, pack_size)
+        futures = {submit(to_analyze[start:start + pack_size]): to_analyze[start:start + pack_size] for start in range(0, len(to_analyze), pack_size)}
+        not_done = set(futures)
+        while not_done:
+            done, not_done = wait(not_done, timeout=STREAM_UPDATE_SECONDS if stream else None, return_when=FIRST_COMPLETED)
+            finished = {i for future in done for i in futures[future]}
+            latest = {}
+            while not partials.empty():
+                i, analysis = partials.get_nowait()
+                latest[i] = analysis
+            for i, analysis in latest.items():
+                if i not in finished:
+                    for j, distance in [(i, None)] + groups.get(i, []):
+                        duplicate_of = {"image_id": images[i][1], "filename": images[i][0], "distance": distance} if j != i else None
+                        payload = make_result_payload(images[j][1], images[j][0], analysis=analysis, duplicate_of=duplicate_of)
+                        payload["partial"] = True
+                        yield j, payload
+            for future in done:
+                pack = futures[future]
+                results = future.result()
+                for i, payload in zip(pack, results if isinstance(results, list) else [results]):
+                    yield i, payload
+                    members = []
+                    for j, distance in groups.pop(i, []):
+                        if cancel_events[j].is_set():
+                            METRICS.incr("images_total", result="cancelled")
+                            yield j, make_result_payload(images[j][1], images[j][0], error=get_text(lang, "cancelled_text"), raw_text="No response from model.")
+                        else:
+                            members.append((j, distance))
+                    if members and not payload["analysis"]:
+                        # The failure may be specific to that photo, so the group gets another chance
+                        successor = members[0][0]
+                        groups[successor] = [(j, hash_distance(hashes[successor], hashes[j])) for j, _ in members[1:]]
+                        successor_future = submit([successor])
+                        futures[successor_future] = [successor]
+                        not_done.add(successor_future)
+                        continue
+                    for j, distance in members:
+                        yield j, reuse(j, payload["analysis"], {"image_id": images[i][1], "filename": images[i][0], "distance": distance}, payload["model"])
+    finally:
+        for cancel_event in cancel_events:
+            cancel_event.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+# --- RE-LOCALIZING FINISHED ANALYSES ---
+# Text-only model that rewrites finished analyses in another dashboard language, so a
+# language switch costs no image tokens
+TRANSLATION_MODEL = "gpt-4.1-mini"
+# Text requests are small; the endpoint pool's quotas still apply
+TRANSLATION_MAX_WORKERS = 16
+# German and Chinese run longer than the English they are translated from
+TRANSLATION_MAX_COMPLETION_TOKENS = 4000
+# Free-text fields of an analysis as "parent.child" paths. Grades, flags, the location and
+# the native origins (geocoded for the map and the inventory) are never sent and stay as analyzed
+TRANSLATED_FIELDS = (
+    "tree_type", "health_status", "approximate_age", "disease_identification",
+    "risk_assessment.infectious_risk_summary", "risk_assessment.structural_stability_summary",
+    "risk_assessment.consequence_of_failure_summary", "felling_recommendations.recommended_method",
+    "felling_recommendations.safety_parameters.minimum_safety_distance_meters",
+    "felling_recommendations.safety_parameters.required_personnel",
+    "felling_recommendations.safety_parameters.required_equipment",
+    "detailed_observations", "rehabilitation_advice",
+)
+# Fixed texts that are looked up in translations instead of being sent to the model
+LOCALIZED_TEXT_KEYS = ("felling_preservation_method", "no_tree_text", "cancelled_text")
+
+@functools.lru_cache(maxsize=None)
+def build_translation_prompt(lang):
+    return f"""
+                You translate tree inspection reports written by a certified arborist into {lang}.
+                The user sends a JSON object of report fields. Reply with a JSON object with exactly the same keys, each value translated into {lang}.
+                Use the established arboricultural terms of {lang}. Keep scientific (Latin) names of species, pathogens and pests, numbers, units and letter grades exactly as written.
+                For species, translate the common name and keep the scientific name in parentheses, e.g. "Silver Birch (Betula pendula)".
+                Do not add, drop, shorten or summarize anything.
+                """
+
+def translation_cache_key(analysis, lang):
+    """Cache key of ``analysis`` translated into ``lang``: the analysis's content, the model and the prompt."""
+    content = json.dumps(analysis, sort_keys=True, ensure_ascii=False)
+    prompt = hashlib.sha256(build_translation_prompt(lang).encode("utf-8")).hexdigest()[:16]
+    return f"{hashlib.sha256(content.encode('utf-8')).hexdigest()}:translation:{TRANSLATION_MODEL}:{lang}:{prompt}"
+
+def localized_text(text, lang):
+    """``text`` in ``lang`` when it is one of LOCALIZED_TEXT_KEYS in any language, otherwise None."""
+    for key in LOCALIZED_TEXT_KEYS:
+        if any(text == strings.get(key) for strings in translations.values()):
+            return get_text(lang, key)
+    return None
+
+def _field(analysis, path):
+    for key in path.split("."):
+        if not isinstance(analysis, dict):
+            return None
+        analysis = analysis.get(key)
+    return analysis
+
+def _set_field(analysis, path, value):
+    *parents, key = path.split(".")
+    for parent in parents:
+        analysis = analysis[parent]
+    analysis[key] = value
+
+def localize_analysis(client, analysis, lang, cancel_event, cache=None):
+    """A copy of ``analysis`` with its free text in ``lang``, from ``cache`` or one text-only request.
+
+    The TRANSLATED_FIELDS that hold text are sent as one flat JSON object and the reply
+    is constrained to the same keys. Texts from translations (the felling preservation
+    phrase) are swapped locally, so the card still recognizes them. Raises when the
+    request fails or the reply cannot be parsed.
+    """
+    key = translation_cache_key(analysis, lang)
+    cached = cache.get(key, kind="translation") if cache is not None else None
+    if cached:
+        return cached
+    localized = copy.deepcopy(analysis)
+    fields = {}
+    for path in TRANSLATED_FIELDS:
+        value = _field(analysis, path)
+        if not isinstance(value, str) or not value.strip():
+            continue
+        local = localized_text(value, lang)
+        if local is not None:
+            _set_field(localized, path, local)
+        else:
+            fields[path] = value
+    if fields:
+        request = dict(
+            model=TRANSLATION_MODEL,
+            messages=[
+                {"role": "system", "content": build_translation_prompt(lang)},
+                {"role": "user", "content": json.dumps(fields, ensure_ascii=False)},
+            ],
+            max_completion_tokens=TRANSLATION_MAX_COMPLETION_TOKENS, temperature=0
+        )
+        if STRUCTURED_OUTPUTS:
+            request["response_format"] = {"type": "json_schema", "json_schema": {
+                "name": "tree_translation", "strict": True, "schema": _strict_object({path: {"type": "string"} for path in fields}),
+            }}
+        with METRICS.timer("model_request", model=TRANSLATION_MODEL, translation=True):
+            result_text, usage, finish_reason = complete_text(client, cancel_event, None, **request)
+        METRICS.record_usage(usage, TRANSLATION_MODEL)
+        if finish_reason == "length":
+            result_text = continue_truncated_reply(client, cancel_event, request, result_text, [])
+        with METRICS.timer("parse"):
+            translated = extract_json_object(result_text or "")
+        for path, value in translated.items():
+            if path in fields and isinstance(value, str) and value.strip():
+                _set_field(localized, path, value)
+    METRICS.incr("translations_total", lang=lang)
+    if cache is not None:
+        cache.put(key, localized)
+    return localized
+
+def localize_results(client, results, lang, max_workers=TRANSLATION_MAX_WORKERS, cache=None, cancel_event=None):
+    """Re-localizes finished result payloads into ``lang``, yielding (index, payload) as each is ready.
+
+    Payloads keep their id, image, model and usage; only the analysis text changes, and
+    the error of a photo without a tree or a cancelled one. Results sharing an analysis
+    (near-duplicates) are translated once. When a translation fails, the payload is
+    yielded unchanged with ``localize_error`` set. Closing the generator early, or
+    setting ``cancel_event``, cancels the translations still outstanding.
+    """
+    cancel_event = cancel_event or threading.Event()
+    groups = {}
+    for i, result in enumerate(results):
+        if result["analysis"]:
+            groups.setdefault(json.dumps(result["analysis"], sort_keys=True, ensure_ascii=False), []).append(i)
+        else:
+            yield i, dict(result, error=localized_text(result["error"], lang) or result["error"])
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tree-translation")
+    try:
+        futures = {
+            executor.submit(localize_analysis, client, results[members[0]]["analysis"], lang, cancel_event, cache): members
+            for members in groups.values()
+        }
+        for future in as_completed(futures):
+            try:
+                analysis, error = future.result(), None
+            except Exception as e:
+                analysis, error = None, f"{type(e).__name__}: {e}"
+            for i in futures[future]:
+                yield i, dict(results[i], analysis=analysis) if error is None else dict(results[i], localize_error=error)
+    finally:
+        cancel_event.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+class FileImageSource:
+    """Maps image ids to files already on disk, for batch runs that need no ImageStore copy."""
+
+    def __init__(self):
+        self._paths = {}
+
+    def add(self, path):
+        image_id = file_sha256(path)
+        self._paths[image_id] = path
+        return image_id
+
+    def path(self, image_id, variant="original"):
+        return self._paths[image_id]
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """SHA-256 of a file's bytes; equal to the ImageStore id of the same upload."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()